@@ -1,56 +1,107 @@
 import datetime
+import fnmatch
+import glob
 import hashlib
 import os
+import shutil
 import stat
 import subprocess
 import sys
 import textwrap
 import urllib
-import zipfile
+import urllib2
 
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
-from distutils import file_util, dir_util
+from distutils import file_util
 
-from utils import IS_MAC, IS_WIN
+from utils import IS_MAC, IS_WIN, parallel_map
 
 if IS_MAC:
     from sh import SetFile, hdiutil, codesign
     from darwin_dyliber import fix_all_dylibs
 if IS_WIN:
     import pbs
-    from pbs import cd, glob
+    from pbs import cd
     git = pbs.Command("C:\\Program Files\\Git\\bin\\git.exe")
     python = pbs.Command("C:\\Python27\\python.exe")
-    pip = pbs.Command("C:\\Python27\\scripts\\pip.exe")
-    mkdir = pbs.Command("C:\\Program Files\\Git\\bin\\mkdir.exe")
+    PIP = "C:\\Python27\\scripts\\pip.exe"
+    pip = pbs.Command(PIP)
     make = pbs.Command("C:\\MinGW\\bin\\mingw32-make.exe")
-    cp = pbs.Command("C:\\Program Files\\Git\\bin\\cp.exe")
-    rm = pbs.Command("C:\\Program Files\\Git\\bin\\rm.exe")
-    find = pbs.Command("C:\\Program Files\\Git\\bin\\find.exe")
-    ln = pbs.Command("C:\\Program Files\\Git\\bin\\ln.exe")
-    tar = pbs.Command("C:\\Program Files\\Git\\bin\\tar.exe")
-    mv = pbs.Command("C:\\Program Files\\Git\\bin\\mv.exe")
 else:
-    from sh import git, cd, python, mkdir, make, cp, glob, pip, rm
-    from sh import find, ln, tar, mv, strip
-
-from depcollector import collect_deps
+    from sh import git, cd, python, make, pip
+    PIP = "pip"
+
+import fsops
+import instrument
+
+from archiver import SUMS, archive_name, make_archives, tarball_name
+from copier import CopyPlan
+from dedup import link_duplicates
+from delta import make_delta
+from depcollector import KEEP_MODULES, collect_deps, prune_unreachable
+from elfdeps import SYSTEM_LIBS, dependency_closure
+from gitfetch import fetch_all, repo_url
+from importprofile import profile_imports
+from libzip import BOOTSTRAP, LIBRARY_ZIP, ON_DISK, add_bootstrap, \
+    make_library
+from stripper import strip_all, strip_copies, strippable, tools_version
+from wheelhouse import Wheelhouse
 
 
 class Action(object):
     __metaclass__ = ABCMeta
 
+    # names of the actions that have to be finished before this one runs
+    depends = []
+    # set for actions that change process wide state (cwd, sys.path,
+    # os.environ) and therefore can't run alongside other actions
+    exclusive = False
+    # cacheable actions implement fingerprint() and outputs() so that the
+    # stage cache can restore their results instead of running them
+    cacheable = False
+
     def __init__(self, name, basedir, skip=[], do=[]):
         self._name = name
         self._basedir = basedir
         self._skip = skip
         self._do = do
+        self._cache = None
+        self._manifest = None
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def basedir(self):
+        return self._basedir
+
+    def use_cache(self, cache):
+        self._cache = cache
+        if self.cacheable:
+            # changes are recorded by comparing the outputs before and
+            # after running, nobody else can be writing to them meanwhile
+            self.exclusive = True
+
+    def use_manifest(self, manifest):
+        self._manifest = manifest
+
+    @property
+    def dry_run(self):
+        return self._manifest is not None and self._manifest.dry_run
+
+    @property
+    def virtual(self):
+        # the bundle is a vtree.VirtualTree, not files in Bitmask/
+        return self._manifest is not None and self._manifest.virtual
+
+    def fingerprint(self, fp, *args, **kwargs):
+        pass
+
+    def outputs(self, *args, **kwargs):
+        return []
+
     @property
     def skip(self):
         return self._name in self._skip
@@ -68,16 +119,30 @@ class Action(object):
 
 def skippable(func):
     def skip_func(self, *args, **kwargs):
-        if self.skip:
+        if self.skip or not self.do:
             print "Skipping...", self.name
+            if self._cache is not None:
+                self._cache.mark_skipped(self)
+            instrument.skipped(self.name)
             return
-        if not self.do:
-            print "Skipping...", self.name
-            return
-        return func(self, *args, **kwargs)
+        with instrument.measure(self.name):
+            if self._cache is not None:
+                return self._cache.run(self, func, args, kwargs)
+            return func(self, *args, **kwargs)
     return skip_func
 
 
+# packaging takes a snapshot of the whole tree, so it goes after everything
+PACKAGING_DEPENDS = ["gitclone", "pythonsetup", "createdirs", "collectdeps",
+                     "copybinaries", "copylibs", "plister", "darwinlauncher",
+                     "copyassets", "fixdylibs", "copymisc", "removepyc",
+                     "mtemall", "signit", "seededconfig", "rmunused",
+                     "prunemodules", "ziplib", "importprofile", "dedup"]
+
+# written by collectdeps next to the bundle, read by prunemodules
+REACHABLE_MODULES = "reachable-modules.json"
+
+
 def platform_dir(basedir, *args):
     dir_ = os.path.join(basedir, "Bitmask", *args)
 
@@ -108,7 +173,11 @@ def get_version(repos, nightly):
             try:
                 version = git("describe").strip()
             except:
-                pass
+                # shallow clones usually don't have the tags describe needs
+                try:
+                    version = git("rev-parse", "HEAD").strip()
+                except:
+                    pass
         m.update(version)
 
     return "{0}-{1}".format(str(datetime.date.today()),
@@ -116,43 +185,26 @@ def get_version(repos, nightly):
 
 
 class GitCloneAll(Action):
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "gitclone", basedir, skip, do)
 
-    def _repo_url(self, repo_name):
-        if repo_name == "leap_assets":
-            return "git://leap.se/leap_assets"
-        return "git://github.com/leapcode/{0}".format(repo_name)
-
     @skippable
-    def run(self, sorted_repos, nightly):
+    def run(self, sorted_repos, nightly, jobs=None, depth=None,
+            sparse=False, cache=None, base=None):
         print "Cloning repositories..."
         cd(self._basedir)
-
-        for repo in sorted_repos:
-            print "Cloning", repo
-            rm("-rf", repo)
-            git.clone(self._repo_url(repo), repo)
-
-            with push_pop(repo):
-                if repo in ["leap_assets"]:
-                    # leap_assets only has 'master'
-                    continue
-
-                if not nightly:
-                    git.checkout("master")
-                    git.pull("--ff-only", "origin", "master")
-                    git.fetch()
-                    git.reset("--hard", "origin/master")
-                    latest_tag = git.describe("--abbrev=0").strip()
-                    git.checkout("--quiet", latest_tag)
-                else:
-                    git.checkout("develop")
-
+        fetch_all(self._basedir, sorted_repos,
+                  lambda repo: repo_url(repo, base), nightly,
+                  jobs=jobs, depth=depth, sparse=sparse, cache=cache)
         print "Done cloning repos..."
 
 
 class PythonSetupAll(Action):
+    depends = ["gitclone"]
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "pythonsetup", basedir, skip, do)
 
@@ -169,8 +221,14 @@ class PythonSetupAll(Action):
         python("setup.py", "hash_binaries")
 
     @skippable
-    def run(self, sorted_repos, binaries_path):
+    def run(self, sorted_repos, binaries_path, wheelhouse=None, index=None,
+            jobs=None):
         cd(self._basedir)
+        if wheelhouse is not None:
+            self._run_offline(sorted_repos, binaries_path,
+                              Wheelhouse(wheelhouse, index, PIP), jobs)
+            return
+
         for repo in sorted_repos:
 
             if repo in ["bitmask_launcher", "leap_assets"]:
@@ -196,6 +254,84 @@ class PythonSetupAll(Action):
                     python("setup.py", "develop")
                     sys.path.append(os.path.join(self._basedir, repo, "src"))
 
+    def _run_offline(self, sorted_repos, binaries_path, wheelhouse, jobs):
+        # the same as above, but the requirements of all the repos are
+        # built into wheels concurrently and then installed offline, at
+        # the same time for repos that need no wheel in common
+        targets = []
+        for repo in sorted_repos:
+            if repo in ["bitmask_launcher", "leap_assets"]:
+                print "Skipping repo: {0}...".format(repo)
+            elif repo == "soledad":
+                targets.extend([(repo, "common"), (repo, "client")])
+            else:
+                targets.append((repo,))
+        environment = wheelhouse.environment()
+        pending = [t for t in targets
+                   if not wheelhouse.unchanged(
+                       os.path.join(self._basedir, *t), environment)]
+
+        requirements = [os.path.join(self._basedir,
+                                     *(t + ("pkg", "requirements.pip")))
+                        for t in pending]
+        print "Building wheels..."
+        parallel_map(wheelhouse.build, requirements, jobs)
+        for batch in wheelhouse.batches(requirements):
+            print "Installing the requirements of", ", ".join(
+                os.path.relpath(os.path.dirname(os.path.dirname(req)),
+                                self._basedir) for req in batch)
+            parallel_map(wheelhouse.install, batch, jobs)
+
+        for target in targets:
+            repo_dir = os.path.join(self._basedir, *target)
+            with push_pop(*target):
+                if target == ("bitmask_client",):
+                    self._build_client(target[0], binaries_path)
+                name = str(python("setup.py", "--name")).splitlines()[-1]
+                if target in pending or not _installed(name):
+                    print "Setting up", "/".join(target)
+                    python("setup.py", "develop")
+                else:
+                    print "Unchanged since the last setup:", "/".join(target)
+                    # the link to the repo is still installed, but a fresh
+                    # clone lost the metadata it points to
+                    if not _has_egg_info(repo_dir):
+                        python("setup.py", "egg_info")
+            sys.path.append(os.path.join(repo_dir, "src"))
+
+        wheelhouse.save([os.path.join(self._basedir, *t) for t in targets],
+                        wheelhouse.environment())
+
+
+def _installed(name):
+    # a distribution pip knows about, setup.py develop ones included
+    try:
+        return bool(subprocess.check_output([PIP, "show", name],
+                                            stderr=subprocess.STDOUT).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def _has_egg_info(repo_dir):
+    return bool(glob.glob(os.path.join(repo_dir, "*.egg-info")) or
+                glob.glob(os.path.join(repo_dir, "src", "*.egg-info")))
+
+
+def _repos_in(basedir):
+    return sorted(r for r in os.listdir(basedir)
+                  if os.path.isdir(os.path.join(basedir, r, ".git")))
+
+
+def _requirements_in(basedir, repo):
+    reqs = []
+    for dirpath, dirnames, filenames in os.walk(os.path.join(basedir, repo)):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        if os.path.basename(dirpath) == "pkg" and \
+                "requirements.pip" in filenames:
+            reqs.append(os.path.join(dirpath, "requirements.pip"))
+    return sorted(reqs)
+
 
 def _convert_path_for_win(path):
     npath = path
@@ -221,34 +357,54 @@ class CreateDirStructure(Action):
         print "Done"
 
     def _create_dir_structure(self, basedir):
-        mkdirp = mkdir.bake("-p")
+        makedirs = fsops.makedirs
+        if self.virtual:
+            makedirs = self._manifest.add_dir
         apps = os.path.join(basedir, "apps")
-        mkdirp(_convert_path_for_win(apps))
+        makedirs(apps)
         if IS_WIN:
-            mkdirp(_convert_path_for_win(os.path.join(apps, "eip")))
+            makedirs(os.path.join(apps, "eip"))
         else:
-            mkdirp(_convert_path_for_win(os.path.join(apps, "eip", "files")))
-        mkdirp(_convert_path_for_win(os.path.join(apps, "mail")))
-        mkdirp(_convert_path_for_win(os.path.join(basedir, "lib")))
+            makedirs(os.path.join(apps, "eip", "files"))
+        makedirs(os.path.join(apps, "mail"))
+        makedirs(os.path.join(basedir, "lib"))
 
     def _darwin_create_dir_structure(self):
-        mkdirp = mkdir.bake("-p")
         app_path = os.path.join(self._basedir, "Bitmask.app")
-        mkdirp(app_path)
-        mkdirp(os.path.join(app_path, "Contents", "MacOS"))
-        mkdirp(os.path.join(app_path, "Contents", "Resources"))
-        mkdirp(os.path.join(app_path, "Contents", "PlugIns"))
-        mkdirp(os.path.join(app_path, "Contents", "StartupItems"))
-        ln("-s", "/Applications", os.path.join(self._basedir, "Applications"))
+        fsops.makedirs(app_path)
+        fsops.makedirs(os.path.join(app_path, "Contents", "MacOS"))
+        fsops.makedirs(os.path.join(app_path, "Contents", "Resources"))
+        fsops.makedirs(os.path.join(app_path, "Contents", "PlugIns"))
+        fsops.makedirs(os.path.join(app_path, "Contents", "StartupItems"))
+        fsops.symlink("/Applications",
+                      os.path.join(self._basedir, "Applications"))
 
 
 class CollectAllDeps(Action):
+    depends = ["pythonsetup", "createdirs"]
+    cacheable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "collectdeps", basedir, skip, do)
 
-    def _remove_unneeded(self, lib_dir):
-        print "Removing unneeded files..."
-        files = find(lib_dir).strip().splitlines()
+    def fingerprint(self, fp, path_file, graph_cache=None, link=False):
+        fp.update_file(path_file)
+        # what's installed is what gets collected
+        fp.update_value(sys.version, str(pip("freeze")))
+        for repo in _repos_in(self._basedir):
+            for req in _requirements_in(self._basedir, repo):
+                fp.update_file(req)
+            if repo == "bitmask_client":
+                # leap.bitmask itself isn't collected, only what it imports
+                fp.update_imports(os.path.join(self._basedir, repo, "src"))
+            else:
+                fp.update_repo(os.path.join(self._basedir, repo))
+
+    def outputs(self, *args, **kwargs):
+        return [platform_dir(self._basedir, "lib"),
+                os.path.join(self._basedir, REACHABLE_MODULES)]
+
+    def _unneeded(self):
         keep = ["QtCore.so",
                 "QtGui.so",
                 "__init__.py",
@@ -264,15 +420,13 @@ class CollectAllDeps(Action):
                     "QtGui.pyd",
                     "QtCore.pyd",
                     ""]  # empty means the whole pyside dir
-        for f in files:
-            if f.find("PySide") > 0:
-                if os.path.split(f)[1] not in keep:
-                    rm("-rf", f)
-                    pass
-        print "Done"
+
+        def unneeded(f):
+            return f.find("PySide") > 0 and os.path.split(f)[1] not in keep
+        return unneeded
 
     @skippable
-    def run(self, path_file):
+    def run(self, path_file, graph_cache=None, link=False):
         print "Collecting dependencies..."
         app_py = os.path.join(self._basedir,
                               "bitmask_client",
@@ -281,93 +435,139 @@ class CollectAllDeps(Action):
                               "bitmask",
                               "app.py")
         dest_lib_dir = platform_dir(self._basedir, "lib")
-        collect_deps(app_py, dest_lib_dir, path_file)
-
-        self._remove_unneeded(dest_lib_dir)
+        # the unneeded PySide files are left out of the copy
+        collect_deps(app_py, dest_lib_dir, path_file, graph_cache, link,
+                     os.path.join(self._basedir, REACHABLE_MODULES),
+                     exclude=self._unneeded(), manifest=self._manifest)
         print "Done"
 
 
 class CopyBinaries(Action):
+    depends = ["createdirs", "collectdeps"]
+    cacheable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copybinaries", basedir, skip, do)
 
+    def fingerprint(self, fp, binaries_path, link=False, closure=False):
+        fp.update_tree(binaries_path)
+
+    def outputs(self, *args, **kwargs):
+        return [os.path.join(self._basedir, "Bitmask")]
+
     @skippable
-    def run(self, binaries_path):
+    def run(self, binaries_path, link=False, closure=False):
         print "Copying binaries..."
         dest_lib_dir = platform_dir(self._basedir, "lib")
+        plan = CopyPlan()
 
         if IS_MAC:
-            cp(glob(os.path.join(binaries_path, "Qt*")), dest_lib_dir)
-            cp(glob(os.path.join(binaries_path, "*.dylib")), dest_lib_dir)
-            cp(glob(os.path.join(binaries_path, "Python")), dest_lib_dir)
+            plan.add_glob(os.path.join(binaries_path, "Qt*"), dest_lib_dir)
+            plan.add_glob(os.path.join(binaries_path, "*.dylib"),
+                          dest_lib_dir)
+            plan.add_glob(os.path.join(binaries_path, "Python"), dest_lib_dir)
             resources_dir = os.path.join(self._basedir,
                                          "Bitmask",
                                          "Bitmask.app",
                                          "Contents",
                                          "Resources")
-            cp(glob(os.path.join(binaries_path, "openvpn.leap*")),
-               resources_dir)
-
-            mkdir("-p", os.path.join(resources_dir, "openvpn"))
-            cp("-r", glob(os.path.join(binaries_path, "openvpn.files", "*")),
-               os.path.join(resources_dir, "openvpn"))
-
-            cp(os.path.join(binaries_path, "cocoasudo"), resources_dir)
-
-            cp("-r", os.path.join(binaries_path, "qt_menu.nib"), resources_dir)
-            cp("-r", os.path.join(binaries_path, "tuntap-installer.app"),
-               resources_dir)
-            cp(os.path.join(binaries_path, "Bitmask"),
-               platform_dir(self._basedir))
+            plan.add_glob(os.path.join(binaries_path, "openvpn.leap*"),
+                          resources_dir)
+            plan.add_glob(os.path.join(binaries_path, "openvpn.files", "*"),
+                          os.path.join(resources_dir, "openvpn"),
+                          symlinks=True)
+            plan.add_into(os.path.join(binaries_path, "cocoasudo"),
+                          resources_dir)
+            plan.add_into(os.path.join(binaries_path, "qt_menu.nib"),
+                          resources_dir, symlinks=True)
+            plan.add_into(os.path.join(binaries_path, "tuntap-installer.app"),
+                          resources_dir, symlinks=True)
+            plan.add_into(os.path.join(binaries_path, "Bitmask"),
+                          platform_dir(self._basedir))
         elif IS_WIN:
-            root = _convert_path_for_win(
-                os.path.join(self._basedir, "Bitmask"))
-            for i in glob(os.path.join(binaries_path, "*.dll")):
-                cp(_convert_path_for_win(i),
-                   root)
+            root = os.path.join(self._basedir, "Bitmask")
+            plan.add_glob(os.path.join(binaries_path, "*.dll"), root)
             import win32com
             win32comext_path = os.path.split(win32com.__file__)[0] + "ext"
             shell_path = os.path.join(win32comext_path, "shell")
-            cp("-r",
-               _convert_path_for_win(shell_path),
-               _convert_path_for_win(os.path.join(dest_lib_dir, "win32com")))
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "bitmask.exe")),
-               root)
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "Microsoft.VC90.CRT.manifest")),
-               root)
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "openvpn_leap.exe")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
-            cp(_convert_path_for_win(
-                os.path.join(binaries_path, "openvpn_leap.exe.manifest")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
-            cp("-r",
-               _convert_path_for_win(
-                   os.path.join(binaries_path, "tap_driver")),
-               _convert_path_for_win(
-                   os.path.join(root, "apps", "eip")))
+            plan.add_into(shell_path, os.path.join(dest_lib_dir, "win32com"))
+            plan.add_into(os.path.join(binaries_path, "bitmask.exe"), root)
+            plan.add_into(os.path.join(binaries_path,
+                                       "Microsoft.VC90.CRT.manifest"),
+                          root)
+            eip_dir = os.path.join(root, "apps", "eip")
+            plan.add_into(os.path.join(binaries_path, "openvpn_leap.exe"),
+                          eip_dir)
+            plan.add_into(os.path.join(binaries_path,
+                                       "openvpn_leap.exe.manifest"),
+                          eip_dir)
+            plan.add_into(os.path.join(binaries_path, "tap_driver"), eip_dir)
         else:
-            cp(glob(os.path.join(binaries_path, "*.so*")), dest_lib_dir)
+            # with closure the libraries are picked by copylibs instead
+            if not closure:
+                plan.add_glob(os.path.join(binaries_path, "*.so*"),
+                              dest_lib_dir)
 
             eip_dir = platform_dir(self._basedir, "apps", "eip")
-            # cp(os.path.join(binaries_path, "openvpn"), eip_dir)
+            # plan.add_into(os.path.join(binaries_path, "openvpn"), eip_dir)
 
-            cp("-r", glob(os.path.join(binaries_path, "openvpn.files", "*")),
-               os.path.join(eip_dir, "files"))
-            cp(os.path.join(binaries_path, "bitmask"),
-               platform_dir(self._basedir))
+            plan.add_glob(os.path.join(binaries_path, "openvpn.files", "*"),
+                          os.path.join(eip_dir, "files"), symlinks=True)
+            plan.add_into(os.path.join(binaries_path, "bitmask"),
+                          platform_dir(self._basedir))
 
         mail_dir = platform_dir(self._basedir, "apps", "mail")
-        cp(_convert_path_for_win(os.path.join(binaries_path, "gpg")),
-           _convert_path_for_win(mail_dir))
+        plan.add_into(os.path.join(binaries_path, "gpg"), mail_dir)
+        plan.execute(link=link, manifest=self._manifest)
+        print "Done"
+
+
+class CopyLibraries(Action):
+    # everything ELF in the bundle has to be there to know what it needs
+    depends = ["collectdeps", "copybinaries", "copymisc"]
+    cacheable = True
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "copylibs", basedir, skip, do)
+
+    def fingerprint(self, fp, binaries_path, system_libs=SYSTEM_LIBS,
+                    link=False):
+        fp.update_tree(binaries_path)
+        fp.update_value(system_libs)
+
+    def outputs(self, *args, **kwargs):
+        return [platform_dir(self._basedir, "lib")]
+
+    @skippable
+    def run(self, binaries_path, system_libs=SYSTEM_LIBS, link=False):
+        print "Copying needed libraries..."
+        root = platform_dir(self._basedir)
+        dest_lib_dir = platform_dir(self._basedir, "lib")
+        roots = fsops.find(root, predicate=strippable, files_only=True)
+        found, unresolved = dependency_closure(
+            roots, [dest_lib_dir, binaries_path], system_libs)
+
+        plan = CopyPlan()
+        for name, path in sorted(found.items()):
+            if not path.startswith(root + os.sep):
+                plan.add_file(path, os.path.join(dest_lib_dir, name))
+        plan.execute(link=link, manifest=self._manifest)
+        print "Copied {0} of the {1} needed libraries".format(len(plan),
+                                                              len(found))
+
+        if unresolved:
+            print "WARNING: unresolved libraries, they have to come from " \
+                "the system:"
+            for name, needed_by in sorted(unresolved.items()):
+                print "  {0} (needed by {1})".format(
+                    name, ", ".join(sorted(os.path.relpath(p, root)
+                                           for p in needed_by)))
         print "Done"
 
 
 class PLister(Action):
+    depends = ["createdirs"]
+
     plist = textwrap.dedent("""\
         <?xml version="1.0" encoding="UTF-8"?>
         <!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
@@ -423,18 +623,30 @@ class PLister(Action):
 
 
 class SeededConfig(Action):
+    depends = ["createdirs", "signit"]
+    cacheable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "seededconfig", basedir, skip, do)
 
+    def fingerprint(self, fp, seeded_config):
+        fp.update_tree(seeded_config)
+
+    def outputs(self, *args, **kwargs):
+        return [platform_dir(self._basedir, "config")]
+
     @skippable
     def run(self, seeded_config):
         print "Copying seeded config..."
-        dir_util.copy_tree(seeded_config,
-                           platform_dir(self._basedir, "config"))
+        plan = CopyPlan()
+        plan.add_tree(seeded_config, platform_dir(self._basedir, "config"))
+        plan.execute(manifest=self._manifest)
         print "Done"
 
 
 class DarwinLauncher(Action):
+    depends = ["createdirs"]
+
     launcher = textwrap.dedent(
         """\
         #!/bin/bash
@@ -470,6 +682,8 @@ class DarwinLauncher(Action):
 
 
 class CopyAssets(Action):
+    depends = ["gitclone", "createdirs"]
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copyassets", basedir, skip, do)
 
@@ -481,14 +695,21 @@ class CopyAssets(Action):
                                      "Bitmask.app",
                                      "Contents",
                                      "Resources")
-        cp(os.path.join(self._basedir, "leap_assets", "mac", "bitmask.icns"),
-           resources_dir)
-        cp(os.path.join(self._basedir, "leap_assets", "mac", "bitmask.tiff"),
-           resources_dir)
+        plan = CopyPlan()
+        plan.add_into(os.path.join(self._basedir, "leap_assets", "mac",
+                                   "bitmask.icns"),
+                      resources_dir)
+        plan.add_into(os.path.join(self._basedir, "leap_assets", "mac",
+                                   "bitmask.tiff"),
+                      resources_dir)
+        plan.execute(manifest=self._manifest)
         print "Done"
 
 
 class CopyMisc(Action):
+    depends = ["pythonsetup", "createdirs", "collectdeps"]
+    cacheable = True
+
     TUF_CONFIG = textwrap.dedent("""\
         [General]
         updater_delay = 60
@@ -496,68 +717,111 @@ class CopyMisc(Action):
         [Mirror.localhost]
         url_prefix = http://dl.bitmask.net/tuf""")
 
+    EXTENSION_URL = ("https://downloads.leap.se/thunderbird_extension/"
+                     "bitmask-thunderbird-latest.xpi")
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "copymisc", basedir, skip, do)
+        self._extension = None
+
+    def _fetch_extension(self):
+        if self._extension is None:
+            print "Downloading thunderbird extension..."
+            path = os.path.join(self._basedir,
+                                "bitmask-thunderbird-latest.xpi")
+            urllib.urlretrieve(self.EXTENSION_URL, path)
+            self._extension = path
+            print "Done"
+        return self._extension
+
+    def _extension_version(self):
+        # what the server says "latest" is, without downloading it
+        request = urllib2.Request(self.EXTENSION_URL)
+        request.get_method = lambda: "HEAD"
+        try:
+            headers = urllib2.urlopen(request, timeout=60).info()
+        except (urllib2.URLError, IOError):
+            return None
+        return [headers.get(name)
+                for name in ("ETag", "Last-Modified", "Content-Length")]
+
+    def fingerprint(self, fp, binary_path, link=False):
+        # "latest" changes behind our back
+        fp.update_value(self.EXTENSION_URL, self._extension_version())
+        fp.update_file(os.path.join(binary_path, "root.json"))
+        for repo in ["bitmask_launcher", "bitmask_client", "leap_pycommon"]:
+            fp.update_repo(os.path.join(self._basedir, repo))
+
+    def outputs(self, *args, **kwargs):
+        return [os.path.join(self._basedir, "Bitmask")]
 
     @skippable
-    def run(self, binary_path):
-        print "Downloading thunderbird extension..."
+    def run(self, binary_path, link=False):
         ext_path = platform_dir(self._basedir, "apps",
                                 "bitmask-thunderbird-latest.xpi")
-        urllib.urlretrieve(
-            "https://downloads.leap.se/thunderbird_extension/"
-            "bitmask-thunderbird-latest.xpi",
-            ext_path)
-        print "Done"
+        plan = CopyPlan()
+        if self.dry_run:
+            print "Not downloading", self.EXTENSION_URL, "in a dry run"
+        else:
+            plan.add_file(self._fetch_extension(), ext_path)
         print "Copying misc files..."
-        apps_dir = _convert_path_for_win(platform_dir(self._basedir, "apps"))
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir, "bitmask_launcher", "src",
-                         "launcher.py")),
-           apps_dir)
-        cp("-r",
-           _convert_path_for_win(os.path.join(self._basedir, "bitmask_client",
-                                              "src", "leap")),
-           apps_dir)
-        lib_dir = _convert_path_for_win(platform_dir(self._basedir, "lib"))
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir,
-                         "leap_pycommon",
-                         "src", "leap", "common", "cacert.pem")),
-           _convert_path_for_win(os.path.join(lib_dir, "leap", "common")))
-        cp(_convert_path_for_win(glob(os.path.join(self._basedir,
-                                                   "bitmask_client", "build",
-                                                   "lib*", "leap", "bitmask",
-                                                   "_version.py"))[0]),
-           os.path.join(apps_dir, "leap", "bitmask"))
-
-        cp(_convert_path_for_win(
-            os.path.join(self._basedir,
-                         "bitmask_client", "relnotes.txt")),
-           _convert_path_for_win(os.path.join(self._basedir, "Bitmask")))
+        apps_dir = platform_dir(self._basedir, "apps")
+        plan.add_into(os.path.join(self._basedir, "bitmask_launcher", "src",
+                                   "launcher.py"),
+                      apps_dir)
+        plan.add_into(os.path.join(self._basedir, "bitmask_client",
+                                   "src", "leap"),
+                      apps_dir)
+        lib_dir = platform_dir(self._basedir, "lib")
+        plan.add_into(os.path.join(self._basedir,
+                                   "leap_pycommon",
+                                   "src", "leap", "common", "cacert.pem"),
+                      os.path.join(lib_dir, "leap", "common"))
+        # added after the leap tree so that it replaces the one in there
+        plan.add_glob(os.path.join(self._basedir,
+                                   "bitmask_client", "build",
+                                   "lib*", "leap", "bitmask",
+                                   "_version.py"),
+                      os.path.join(apps_dir, "leap", "bitmask"))
+
+        plan.add_into(os.path.join(self._basedir,
+                                   "bitmask_client", "relnotes.txt"),
+                      os.path.join(self._basedir, "Bitmask"))
+
+        metadata = os.path.join(self._basedir, "Bitmask", "repo", "metadata")
+        plan.add_dir(os.path.join(metadata, "previous"))
+        plan.add_into(os.path.join(binary_path, "root.json"),
+                      os.path.join(metadata, "current"))
+        plan.execute(link=link, manifest=self._manifest)
+        if self.dry_run:
+            return
 
         launcher_path = os.path.join(self._basedir, "Bitmask", "launcher.conf")
+        if self.virtual:
+            self._manifest.add_bytes(launcher_path, self.TUF_CONFIG)
+            print "Done"
+            return
         with open(launcher_path, "w") as f:
             f.write(self.TUF_CONFIG)
-
-        metadata = os.path.join(self._basedir, "Bitmask", "repo", "metadata")
-        mkdir("-p", os.path.join(metadata, "current"))
-        mkdir("-p", os.path.join(metadata, "previous"))
-        cp(os.path.join(binary_path, "root.json"),
-           os.path.join(metadata, "current"))
         print "Done"
 
 
 class FixDylibs(Action):
+    depends = ["collectdeps", "copybinaries", "plister",
+               "darwinlauncher", "copyassets"]
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "fixdylibs", basedir, skip, do)
 
     @skippable
-    def run(self):
-        fix_all_dylibs(platform_dir(self._basedir))
+    def run(self, jobs=None):
+        fix_all_dylibs(platform_dir(self._basedir), jobs)
 
 
 class DmgIt(Action):
+    depends = PACKAGING_DEPENDS
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "dmgit", basedir, skip, do)
 
@@ -568,14 +832,17 @@ class DmgIt(Action):
         version = get_version(repos, nightly)
         dmg_dir = os.path.join(self._basedir, "dmg")
         template_dir = os.path.join(self._basedir, "Bitmask")
-        mkdir("-p", dmg_dir)
-        cp("-R", os.path.join(template_dir, "Applications"), dmg_dir)
-        cp("-R", os.path.join(template_dir, "relnotes.txt"), dmg_dir)
-        cp("-R", os.path.join(template_dir, "Bitmask.app"), dmg_dir)
-        cp(os.path.join(self._basedir,
-                        "leap_assets",
-                        "mac", "bitmask.icns"),
-           os.path.join(dmg_dir, ".VolumeIcon.icns"))
+        plan = CopyPlan()
+        plan.add_into(os.path.join(template_dir, "Applications"), dmg_dir,
+                      symlinks=True)
+        plan.add_into(os.path.join(template_dir, "relnotes.txt"), dmg_dir)
+        plan.add_into(os.path.join(template_dir, "Bitmask.app"), dmg_dir,
+                      symlinks=True)
+        plan.add_file(os.path.join(self._basedir,
+                                   "leap_assets",
+                                   "mac", "bitmask.icns"),
+                      os.path.join(dmg_dir, ".VolumeIcon.icns"))
+        plan.execute()
         SetFile("-c", "icnC", os.path.join(dmg_dir, ".VolumeIcon.icns"))
 
         vol_name = "Bitmask"
@@ -587,58 +854,188 @@ class DmgIt(Action):
                 "-fsargs", "-c c=64,a=16,e=16", "-fs", "HFS+",
                 "-format", "UDRW", "-ov", "-size", "500000k",
                 raw_dmg_path)
-        rm("-rf", dmg_dir)
-        mkdir(dmg_dir)
+        fsops.remove(dmg_dir)
+        fsops.makedirs(dmg_dir)
         hdiutil("attach", raw_dmg_path, "-mountpoint", dmg_dir)
         SetFile("-a", "C", dmg_dir)
         hdiutil("detach", dmg_dir)
 
-        rm("-rf", dmg_dir)
+        fsops.remove(dmg_dir)
         hdiutil("convert", raw_dmg_path, "-format", "UDZO",
                 "-imagekey", "zlib-level=9", "-o",
                 dmg_path)
-        rm("-f", raw_dmg_path)
+        fsops.remove(raw_dmg_path)
         print "Done"
 
 
 class TarballIt(Action):
+    depends = PACKAGING_DEPENDS
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "tarballit", basedir, skip, do)
 
     @skippable
-    def run(self, repos, nightly):
+    def run(self, repos, nightly, compression="bz2", jobs=None,
+            previous=None, extra_formats=()):
         print "Tarballing it..."
         cd(self._basedir)
         version = get_version(repos, nightly)
         import platform
         bits = platform.architecture()[0][:2]
         bundle_name = "Bitmask-linux%s-%s" % (bits, version)
-        mv("Bitmask", bundle_name)
-        tar("cjf", bundle_name+".tar.bz2", bundle_name)
+        bundle_dir = os.path.join(self._basedir, bundle_name)
+        listing = None
+        if self.virtual:
+            # streamed from where the files are, there's no Bitmask/
+            listing = self._manifest.listing(
+                os.path.join(self._basedir, "Bitmask"))
+        else:
+            fsops.rename(os.path.join(self._basedir, "Bitmask"), bundle_dir)
+        # every format from the same read of the tree
+        formats = [compression] + [f for f in extra_formats
+                                   if f != compression]
+        tarball = os.path.join(self._basedir,
+                               archive_name(bundle_name, compression))
+        make_archives(bundle_dir,
+                      [(os.path.join(self._basedir,
+                                     archive_name(bundle_name, fmt)), fmt)
+                       for fmt in formats],
+                      jobs=jobs, listing=listing, sums=SUMS)
+        if previous is not None:
+            print "Making delta from", previous
+            # the delta makes what's in the tarball, sums included
+            sums = os.path.join(bundle_dir, SUMS)
+            shutil.copyfile(tarball + "." + SUMS, sums)
+            make_delta(previous, bundle_dir,
+                       os.path.join(self._basedir,
+                                    tarball_name(bundle_name + ".delta",
+                                                 compression)),
+                       fmt=compression, jobs=jobs, sums=sums)
         print "Done"
 
 
 class PycRemover(Action):
+    depends = ["collectdeps", "copybinaries", "copylibs", "copymisc",
+               "fixdylibs"]
+    # everything it works on comes from the actions it depends on
+    cacheable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "removepyc", basedir, skip, do)
 
+    def fingerprint(self, fp, strip_cache=None, debug_symbols=None,
+                    jobs=None):
+        # the tree comes from the actions it depends on, how it gets
+        # stripped from here
+        fp.update_value(tools_version(), strip_cache, debug_symbols, jobs,
+                        self.virtual)
+
+    def outputs(self, strip_cache=None, debug_symbols=None, jobs=None):
+        outputs = [os.path.join(self._basedir, "Bitmask")]
+        if debug_symbols is not None:
+            outputs.append(debug_symbols)
+        return outputs
+
+    def _run_virtual(self, strip_cache, jobs):
+        # the binaries get stripped into the scratch directory of the tree
+        tree = self._manifest
+        tree.remove_matching(
+            self._basedir,
+            lambda path: path.endswith(".pyc") and not tree.isdir(path))
+        print "Stripping binaries..."
+        files = tree.find(self._basedir, "*.so*", predicate=strippable)
+        sources = sorted(set(tree.source(f) for f in files))
+        stripped = strip_copies(sources, tree.scratch, strip_cache, jobs)
+        for f in files:
+            tree.set_source(f, stripped[tree.source(f)])
+
     @skippable
-    def run(self):
+    def run(self, strip_cache=None, debug_symbols=None, jobs=None):
         print "Removing .pyc files..."
-        files = find(self._basedir, "-name", "*.pyc").strip().splitlines()
-        for f in files:
-            rm(f)
-        files = find(self._basedir, "-name", "*\\.so*").strip().splitlines()
-        for f in files:
-            print "Stripping", f
-            try:
-                strip(f)
-            except:
-                pass
+        if self.virtual:
+            self._run_virtual(strip_cache, jobs)
+            print "Done"
+            return
+        for f in fsops.find(self._basedir, "*.pyc", files_only=True):
+            os.unlink(f)
+        print "Stripping binaries..."
+        files = fsops.find(self._basedir, "*.so*", predicate=strippable)
+        strip_all(self._basedir, files, strip_cache, debug_symbols, jobs)
+        print "Done"
+
+
+class ZipLibrary(Action):
+    depends = ["collectdeps", "copymisc", "removepyc", "rmunused",
+               "prunemodules"]
+    cacheable = True
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "ziplib", basedir, skip, do)
+
+    def fingerprint(self, fp, jobs=None):
+        # the bytecode in the zip is the one of this interpreter
+        fp.update_value(sys.version, BOOTSTRAP, LIBRARY_ZIP, ON_DISK, jobs)
+
+    def outputs(self, *args, **kwargs):
+        return [platform_dir(self._basedir, "lib"),
+                platform_dir(self._basedir, "apps", "launcher.py")]
+
+    @skippable
+    def run(self, jobs=None):
+        print "Zipping the python library..."
+        make_library(platform_dir(self._basedir, "lib"), jobs)
+        add_bootstrap(platform_dir(self._basedir, "apps", "launcher.py"))
+        print "Done"
+
+
+class ImportProfile(Action):
+    # measures the bundle as it will be shipped
+    depends = ["collectdeps", "copymisc", "copylibs", "removepyc",
+               "rmunused", "prunemodules", "ziplib"]
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "importprofile", basedir, skip, do)
+
+    @skippable
+    def run(self, modules=["leap.bitmask.app"]):
+        print "Profiling imports..."
+        lib_dir = platform_dir(self._basedir, "lib")
+        path = [platform_dir(self._basedir, "apps")]
+        library = os.path.join(lib_dir, "library.zip")
+        if os.path.isfile(library):
+            path.append(library)
+        path.append(lib_dir)
+        profile_imports(path, modules,
+                        os.path.join(self._basedir, REACHABLE_MODULES),
+                        os.path.join(self._basedir, "import-profile.txt"),
+                        os.path.join(self._basedir, "import-profile.json"),
+                        library_path=lib_dir)
+        print "Done"
+
+
+class Deduplicate(Action):
+    # the last one to touch the tree, a file modified in place afterwards
+    # would change its duplicates too
+    depends = [name for name in PACKAGING_DEPENDS if name != "dedup"]
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "dedup", basedir, skip, do)
+
+    @skippable
+    def run(self, jobs=None):
+        print "Hardlinking identical files..."
+        linked, saved = link_duplicates(
+            os.path.join(self._basedir, "Bitmask"), jobs)
+        print "Linked {0} files, {1:.1f} MB less to archive".format(
+            linked, saved / (1024.0 * 1024.0))
         print "Done"
 
 
 class MtEmAll(Action):
+    depends = ["copybinaries", "removepyc"]
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "mtemall", basedir, skip, do)
 
@@ -659,29 +1056,35 @@ class MtEmAll(Action):
 
 
 class ZipIt(Action):
+    depends = PACKAGING_DEPENDS
+    exclusive = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "zipit", basedir, skip, do)
 
-    def _zipdir(self, path, zf):
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                zf.write(os.path.join(root, f))
-
     @skippable
-    def run(self, repos, nightly):
+    def run(self, repos, nightly, jobs=None, extra_formats=()):
         print "Ziping it..."
         cd(self._basedir)
         version = get_version(repos, nightly)
         name = "Bitmask-win32-{0}".format(version)
-        mv(_convert_path_for_win(os.path.join(self._basedir, "Bitmask")),
-           _convert_path_for_win(os.path.join(self._basedir, name)))
-        zf = zipfile.ZipFile("{0}.zip".format(name), "w", zipfile.ZIP_DEFLATED)
-        self._zipdir(name, zf)
-        zf.close()
+        bundle_dir = os.path.join(self._basedir, name)
+        fsops.rename(os.path.join(self._basedir, "Bitmask"), bundle_dir)
+        formats = ["zip"] + [f for f in extra_formats if f != "zip"]
+        make_archives(bundle_dir,
+                      [(os.path.join(self._basedir, archive_name(name, fmt)),
+                        fmt)
+                       for fmt in formats],
+                      jobs=jobs, sums=SUMS)
         print "Done"
 
 
 class SignIt(Action):
+    # nothing may change the .app once it's signed, rmunused isn't part of
+    # the mac build so ziplib depending on it makes no cycle here
+    depends = ["fixdylibs", "copymisc", "removepyc", "prunemodules",
+               "ziplib"]
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "signit", basedir, skip, do)
 
@@ -718,17 +1121,49 @@ class SignIt(Action):
 
 
 class RemoveUnused(Action):
+    depends = ["collectdeps", "copymisc", "removepyc", "seededconfig"]
+    cacheable = True
+
     def __init__(self, basedir, skip, do):
         Action.__init__(self, "rmunused", basedir, skip, do)
 
+    def outputs(self, *args, **kwargs):
+        return [os.path.join(self._basedir, "Bitmask")]
+
     @skippable
     def run(self):
         print "Removing unused python code..."
-        test_dirs = find(self._basedir, "-name", "*test*").strip().splitlines()
-        for td in test_dirs:
-            rm("-rf", os.path.join(self._basedir, td))
+        remove_matching = fsops.remove_matching
+        if self.virtual:
+            remove_matching = self._manifest.remove_matching
+        remove_matching(
+            self._basedir,
+            lambda path: fnmatch.fnmatch(os.path.basename(path), "*test*"))
 
-        # twisted_used = ["aplication", "conch", "cred",
-        #                 "version", "internet", "mail"]
-        # twisted_files = find(self._basedir, "-name", "t
+        print "Done"
+
+
+class PruneModules(Action):
+    # both delete under lib/
+    depends = ["collectdeps", "copymisc", "removepyc", "rmunused"]
+    cacheable = True
+
+    def __init__(self, basedir, skip, do):
+        Action.__init__(self, "prunemodules", basedir, skip, do)
+
+    def fingerprint(self, fp, keep=KEEP_MODULES):
+        fp.update_value(keep)
+
+    def outputs(self, *args, **kwargs):
+        return [platform_dir(self._basedir, "lib")]
+
+    @skippable
+    def run(self, keep=KEEP_MODULES):
+        print "Pruning unreachable python modules..."
+        tree = None
+        if self.virtual:
+            tree = self._manifest
+        prune_unreachable(platform_dir(self._basedir, "lib"),
+                          os.path.join(self._basedir, REACHABLE_MODULES),
+                          keep, tree)
         print "Done"
@@ -0,0 +1,564 @@
+import bz2
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+from collections import deque
+from contextlib import contextmanager
+from cStringIO import StringIO
+from Queue import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from fsops import walk
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The input is cut in fixed size blocks, each one compressed on its own
+# into a complete stream and the streams written one after the other in
+# input order. bzip2, xz and zstd all decompress concatenated streams as
+# one, and since the blocks don't depend on the number of workers neither
+# does the output.
+
+
+def _bz2(data):
+    return bz2.compress(data, 9)
+
+
+def _xz(data):
+    return lzma.compress(data, preset=6)
+
+
+def _zstd(data):
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+def _bz2_decompressor():
+    return bz2.BZ2Decompressor()
+
+
+def _xz_decompressor():
+    return lzma.LZMADecompressor()
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# name -> (extension, block size, compress function, decompressor
+#          factory, module it needs)
+FORMATS = {
+    # a bzip2 block at level 9 is 900k, so the ratio barely changes
+    "bz2": ("tar.bz2", 900 * 1000, _bz2, _bz2_decompressor, bz2),
+    "xz": ("tar.xz", 8 * 1024 * 1024, _xz, _xz_decompressor, lzma),
+    "zstd": ("tar.zst", 8 * 1024 * 1024, _zstd, _zstd_decompressor,
+             zstandard),
+}
+
+CHUNK = 1024 * 1024
+
+# entries waiting for each archive writer
+QUEUE_SIZE = 64
+
+# files from this size on are memory mapped instead of read
+MMAP_SIZE = 1024 * 1024
+
+# symlinks followed before giving up on a loop, like the kernel's
+MAX_LINKS = 40
+
+# sha256sum -c format checksums of the files of the bundle, at its top
+# and next to the archives
+SUMS = "SHA256SUMS"
+
+
+class ParallelCompressor(object):
+    # write only file object, what's written to it ends up compressed in
+    # fileobj. The compression libraries release the GIL, so threads are
+    # enough to keep all the cores busy.
+    def __init__(self, fileobj, fmt="bz2", jobs=None):
+        if fmt not in FORMATS:
+            raise ValueError("Unknown compression {0}".format(fmt))
+        _, self._block_size, self._compress, _, module = FORMATS[fmt]
+        if module is None:
+            raise ValueError("{0} compression isn't available, install "
+                             "its python module".format(fmt))
+        self._fileobj = fileobj
+        self._jobs = jobs or cpu_count()
+        self._pool = ThreadPool(self._jobs)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._closed = False
+
+    def _submit(self, data):
+        self._pending.append(self._pool.apply_async(self._compress, (data,)))
+        # bounded, so memory stays the same whatever the size of the tree
+        while len(self._pending) > 2 * self._jobs:
+            self._fileobj.write(self._pending.popleft().get())
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self._block_size:
+            return
+        data = "".join(self._buffer)
+        start = 0
+        while len(data) - start >= self._block_size:
+            self._submit(data[start:start + self._block_size])
+            start += self._block_size
+        self._buffer = [data[start:]]
+        self._buffered = len(data) - start
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buffered:
+                self._submit("".join(self._buffer))
+            self._buffer = []
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+
+class ConcatenatedReader(object):
+    # read only file object decompressing every stream in fileobj, python
+    # 2's BZ2File stops after the first one
+    def __init__(self, fileobj, fmt):
+        _, _, _, self._factory, module = FORMATS[fmt]
+        if module is None:
+            raise ValueError("{0} compression isn't available, install "
+                             "its python module".format(fmt))
+        self._fileobj = fileobj
+        self._decompressor = self._factory()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _feed(self, data):
+        out = []
+        while data:
+            try:
+                out.append(self._decompressor.decompress(data))
+            except EOFError:
+                # the previous stream ended right at the end of a chunk
+                self._decompressor = self._factory()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._factory()
+        self._buffer = self._buffer[self._pos:] + "".join(out)
+        self._pos = 0
+
+    def read(self, size=-1):
+        while not self._eof and \
+                (size < 0 or len(self._buffer) - self._pos < size):
+            data = self._fileobj.read(CHUNK)
+            if not data:
+                self._eof = True
+                break
+            self._feed(data)
+        if size < 0:
+            size = len(self._buffer) - self._pos
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def format_of(path):
+    for fmt, info in FORMATS.items():
+        if path.endswith("." + info[0]):
+            return fmt
+    raise ValueError("Unknown archive format " + path)
+
+
+@contextmanager
+def open_tarball(path):
+    # a streaming tarfile, members can only be read in order
+    with open(path, "rb") as f:
+        tf = tarfile.open(fileobj=ConcatenatedReader(f, format_of(path)),
+                          mode="r|")
+        try:
+            yield tf
+        finally:
+            tf.close()
+
+
+def tree_entries(root):
+    # sorted, tarfile's own recursion uses unsorted listdir
+    yield root
+    for dirpath, dirnames, filenames in walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            yield os.path.join(dirpath, name)
+
+
+def tarball_name(name, fmt="bz2"):
+    return "{0}.{1}".format(name, FORMATS[fmt][0])
+
+
+def archive_name(name, fmt):
+    if fmt == "zip":
+        return name + ".zip"
+    return tarball_name(name, fmt)
+
+
+# not worth deflating, they are compressed already
+STORED_EXTENSIONS = set([
+    ".zip", ".xpi", ".jar", ".egg", ".whl", ".cab", ".7z",
+    ".gz", ".tgz", ".bz2", ".xz", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".mp3", ".ogg",
+])
+COMPRESSED_MAGICS = [
+    "PK\x03\x04", "\x1f\x8b", "BZh", "\xfd7zXZ", "\x89PNG", "\xff\xd8\xff",
+    "GIF8",
+]
+# bigger files are sampled, in windows spread over all of them since a
+# binary can have its compressed resources anywhere
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_WINDOWS = 4
+# the sample has to deflate to less than this for the file to be
+# deflated, which is only short of incompressible: the whole file gets
+# deflated when the sample is borderline, and stored if that's no smaller
+SAMPLE_RATIO = 0.98
+
+# _write_entry writes the entries deflated by the pool the way python
+# 2.7's zipfile does, elsewhere they go through writestr, which deflates
+PRECOMPRESSED = sys.version_info[:2] == (2, 7)
+
+
+def worth_deflating(name, data):
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return False
+    if any(data[:len(magic)] == magic for magic in COMPRESSED_MAGICS):
+        return False
+    if len(data) <= SAMPLE_SIZE:
+        return True
+    window = SAMPLE_SIZE // SAMPLE_WINDOWS
+    step = (len(data) - window) // (SAMPLE_WINDOWS - 1)
+    deflated = sum(len(zlib.compress(data[i * step:i * step + window], 1))
+                   for i in range(SAMPLE_WINDOWS))
+    return deflated < SAMPLE_SIZE * SAMPLE_RATIO
+
+
+def _deflate(path, data):
+    # (size, crc, compress type, data to store)
+    size = len(data)
+    crc = zlib.crc32(data) & 0xffffffff
+    compress_type = zipfile.ZIP_STORED
+    if not PRECOMPRESSED:
+        if worth_deflating(path, data):
+            compress_type = zipfile.ZIP_DEFLATED
+        return size, crc, compress_type, data
+    if worth_deflating(path, data):
+        # raw deflate, what zipfile itself writes
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data):
+            compress_type = zipfile.ZIP_DEFLATED
+            data = deflated
+    return size, crc, compress_type, data
+
+
+def _write_entry(zf, zinfo, deflated):
+    # ZipFile.writestr minus the compression, which was done already
+    zinfo.file_size, zinfo.CRC, zinfo.compress_type, data = deflated
+    if not PRECOMPRESSED:
+        zf.writestr(zinfo, data[:])
+        return
+    zinfo.compress_size = len(data)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+        zinfo.compress_size > zipfile.ZIP64_LIMIT
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+# The writers get every entry of the tree, with the contents of the files
+# read only once for all of them, and the first time for files with
+# several hardlinks. Each one runs in its own thread.
+
+class _TarWriter(object):
+    def __init__(self, dest, fmt, jobs):
+        self.dest = dest
+        self._out = open(dest + ".tmp", "wb")
+        try:
+            self._compressor = ParallelCompressor(self._out, fmt, jobs)
+        except ValueError:
+            self._out.close()
+            os.unlink(dest + ".tmp")
+            raise
+        self._tf = tarfile.open(fileobj=self._compressor, mode="w|",
+                                format=tarfile.GNU_FORMAT)
+
+    def add(self, path, name, st, data, inode, last):
+        # tarfile turns the later links to an inode into link entries
+        tarinfo = self._tf.gettarinfo(path, name)
+        if tarinfo is None:
+            return
+        if tarinfo.isreg():
+            self._tf.addfile(tarinfo, StringIO(data))
+        else:
+            self._tf.addfile(tarinfo)
+
+    def close(self, ok):
+        try:
+            if ok:
+                self._tf.close()
+        finally:
+            self._compressor.close()
+            self._out.close()
+
+
+class _ZipWriter(object):
+    # like zip -r, entries are deflated concurrently but written in
+    # sorted order, and stored when deflating doesn't pay off. Zip has no
+    # hardlinks, every one of them gets its entry, but they are only
+    # deflated once.
+    def __init__(self, dest, jobs):
+        self.dest = dest
+        self._jobs = jobs
+        self._pool = ThreadPool(jobs)
+        self._pending = deque()
+        self._shared = {}
+        self._out = open(dest + ".tmp", "wb")
+        self._zf = zipfile.ZipFile(self._out, "w", zipfile.ZIP_DEFLATED,
+                                   allowZip64=True)
+
+    def add(self, path, name, st, data, inode, last):
+        if st is None:
+            return
+        zinfo = zipfile.ZipInfo(name.replace(os.sep, "/"),
+                                time.localtime(st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        result = self._shared.get(inode)
+        if result is None:
+            result = self._pool.apply_async(_deflate, (path, data))
+        if inode is not None:
+            # kept until its last link is written
+            if last:
+                self._shared.pop(inode, None)
+            else:
+                self._shared[inode] = result
+        self._pending.append((zinfo, result))
+        while len(self._pending) > 2 * self._jobs:
+            self._write()
+
+    def _write(self):
+        zinfo, result = self._pending.popleft()
+        _write_entry(self._zf, zinfo, result.get())
+
+    def close(self, ok):
+        try:
+            if ok:
+                while self._pending:
+                    self._write()
+                self._zf.close()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._out.close()
+
+
+def _drain(writer, queue, errors):
+    try:
+        for item in iter(queue.get, None):
+            writer.add(*item)
+    except Exception:
+        errors.append(sys.exc_info())
+        # the reader mustn't block on a full queue
+        while queue.get() is not None:
+            pass
+
+
+def _resolve(paths, path, rel):
+    # the file a symlink ends up at, followed from where the link is in
+    # the archive and not from where it is on disk, a virtual tree keeps
+    # them in a scratch directory
+    for _ in range(MAX_LINKS):
+        if not os.path.islink(path):
+            return path
+        target = os.readlink(path)
+        rel = os.path.normpath(os.path.join(os.path.dirname(rel), target))
+        if os.path.isabs(target) or rel not in paths:
+            # out of the archive, or through a linked directory
+            return os.path.join(os.path.dirname(path), target)
+        path = paths[rel]
+    return None
+
+
+def _entries(listing):
+    # (path, name in the archive, stat of the file it is or points to,
+    # None for the rest, the file its contents are read from)
+    paths = dict((os.path.normpath(rel), path) for path, rel in listing)
+    entries = []
+    for path, rel in listing:
+        st = None
+        source = _resolve(paths, path, rel)
+        if source is not None and os.path.isfile(source):
+            st = os.stat(source)
+        entries.append((path, rel, st, source))
+    return entries
+
+
+def _read(path, size):
+    # the pages of a mapped file are shared by all the writers, instead
+    # of being copied into a string
+    with open(path, "rb") as f:
+        if size >= MMAP_SIZE:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+def read_sums(path):
+    # {path relative to the bundle: sha256} of a sums file
+    sums = {}
+    with open(path) as f:
+        for line in f:
+            sha, rel = line.rstrip("\n").split("  ", 1)
+            sums[os.path.normpath(rel)] = sha
+    return sums
+
+
+def make_archives(root, archives, arcname=None, jobs=None, listing=None,
+                  sums=None):
+    # Writes root to every (dest, format) of archives, the format one of
+    # FORMATS or "zip", walking and reading the tree once for all of them.
+    # The top directory in the archives is named arcname. listing, (path,
+    # path relative to root) in tree_entries order, replaces the walk.
+    # With sums, the checksums of the files taken while reading them are
+    # added last as the file sums, and written next to every archive as
+    # <archive>.<sums>.
+    if arcname is None:
+        arcname = os.path.basename(root)
+    jobs = jobs or cpu_count()
+    if listing is None:
+        listing = [(path, os.path.relpath(path, root))
+                   for path in tree_entries(root)]
+    entries = _entries(listing)
+    links = {}
+    for _, _, st, _ in entries:
+        if st is not None and st.st_nlink > 1:
+            inode = (st.st_dev, st.st_ino)
+            links[inode] = links.get(inode, 0) + 1
+
+    writers = []
+    queues = []
+    threads = []
+    errors = []
+    checksums = []
+    inode_sums = {}
+    newest = 0
+    sums_tmp = None
+    ok = False
+    try:
+        for dest, fmt in archives:
+            if fmt == "zip":
+                writers.append(_ZipWriter(dest, jobs))
+            else:
+                writers.append(_TarWriter(dest, fmt, jobs))
+        queues = [Queue(QUEUE_SIZE) for _ in writers]
+        for writer, queue in zip(writers, queues):
+            thread = threading.Thread(target=_drain,
+                                      args=(writer, queue, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        read = set()
+        for path, rel, st, source in entries:
+            if errors:
+                break
+            data = inode = None
+            last = False
+            if st is not None:
+                if st.st_nlink > 1:
+                    inode = (st.st_dev, st.st_ino)
+                    links[inode] -= 1
+                    last = links[inode] == 0
+                if inode is None or inode not in read:
+                    read.add(inode)
+                    data = _read(source, st.st_size)
+                    sha = hashlib.sha256(data).hexdigest()
+                    inode_sums[inode] = sha
+                else:
+                    sha = inode_sums[inode]
+                if not os.path.islink(path):
+                    checksums.append((sha, os.path.normpath(rel)))
+                    newest = max(newest, st.st_mtime)
+            name = os.path.normpath(os.path.join(arcname, rel))
+            for queue in queues:
+                queue.put((path, name, st, data, inode, last))
+
+        if sums is not None and not errors:
+            fd, sums_tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(archives[0][0])))
+            with os.fdopen(fd, "w") as f:
+                for sha, rel in checksums:
+                    f.write("{0}  {1}\n".format(sha, rel.replace(os.sep, "/")))
+            os.chmod(sums_tmp, 0644)
+            # dated like the newest file it covers, the same input makes
+            # the same archive
+            os.utime(sums_tmp, (newest, newest))
+            st = os.stat(sums_tmp)
+            for queue in queues:
+                queue.put((sums_tmp, os.path.join(arcname, sums), st,
+                           _read(sums_tmp, st.st_size), None, False))
+        ok = True
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        ok = ok and not errors
+        for writer in writers:
+            writer.close(ok)
+            if ok:
+                os.rename(writer.dest + ".tmp", writer.dest)
+                if sums_tmp is not None:
+                    shutil.copyfile(sums_tmp, writer.dest + "." + sums)
+            else:
+                os.unlink(writer.dest + ".tmp")
+        if sums_tmp is not None:
+            os.unlink(sums_tmp)
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return [dest for dest, _ in archives]
+
+
+def make_tarball(root, dest, arcname=None, fmt="bz2", jobs=None):
+    # like tar c<fmt>f dest root, the top directory named arcname
+    make_archives(root, [(dest, fmt)], arcname, jobs)
+    return dest
+
+
+def make_zip(root, dest, arcname=None, jobs=None):
+    make_archives(root, [(dest, "zip")], arcname, jobs)
+    return dest
@@ -0,0 +1,468 @@
+# Times the bundling stages on a generated workspace, no network, VM or
+# leap repositories needed:
+#
+#   python benchmark.py --scales 20 100 --output before.json
+#   python benchmark.py --scales 20 100 --compare before.json
+#
+# Every scale is a fake site-packages with that many packages, each one
+# with --modules modules importing each other, data files, an extension
+# module and a tests directory, plus the leap packages and hooks
+# collect_deps expects. The extension modules are copies of the
+# interpreter's own, real ELF objects to strip, and the libraries they
+# link to make the binaries directory the ELF closure is taken from. The
+# repositories are local bare ones with a history of --commits commits,
+# their requirements tiny wheels installed into a user site of their own.
+
+import argparse
+import compileall
+import glob
+import imp
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+import zipfile
+
+from distutils import file_util
+
+from actions import CopyLibraries, PycRemover, RemoveUnused, platform_dir
+from actions import PIP
+from archiver import make_archives, make_tarball, make_zip
+from copier import CopyPlan
+from depcollector import HOOKS, collect_deps
+from elfdeps import dependency_closure
+from fsops import find, makedirs, remove
+from gitfetch import fetch_all, repo_url
+from main import sorted_repos
+from stripper import strip_copies, strippable
+from utils import parallel_map
+from wheelhouse import Wheelhouse
+
+LEAP_PACKAGES = ["leap.common", "leap.keymanager", "leap.mail",
+                 "leap.soledad.client", "leap.soledad.common", "jsonschema"]
+
+NAMESPACE_INIT = "__import__('pkg_resources').declare_namespace(__name__)\n"
+
+STAGES = ["git", "git_shallow", "setup", "setup_warm", "collect_deps",
+          "collect_deps_warm", "copy", "copy_hardlink", "elf_closure",
+          "strip", "removepyc", "rmunused", "tarball", "zip",
+          "tarball_and_zip"]
+
+# where the libraries the extension modules link to are looked for
+LIB_DIRS = ["/lib", "/lib64", "/usr/lib", "/usr/lib64", "/lib/*-linux-gnu",
+            "/usr/lib/*-linux-gnu"]
+
+AUTHOR = "bench <bench@example.org> 1400000000 +0000"
+
+
+def _write(path, data):
+    makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _module_source(rng, imports, functions=20):
+    lines = ["import {0}".format(name) for name in imports]
+    for i in range(functions):
+        lines.append("")
+        lines.append("def function_{0}(value):".format(i))
+        lines.append("    \"\"\"{0}\"\"\"".format("x" * rng.randint(10, 80)))
+        lines.append("    return value * {0} + {1}".format(i, len(imports)))
+    return "\n".join(lines) + "\n"
+
+
+def _elf_objects():
+    # the extension modules of the interpreter, None if it has none
+    dynload = sysconfig.get_config_var("DESTSHARED") or ""
+    objects = [path for path in sorted(glob.glob(os.path.join(dynload,
+                                                              "*.so")))
+               if strippable(path)]
+    return objects or None
+
+
+def _make_binaries(binaries, objects):
+    # what the extension modules need besides the system libraries, like
+    # the binaries path of a real build
+    lib_dirs = [d for pattern in LIB_DIRS for d in sorted(glob.glob(pattern))]
+    found, _ = dependency_closure(objects, lib_dirs)
+    makedirs(binaries)
+    for name, path in sorted(found.items()):
+        file_util.copy_file(path, os.path.join(binaries, name))
+    return len(found)
+
+
+def _make_wheel(index, name):
+    # the smallest wheel pip installs
+    dist_info = "{0}-1.0.dist-info".format(name)
+    files = {
+        name + ".py": "VALUE = {0!r}\n".format(name),
+        dist_info + "/METADATA": "Metadata-Version: 2.1\nName: {0}\n"
+                                 "Version: 1.0\n".format(name),
+        dist_info + "/WHEEL": "Wheel-Version: 1.0\nGenerator: benchmark\n"
+                              "Root-Is-Purelib: true\nTag: py2-none-any\n",
+    }
+    record = "".join("{0},,\n".format(f) for f in sorted(files))
+    files[dist_info + "/RECORD"] = record + dist_info + "/RECORD,,\n"
+    path = os.path.join(index, "{0}-1.0-py2-none-any.whl".format(name))
+    with zipfile.ZipFile(path, "w") as zf:
+        for arcname, data in sorted(files.items()):
+            zf.writestr(arcname, data)
+
+
+def _data(data):
+    return "data {0}\n{1}\n".format(len(data), data)
+
+
+def _make_remote(path, requirements, commits, rng):
+    # a bare repository through git fast-import, every commit changes a
+    # module, there's a release tag every ten of them and develop is a
+    # commit ahead of master
+    subprocess.check_call(["git", "init", "--quiet", "--bare", path])
+    subprocess.check_call(["git", "symbolic-ref", "HEAD",
+                           "refs/heads/master"], cwd=path)
+    stream = []
+    for i in range(1, commits + 1):
+        stream.append("commit refs/heads/master\nmark :{0}\n"
+                      "committer {1}\n".format(i, AUTHOR))
+        stream.append(_data("commit {0}".format(i)))
+        if i > 1:
+            stream.append("from :{0}\n".format(i - 1))
+        else:
+            for name, data in [
+                    ("setup.py", "from setuptools import setup\n"
+                                 "setup(name={0!r})\n".format(path)),
+                    ("pkg/requirements.pip", "".join(
+                        r + "\n" for r in requirements)),
+                    ("tests/test_all.py", _module_source(rng, ["os"])),
+                    ("docs/index.rst", "x" * 4096)]:
+                stream.append("M 644 inline {0}\n".format(name))
+                stream.append(_data(data))
+        stream.append("M 644 inline src/mod{0:04d}.py\n".format(i % 50))
+        stream.append(_data(_module_source(rng, ["os"])))
+        if i % 10 == 0:
+            stream.append("tag 0.{0}\nfrom :{1}\ntagger {2}\n".format(
+                i // 10, i, AUTHOR))
+            stream.append(_data("0.{0}".format(i // 10)))
+    stream.append("commit refs/heads/develop\ncommitter {0}\n".format(
+        AUTHOR))
+    stream.append(_data("develop"))
+    stream.append("from :{0}\n".format(commits))
+    stream.append("M 644 inline src/develop.py\n")
+    stream.append(_data(_module_source(rng, ["os"])))
+    proc = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path,
+                            stdin=subprocess.PIPE)
+    proc.communicate("".join(stream))
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, "git fast-import")
+
+
+def _findable(name):
+    try:
+        imp.find_module(name.split(".")[0])
+    except ImportError:
+        return False
+    return True
+
+
+def make_workspace(root, packages, modules, commits=100, seed=0):
+    rng = random.Random(seed)
+    site = os.path.join(root, "site-packages")
+    objects = _elf_objects()
+    names = []
+    for p in range(packages):
+        name = "pkg{0:04d}".format(p)
+        names.append(name)
+        pkg_dir = os.path.join(site, name)
+        _write(os.path.join(pkg_dir, "__init__.py"),
+               _module_source(rng, ["{0}.mod0000".format(name)]))
+        for m in range(modules):
+            imports = ["os", "json"]
+            if m + 1 < modules:
+                imports.append("{0}.mod{1:04d}".format(name, m + 1))
+            _write(os.path.join(pkg_dir, "mod{0:04d}.py".format(m)),
+                   _module_source(rng, imports))
+        _write(os.path.join(pkg_dir, "data", "schema.json"),
+               json.dumps({"package": name, "values": range(200)}))
+        _write(os.path.join(pkg_dir, "tests", "__init__.py"), "")
+        _write(os.path.join(pkg_dir, "tests", "test_all.py"),
+               _module_source(rng, [name]))
+        if p % 3 == 0:
+            # an extension module, modulegraph only looks at the name
+            speedups = os.path.join(pkg_dir, "_speedups.so")
+            if objects is not None:
+                file_util.copy_file(objects[p // 3 % len(objects)], speedups)
+            else:
+                _write(speedups, os.urandom(rng.randint(64, 256) * 1024))
+            with open(os.path.join(pkg_dir, "__init__.py"), "a") as f:
+                f.write("try:\n    from {0} import _speedups\n"
+                        "except ImportError:\n    pass\n".format(name))
+
+    # what collect_deps and its hooks can't do without
+    for dotted in LEAP_PACKAGES + HOOKS:
+        if dotted not in LEAP_PACKAGES and _findable(dotted):
+            continue
+        parts = dotted.split(".")
+        for i in range(1, len(parts) + 1):
+            init = os.path.join(site, *(parts[:i] + ["__init__.py"]))
+            if not os.path.exists(init):
+                _write(init, NAMESPACE_INIT if i < len(parts) else
+                       _module_source(rng, ["os"]))
+
+    basedir = os.path.join(root, "build")
+    app = os.path.join(basedir, "bitmask_client", "src", "leap", "bitmask",
+                       "app.py")
+    _write(app, _module_source(rng, names + LEAP_PACKAGES))
+
+    # like create_paths.py does
+    paths_file = os.path.join(root, "paths")
+    file_util.write_file(paths_file, [site] + sys.path[1:])
+
+    libraries = 0
+    if objects is not None:
+        libraries = _make_binaries(os.path.join(root, "binaries"), objects)
+
+    # each repo needs its own wheel and the next one's
+    index = os.path.join(root, "index")
+    makedirs(index)
+    for i, repo in enumerate(sorted_repos):
+        _make_wheel(index, "benchdep{0}".format(i))
+        _make_remote(os.path.join(root, "remotes", repo),
+                     ["benchdep{0}".format(i),
+                      "benchdep{0}".format((i + 1) % len(sorted_repos))],
+                     commits, rng)
+
+    files = find(site, files_only=True)
+    size = sum(os.path.getsize(f) for f in files)
+    return basedir, app, paths_file, {"packages": packages,
+                                      "modules": modules,
+                                      "files": len(files), "bytes": size,
+                                      "commits": commits,
+                                      "libraries": libraries}
+
+
+def _timed(results, stage, func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    results.setdefault(stage, []).append(time.time() - start)
+
+
+def _pip():
+    # the one of the interpreter running the benchmark
+    pip = os.path.join(os.path.dirname(sys.executable), "pip")
+    if os.path.exists(pip):
+        return pip
+    return PIP
+
+
+def _setup(house, requirements, jobs):
+    # PythonSetupAll with a wheelhouse, up to setup.py develop
+    parallel_map(house.build, requirements, jobs)
+    for batch in house.batches(requirements):
+        parallel_map(house.install, batch, jobs)
+
+
+def run_pipeline(root, basedir, app, paths_file, jobs, results):
+    bundle = os.path.join(basedir, "Bitmask")
+    remove(bundle)
+
+    base = "file://" + os.path.join(root, "remotes")
+    for stage, depth in [("git", None), ("git_shallow", 1)]:
+        checkouts = os.path.join(root, stage)
+        remove(checkouts)
+        makedirs(checkouts)
+        _timed(results, stage, fetch_all, checkouts, sorted_repos,
+               lambda repo: repo_url(repo, base), False, jobs=jobs,
+               depth=depth, sparse=depth is not None)
+
+    # installed into a user site that goes away with the workspace
+    house_dir = os.path.join(root, "wheelhouse")
+    user_base = os.path.join(root, "userbase")
+    remove(house_dir)
+    remove(user_base)
+    environ = dict(os.environ)
+    os.environ.update({"PIP_USER": "1", "PYTHONUSERBASE": user_base,
+                       "PIP_DISABLE_PIP_VERSION_CHECK": "1",
+                       "PIP_NO_PYTHON_VERSION_WARNING": "1"})
+    try:
+        house = Wheelhouse(house_dir, os.path.join(root, "index"), _pip())
+        requirements = [os.path.join(root, "git", repo, "pkg",
+                                     "requirements.pip")
+                        for repo in sorted_repos]
+        _timed(results, "setup", _setup, house, requirements, jobs)
+        _timed(results, "setup_warm", _setup, house, requirements, jobs)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+    lib_dir = platform_dir(basedir, "lib")
+    makedirs(lib_dir)
+    graph_cache = os.path.join(root, "graph-cache.json")
+    remove(graph_cache)
+
+    _timed(results, "collect_deps", collect_deps, app, lib_dir, paths_file,
+           graph_cache)
+    remove(lib_dir)
+    makedirs(lib_dir)
+    _timed(results, "collect_deps_warm", collect_deps, app, lib_dir,
+           paths_file, graph_cache)
+
+    for stage, link in [("copy", False), ("copy_hardlink", True)]:
+        copy_dir = os.path.join(root, stage)
+        remove(copy_dir)
+        plan = CopyPlan()
+        plan.add_tree(lib_dir, copy_dir)
+        _timed(results, stage, plan.execute, jobs, link)
+        remove(copy_dir)
+
+    binaries = os.path.join(root, "binaries")
+    if os.path.isdir(binaries):
+        _timed(results, "elf_closure", CopyLibraries(basedir, [], []).run,
+               binaries)
+    stripped = os.path.join(root, "stripped")
+    makedirs(stripped)
+    _timed(results, "strip", strip_copies,
+           find(bundle, "*.so*", predicate=strippable), stripped, jobs=jobs)
+    remove(stripped)
+
+    compileall.compile_dir(lib_dir, quiet=True)
+    _timed(results, "removepyc", PycRemover(basedir, [], []).run, jobs=jobs)
+    _timed(results, "rmunused", RemoveUnused(basedir, [], []).run)
+
+    out = os.path.join(root, "out")
+    makedirs(out)
+    _timed(results, "tarball", make_tarball, bundle,
+           os.path.join(out, "bundle.tar.bz2"), jobs=jobs)
+    _timed(results, "zip", make_zip, bundle,
+           os.path.join(out, "bundle.zip"), jobs=jobs)
+    _timed(results, "tarball_and_zip", make_archives, bundle,
+           [(os.path.join(out, "both.tar.bz2"), "bz2"),
+            (os.path.join(out, "both.zip"), "zip")], jobs=jobs)
+    remove(out)
+
+
+def _quiet(func, *args):
+    # the stages print a lot, only the results matter here
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    sys.stdout.flush()
+    os.dup2(devnull, 1)
+    try:
+        return func(*args)
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(devnull)
+        os.close(stdout)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(scales, modules, repeat, jobs, commits=100):
+    report = {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "jobs": jobs,
+        "repeat": repeat,
+        "commits": commits,
+        "results": [],
+    }
+    for packages in scales:
+        root = tempfile.mkdtemp(prefix="bundler-bench-")
+        try:
+            basedir, app, paths_file, scale = make_workspace(
+                root, packages, modules, commits)
+            times = {}
+            for _ in range(repeat):
+                _quiet(run_pipeline, root, basedir, app, paths_file, jobs,
+                       times)
+            for stage in STAGES:
+                if stage not in times:
+                    continue
+                report["results"].append({
+                    "scale": scale,
+                    "stage": stage,
+                    "seconds": times[stage],
+                    "best": min(times[stage]),
+                })
+        finally:
+            remove(root)
+    return report
+
+
+def _key(result):
+    return (result["scale"]["packages"], result["scale"]["modules"],
+            result["stage"])
+
+
+def print_report(report, baseline=None, threshold=0.2):
+    # returns the results slower than the baseline by more than threshold
+    before = {}
+    if baseline is not None:
+        before = dict((_key(r), r["best"]) for r in baseline["results"])
+    regressions = []
+    print "{0:>8} {1:>7} {2:<18} {3:>9} {4:>9}".format(
+        "packages", "modules", "stage", "best s", "vs base")
+    for result in report["results"]:
+        old = before.get(_key(result))
+        ratio = ""
+        if old:
+            change = result["best"] / old
+            ratio = "{0:.2f}x".format(change)
+            if change > 1 + threshold:
+                ratio += " !"
+                regressions.append(result)
+        print "{0:8d} {1:7d} {2:<18} {3:9.3f} {4:>9}".format(
+            result["scale"]["packages"], result["scale"]["modules"],
+            result["stage"], result["best"], ratio)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bundling stages offline.')
+    parser.add_argument('--scales', type=int, nargs="+", default=[20, 100],
+                        help="Number of packages in each generated "
+                        "site-packages")
+    parser.add_argument('--modules', type=int, default=20,
+                        help="Modules per package")
+    parser.add_argument('--commits', type=int, default=100,
+                        help="Commits in the history of each repository")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per scale, the best one is compared")
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--output', help="Write the results as JSON here")
+    parser.add_argument('--compare',
+                        help="Results of a previous run to compare with, "
+                        "exits with 1 on regressions")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slowdown tolerated before it's a regression")
+    args = parser.parse_args()
+
+    report = benchmark(args.scales, args.modules, args.repeat, args.jobs,
+                       args.commits)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    if print_report(report, baseline, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import glob
+import json
+import os
+import shutil
+import sys
+import threading
+
+from collections import OrderedDict
+
+import instrument
+
+from fsops import makedirs, remove, walk
+from stagecache import hash_file
+from utils import parallel_map
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK = 1024 * 1024
+
+# ioctl asking the filesystem to share the source extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+# objects that strip and install_name_tool rewrite in place, a hardlink
+# would let them modify the original too
+BINARY_MAGICS = [
+    "\x7fELF",
+    "\xfe\xed\xfa\xce", "\xce\xfa\xed\xfe",
+    "\xfe\xed\xfa\xcf", "\xcf\xfa\xed\xfe",
+    "\xca\xfe\xba\xbe",
+]
+
+
+def _is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(4) in BINARY_MAGICS
+
+
+def _clone(fsrc, fdst):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def copy_file(src, dst, link=False):
+    instrument.count("files_copied")
+    remove(dst)
+    if link and hasattr(os, "link") and not _is_binary(src):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # different filesystem or no hardlink support
+            pass
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            if not _clone(fsrc, fdst):
+                shutil.copyfileobj(fsrc, fdst, CHUNK)
+                instrument.count("bytes_copied", fdst.tell())
+    shutil.copystat(src, dst)
+
+
+# Collects everything a stage wants copied before touching the disk, so
+# the files can be copied concurrently. Destinations are unique, when the
+# same destination is added twice the last source wins, as it would
+# copying one by one.
+class CopyPlan(object):
+    def __init__(self):
+        self._files = OrderedDict()
+        self._links = OrderedDict()
+        self._dirs = set()
+        # (destination, source replaced, source replacing it)
+        self._replaced = []
+
+    def __len__(self):
+        return len(self._files) + len(self._links)
+
+    def add_file(self, src, dst):
+        self._links.pop(dst, None)
+        previous = self._files.pop(dst, None)
+        if previous is not None and previous != src:
+            self._replaced.append((dst, previous, src))
+        self._files[dst] = src
+        self._dirs.add(os.path.dirname(dst))
+
+    def add_link(self, target, dst):
+        self._files.pop(dst, None)
+        self._links.pop(dst, None)
+        self._links[dst] = target
+        self._dirs.add(os.path.dirname(dst))
+
+    def add_dir(self, dst):
+        self._dirs.add(dst)
+
+    def add_tree(self, src, dst, symlinks=False):
+        # the contents of src end up in dst, like dir_util.copy_tree
+        self._dirs.add(dst)
+        for dirpath, dirnames, filenames in walk(src,
+                                                 followlinks=not symlinks):
+            reldir = os.path.relpath(dirpath, src)
+            destdir = os.path.normpath(os.path.join(dst, reldir))
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                if symlinks and os.path.islink(path):
+                    dirnames.remove(name)
+                    self.add_link(os.readlink(path),
+                                  os.path.join(destdir, name))
+                else:
+                    self._dirs.add(os.path.join(destdir, name))
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if symlinks and os.path.islink(path):
+                    self.add_link(os.readlink(path),
+                                  os.path.join(destdir, name))
+                else:
+                    self.add_file(path, os.path.join(destdir, name))
+
+    def add_into(self, src, dstdir, symlinks=False):
+        # like `cp -r src dstdir`
+        dst = os.path.join(dstdir, os.path.basename(src.rstrip(os.sep)))
+        if symlinks and os.path.islink(src):
+            self.add_link(os.readlink(src), dst)
+        elif os.path.isdir(src):
+            self.add_tree(src, dst, symlinks)
+        else:
+            self.add_file(src, dst)
+
+    def add_glob(self, pattern, dstdir, symlinks=False):
+        for src in sorted(glob.glob(pattern)):
+            self.add_into(src, dstdir, symlinks)
+
+    def discard(self, predicate, root):
+        # drops what fsops.remove_matching(root, predicate) would remove
+        # once copied, so that it isn't copied at all
+        def matches(path):
+            while path.startswith(root + os.sep):
+                if predicate(path):
+                    return True
+                path = os.path.dirname(path)
+            return False
+        for entries in (self._files, self._links):
+            for dst in [d for d in entries if matches(d)]:
+                del entries[dst]
+        self._dirs = set(d for d in self._dirs if not matches(d))
+
+    def execute(self, jobs=None, link=False, manifest=None):
+        files = self._files.items()
+        if manifest is not None:
+            files = manifest.record(self._files.items(), self._links.items(),
+                                    self._replaced, jobs, self._dirs)
+            if manifest.dry_run or manifest.virtual:
+                return
+        for d in sorted(self._dirs):
+            makedirs(d)
+        for dst, target in self._links.items():
+            remove(dst)
+            os.symlink(target, dst)
+
+        def copy(item):
+            dst, src = item
+            copy_file(src, dst, link)
+        parallel_map(copy, files, jobs)
+
+
+def _describe(item, digest):
+    dst, src = item
+    sha = hash_file(src) if digest else None
+    return dst, src, os.path.getsize(src), sha
+
+
+# What the copy plans of all the actions put in the bundle, with the size
+# of every file, and its hash when digests are wanted. Copies of a file
+# that is already at its destination are skipped, overwrites with other
+# contents are reported, and with digests identical files at several
+# destinations too. Without them files are only read to compare the two
+# copies of a destination that have the same size. In a dry run nothing
+# gets copied, the actions only record their plans.
+class CopyManifest(object):
+    virtual = False
+
+    def __init__(self, basedir, dry_run=False, digests=False):
+        self._basedir = basedir
+        self.dry_run = dry_run
+        self.digests = digests
+        self._lock = threading.Lock()
+        self._files = {}
+        self._links = {}
+        self._overwrites = []
+        self._skipped = 0
+
+    def _rel(self, path):
+        return os.path.relpath(path, self._basedir)
+
+    def record(self, files, links, replaced, jobs=None, dirs=()):
+        # returns the files that still have to be copied
+        owner = instrument.current()
+        described = parallel_map(lambda item: _describe(item, self.digests),
+                                 files, jobs)
+        todo = []
+        with self._lock:
+            for dst, old, new in replaced:
+                self._overwrites.append({"path": self._rel(dst),
+                                         "action": owner, "by": owner,
+                                         "source": old, "new_source": new})
+            for dst, target in links:
+                self._links[self._rel(dst)] = {"target": target,
+                                               "action": owner}
+            for dst, src, size, sha in described:
+                rel = self._rel(dst)
+                previous = self._files.get(rel)
+                if previous is not None and previous["size"] == size:
+                    if previous["sha256"] is None:
+                        previous["sha256"] = hash_file(previous["source"])
+                    if sha is None:
+                        sha = hash_file(src)
+                    if previous["sha256"] == sha:
+                        self._skipped += 1
+                        continue
+                if previous is not None:
+                    self._overwrites.append({
+                        "path": rel, "action": previous["action"],
+                        "by": owner, "source": previous["source"],
+                        "new_source": src})
+                self._files[rel] = {"source": src, "size": size,
+                                    "sha256": sha, "action": owner}
+                todo.append((dst, src))
+        return todo
+
+    def entries(self):
+        # destination relative to basedir -> source, size, sha256, action
+        with self._lock:
+            return dict(self._files)
+
+    def duplicates(self):
+        # destinations sharing their contents, biggest waste first
+        entries = self.entries()
+        by_hash = {}
+        for rel, entry in entries.items():
+            if entry["size"] > 0 and entry["sha256"] is not None:
+                by_hash.setdefault(entry["sha256"], []).append(rel)
+        groups = [(entries[paths[0]]["size"], sorted(paths))
+                  for paths in by_hash.values() if len(paths) > 1]
+        return sorted(groups, key=lambda g: (-g[0] * (len(g[1]) - 1), g[1]))
+
+    def write(self, path):
+        with self._lock:
+            manifest = {"files": self._files, "links": self._links,
+                        "overwrites": self._overwrites,
+                        "skipped": self._skipped}
+        if self.digests:
+            manifest["duplicates"] = [{"size": size, "paths": paths}
+                                      for size, paths in self.duplicates()]
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def print_summary(self, top=10):
+        entries = self.entries()
+        if not entries:
+            return
+        mb = lambda n: "{0:.1f} MB".format(n / (1024.0 * 1024.0))
+        print "Copy manifest: {0} files, {1}, {2} copies skipped as " \
+            "already in place".format(
+                len(entries), mb(sum(e["size"] for e in entries.values())),
+                self._skipped)
+        if self.digests:
+            duplicates = self.duplicates()
+            print "{0} files have identical copies, {1} in excess".format(
+                sum(len(paths) for _, paths in duplicates),
+                mb(sum(size * (len(paths) - 1)
+                       for size, paths in duplicates)))
+            for size, paths in duplicates[:top]:
+                print "  {0} x{1}: {2}".format(mb(size), len(paths),
+                                                ", ".join(paths))
+        for o in self._overwrites:
+            print "WARNING: {0} from {1} overwritten by {2} with {3}".format(
+                o["path"], o["action"], o["by"], o["new_source"])
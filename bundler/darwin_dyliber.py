@@ -1,59 +1,206 @@
 import os
+import struct
+import subprocess
 
-from sh import otool, install_name_tool, find
+from collections import namedtuple
 
-def parse_otool_output(output):
-    lines = output.splitlines()[1:]
-    libs = []
-    for line in lines:
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        line = line.split("(")[0].strip()
-        lib = os.path.split(line)[-1]
-        libs.append((lib, line))
+from fsops import walk
+from utils import parallel_map
+
+INSTALL_NAME_TOOL = "install_name_tool"
+
+# magic as read big endian -> (byte order, 64 bit)
+MACHO_MAGICS = {
+    0xfeedface: (">", False),
+    0xcefaedfe: ("<", False),
+    0xfeedfacf: (">", True),
+    0xcffaedfe: ("<", True),
+}
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LOAD_COMMANDS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB,
+                 LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+MachOInfo = namedtuple("MachOInfo", ["install_name", "dylibs", "rpaths"])
+
+
+class MachOError(Exception):
+    pass
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise MachOError("Truncated Mach-O file")
+    return data
+
+
+def _read_slice(f, offset):
+    magic = struct.unpack(">I", _read(f, offset, 4))[0]
+    if magic not in MACHO_MAGICS:
+        raise MachOError("Bad Mach-O magic in fat slice")
+    endian, is_64 = MACHO_MAGICS[magic]
+    ncmds, sizeofcmds = struct.unpack(endian + "II",
+                                      _read(f, offset + 16, 8))
+    pos = offset + (32 if is_64 else 28)
+    commands = _read(f, pos, sizeofcmds)
+
+    install_name = None
+    dylibs = []
+    rpaths = []
+    start = 0
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack(endian + "II",
+                                     commands[start:start + 8])
+        if cmdsize < 8 or start + cmdsize > len(commands):
+            raise MachOError("Bad load command size")
+        if cmd == LC_ID_DYLIB or cmd == LC_RPATH or cmd in LOAD_COMMANDS:
+            # the string is the first field after cmd and cmdsize in both
+            # dylib_command and rpath_command
+            name_offset = struct.unpack(endian + "I",
+                                        commands[start + 8:start + 12])[0]
+            name = commands[start + name_offset:start + cmdsize]
+            name = name.split("\0", 1)[0]
+            if cmd == LC_ID_DYLIB:
+                install_name = name
+            elif cmd == LC_RPATH:
+                rpaths.append(name)
+            else:
+                dylibs.append(name)
+        start += cmdsize
+    return install_name, dylibs, rpaths
+
+
+def read_macho(path):
+    # Returns the install name, linked dylibs and rpaths of a Mach-O file,
+    # or None if it isn't one. For universal binaries all the slices are
+    # merged.
+    with open(path, "rb") as f:
+        head = f.read(8)
+        if len(head) < 8:
+            return None
+        magic, nfat = struct.unpack(">II", head)
+        if magic in MACHO_MAGICS:
+            return MachOInfo(*_read_slice(f, 0))
+        if magic not in (FAT_MAGIC, FAT_MAGIC_64) or nfat > 32:
+            # java class files share the fat magic, but their version
+            # number makes nfat way bigger than any real universal binary
+            return None
 
-    return libs
+        if magic == FAT_MAGIC:
+            arch_fmt, arch_size = ">iiIII", 20
+        else:
+            arch_fmt, arch_size = ">iiQQII", 32
+        install_name = None
+        dylibs = []
+        rpaths = []
+        for i in range(nfat):
+            arch = struct.unpack(arch_fmt,
+                                 _read(f, 8 + i * arch_size, arch_size))
+            name, libs, paths = _read_slice(f, arch[2])
+            install_name = install_name or name
+            dylibs.extend(lib for lib in libs if lib not in dylibs)
+            rpaths.extend(p for p in paths if p not in rpaths)
+        return MachOInfo(install_name, dylibs, rpaths)
 
-def locate_lib(executable_path, lib):
-    return find(executable_path, "-name", lib, "-type", "f").strip()
 
-def install_name_tooler(executable_path, lib_path):
-    out = otool("-L", lib_path)
-    _, lib_name = os.path.split(lib_path)
-    libs = parse_otool_output(out)
-    updated_any = False
-    for lib, original in libs:
-        do_id = lib == lib_name
+def bundle_files(executable_path):
+    files = []
+    for dirpath, dirnames, filenames in walk(executable_path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(path)
+    return files
 
+
+def build_index(files):
+    # basename -> path, what used to be a `find -name` per dependency
+    index = {}
+    for path in files:
+        index.setdefault(os.path.basename(path), path)
+    return index
+
+
+def _relocated(executable_path, location):
+    return os.path.join("@executable_path",
+                        os.path.relpath(location, executable_path))
+
+
+def plan_fixes(executable_path, index, path, info):
+    # install_name_tool arguments that make path load everything it can
+    # from inside the bundle
+    lib_name = os.path.basename(path)
+    names = list(info.dylibs)
+    if info.install_name is not None:
+        names.insert(0, info.install_name)
+
+    args = []
+    new_id = None
+    for original in names:
         if original.find("Carbon") > 0:
             continue
-        location = locate_lib(executable_path, lib)
-        if location is None or len(location) == 0:
+        lib = os.path.basename(original)
+        location = index.get(lib)
+        if location is None:
             continue
+        relocated = _relocated(executable_path, location)
+        if lib == lib_name:
+            if new_id is None and relocated != info.install_name:
+                new_id = relocated
+        elif relocated != original:
+            args.extend(["-change", original, relocated])
+    if new_id is not None:
+        args = ["-id", new_id] + args
+    return args
+
+
+def plan_all(executable_path):
+    files = bundle_files(executable_path)
+    index = build_index(files)
+    plan = []
+    for path in files:
         try:
-            if do_id:
-                install_name_tool("-id",
-                                  os.path.join("@executable_path",
-                                               os.path.relpath(location,
-                                                               executable_path)),
-                                  lib_path)
-            else:
-                install_name_tool("-change", original,
-                                  os.path.join("@executable_path",
-                                               os.path.relpath(location,
-                                                               executable_path)),
-                                  lib_path)
-            updated_any = True
-        except Exception as e:
-            print "ERROR Fixing", lib
-            print e
-    if updated_any:
-        print "Fixed", lib_path
-
-def fix_all_dylibs(executable_path):
-    print "Fixing all dylibs, this might take a while..."
-    files = find(executable_path, "-type", "f").strip().splitlines()
-    for f in files:
-        install_name_tooler(executable_path, f)
-    print "Done"
+            info = read_macho(path)
+        except (MachOError, IOError, struct.error) as e:
+            print "WARNING: can't read", path, e
+            continue
+        if info is None:
+            continue
+        args = plan_fixes(executable_path, index, path, info)
+        if args:
+            plan.append((path, args))
+    return plan
+
+
+def _apply(item):
+    # every change of a file in a single install_name_tool run
+    path, args = item
+    try:
+        subprocess.check_output([INSTALL_NAME_TOOL] + args + [path],
+                                stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        print "ERROR Fixing", path
+        print e.output
+        return False
+    print "Fixed", path
+    return True
+
+
+def fix_all_dylibs(executable_path, jobs=None):
+    print "Fixing all dylibs..."
+    plan = plan_all(executable_path)
+    results = parallel_map(_apply, plan, jobs)
+    print "Done, fixed {0} files, {1} failed".format(results.count(True),
+                                                     results.count(False))
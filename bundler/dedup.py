@@ -0,0 +1,47 @@
+import os
+import stat
+
+from fsops import walk
+from stagecache import hash_file
+from utils import parallel_map
+
+
+def _same_size(root):
+    # regular files that have the size of another one, in sorted order
+    by_size = {}
+    for dirpath, dirnames, filenames in walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                by_size.setdefault(st.st_size, []).append((path, st))
+    candidates = []
+    for files in by_size.values():
+        if len(files) > 1:
+            candidates.extend(files)
+    return sorted(candidates)
+
+
+def link_duplicates(root, jobs=None):
+    # Replaces every file of root with the contents, mode and owner of one
+    # that comes before it by a hardlink to that one. tarfile writes
+    # hardlinks as link entries, so the contents go once in the tarball.
+    candidates = _same_size(root)
+    hashes = parallel_map(lambda item: hash_file(item[0]), candidates, jobs)
+    first = {}
+    linked = saved = 0
+    for (path, st), sha in zip(candidates, hashes):
+        key = (sha, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+        if key not in first:
+            first[key] = (path, st)
+            continue
+        target, target_st = first[key]
+        if (st.st_dev, st.st_ino) == (target_st.st_dev, target_st.st_ino):
+            continue
+        tmp = path + ".dedup"
+        os.link(target, tmp)
+        os.rename(tmp, path)
+        linked += 1
+        saved += st.st_size
+    return linked, saved
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from archiver import make_tarball, open_tarball, read_sums
+from fsops import makedirs, remove, walk
+from stagecache import hash_file
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+# A delta turns the previous bundle into the new one. It's a tarball with
+# delta.json first, describing every entry of the new bundle:
+#   keep   the content is in the old bundle, at "source", with "sha256"
+#   patch  patches/<path> is a bsdiff4 patch from "source" to "sha256"
+#   new    files/<path> is the whole file
+#   same   the content is the one of the new file at "source", it's
+#          hardlinked to it when they have the same mode
+# Files are matched by content, so unchanged files that moved are kept
+# too. Without the bsdiff4 module changed files go in whole.
+
+DELTA_VERSION = 2
+MANIFEST = "delta.json"
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _reader(path):
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+    return read
+
+
+def _new_tree(root, hashes):
+    files, links, dirs = {}, {}, []
+    for dirpath, dirnames, filenames in walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                links[rel] = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                dirs.append([rel, stat.S_IMODE(st.st_mode)])
+            elif stat.S_ISREG(st.st_mode):
+                sha = hashes.get(rel) or hash_file(path)
+                files[rel] = (sha, stat.S_IMODE(st.st_mode))
+    return files, links, dirs
+
+
+def _old_entries(previous):
+    # (path, kind, data) for every entry of the previous bundle, be it a
+    # tarball or an extracted directory. The data of files is only read
+    # when asked for, tarballs can't go back.
+    if os.path.isdir(previous):
+        for dirpath, dirnames, filenames in walk(previous):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, previous)
+                if os.path.islink(path):
+                    yield rel, "link", None
+                elif os.path.isdir(path):
+                    yield rel, "dir", None
+                else:
+                    yield rel, "file", _reader(path)
+        return
+
+    with open_tarball(previous) as tf:
+        for member in tf:
+            # the top directory is named after the old version
+            parts = member.name.split("/", 1)
+            if len(parts) < 2 or not parts[1]:
+                continue
+            rel = os.path.normpath(parts[1])
+            # a hardlink's contents are those of a file before it
+            if member.issym() or member.islnk():
+                yield rel, "link", None
+            elif member.isdir():
+                yield rel, "dir", None
+            elif member.isfile():
+                yield rel, "file", tf.extractfile(member).read
+
+
+def make_delta(previous, root, dest, fmt="bz2", jobs=None, sums=None):
+    # previous is the last bundle (tarball or directory), root the
+    # staged new one. The checksums in the sums file of root, if any,
+    # aren't taken again.
+    hashes = {}
+    if sums is not None:
+        hashes = read_sums(sums)
+    files, links, dirs = _new_tree(root, hashes)
+    wanted = set(sha for sha, _ in files.values())
+    staging = tempfile.mkdtemp(prefix="bundler-delta-")
+    # mkdtemp makes it 0700, the top directory of the tarball is this one
+    os.chmod(staging, stat.S_IMODE(os.stat(root).st_mode))
+    try:
+        old_paths = set()
+        old_hashes = {}
+        patched = {}
+        for rel, kind, read in _old_entries(previous):
+            old_paths.add(rel)
+            if kind != "file":
+                continue
+            new = files.get(rel)
+            data = read()
+            sha = _sha256(data)
+            if sha in wanted:
+                # same path first, then whatever had that content
+                if new is not None and new[0] == sha or \
+                        sha not in old_hashes:
+                    old_hashes[sha] = rel
+            if bsdiff4 is None or new is None or new[0] == sha:
+                continue
+            with open(os.path.join(root, rel), "rb") as f:
+                patch = bsdiff4.diff(data, f.read())
+            if len(patch) < os.path.getsize(os.path.join(root, rel)):
+                path = os.path.join(staging, "patches", rel)
+                makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.write(patch)
+                patched[rel] = (rel, sha)
+
+        entries = []
+        counts = {"keep": 0, "patch": 0, "new": 0, "same": 0}
+        staged = {}
+        for rel in sorted(files):
+            sha, mode = files[rel]
+            entry = {"path": rel, "sha256": sha, "mode": mode}
+            if sha in old_hashes:
+                entry.update(op="keep", source=old_hashes[sha])
+                patch = os.path.join(staging, "patches", rel)
+                if os.path.exists(patch):
+                    remove(patch)
+            elif rel in patched:
+                entry.update(op="patch", source=patched[rel][0],
+                             source_sha256=patched[rel][1])
+            elif sha in staged:
+                entry.update(op="same", source=staged[sha])
+            else:
+                entry["op"] = "new"
+                staged[sha] = rel
+                path = os.path.join(staging, "files", rel)
+                makedirs(os.path.dirname(path))
+                try:
+                    os.link(os.path.join(root, rel), path)
+                except OSError:
+                    shutil.copyfile(os.path.join(root, rel), path)
+            counts[entry["op"]] += 1
+            entries.append(entry)
+
+        current = set(files) | set(links) | set(d for d, _ in dirs)
+        manifest = {
+            "version": DELTA_VERSION,
+            "from": os.path.basename(previous),
+            "to": os.path.basename(root),
+            "files": entries,
+            "links": sorted(links.items()),
+            "dirs": dirs,
+            "removed": sorted(old_paths - current),
+        }
+        with open(os.path.join(staging, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+        make_tarball(staging, dest, arcname="delta", fmt=fmt, jobs=jobs)
+    finally:
+        remove(staging)
+
+    print "Delta: {0} kept, {1} patched, {2} new, {3} duplicated, " \
+        "{4} removed".format(counts["keep"], counts["patch"], counts["new"],
+                             counts["same"], len(manifest["removed"]))
+    return dest
+
+
+def _write(dest, entry, data):
+    if _sha256(data) != entry["sha256"]:
+        raise ValueError("Checksum mismatch for " + entry["path"])
+    path = os.path.join(dest, entry["path"])
+    makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, entry["mode"])
+
+
+def apply_delta(old_root, delta, dest):
+    # what the updater does: builds the new bundle in dest from the
+    # extracted old one in old_root
+    makedirs(dest)
+    manifest = None
+    with open_tarball(delta) as tf:
+        for member in tf:
+            name = member.name.split("/", 1)[-1]
+            if name == MANIFEST:
+                manifest = json.load(tf.extractfile(member))
+                if manifest["version"] > DELTA_VERSION:
+                    raise ValueError("Unsupported delta version")
+                entries = dict((e["path"], e) for e in manifest["files"])
+                continue
+            if not member.isfile():
+                continue
+            if manifest is None:
+                raise ValueError("Delta without " + MANIFEST)
+            kind, rel = name.split("/", 1)
+            entry = entries[rel]
+            data = tf.extractfile(member).read()
+            if kind == "patches":
+                old = _reader(os.path.join(old_root, entry["source"]))()
+                data = bsdiff4.patch(old, data)
+            _write(dest, entry, data)
+
+    for entry in manifest["files"]:
+        if entry["op"] == "keep":
+            _write(dest, entry,
+                   _reader(os.path.join(old_root, entry["source"]))())
+    for entry in manifest["files"]:
+        if entry["op"] == "same":
+            source = os.path.join(dest, entry["source"])
+            path = os.path.join(dest, entry["path"])
+            makedirs(os.path.dirname(path))
+            if hasattr(os, "link") and \
+                    stat.S_IMODE(os.stat(source).st_mode) == entry["mode"]:
+                os.link(source, path)
+            else:
+                _write(dest, entry, _reader(source)())
+    for rel, target in manifest["links"]:
+        os.symlink(target, os.path.join(dest, rel))
+    for rel, mode in manifest["dirs"]:
+        makedirs(os.path.join(dest, rel))
+        os.chmod(os.path.join(dest, rel), mode)
@@ -1,44 +1,242 @@
 import sys
 import os
-import errno
+import fnmatch
+import hashlib
+import imp
+import json
 
-from distutils import dir_util, file_util
 from modulegraph import modulegraph
+from copier import CopyPlan
+from fsops import remove, walk
 from utils import IS_WIN
 
+# modules that are only imported dynamically, modulegraph can't see them
+HOOKS = [
+    "distutils",
+    "site",
+    "jsonschema",
+    "scrypt",
+    "_scrypt",
+    "ConfigParser",
+    "encodings.idna",
+    "leap.soledad.client",
+    "leap.mail",
+    "leap.keymanager",
+    "argparse",
+    "srp",
+    "pkgutil",
+    "pkg_resources",
+    "_sre",
+    "zope.proxy",
+    "tuf",
+    "timeit",
+]
 
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else: raise
-
-def collect_deps(root, dest_lib_dir, path_file):
-    mg = modulegraph.ModuleGraph([sys.path[0]] + [x.strip() for x in open(path_file, 'r').readlines()] + sys.path[1:])#, debug=3)
-
-    mg.import_hook("distutils")
-    mg.import_hook("site")
-    mg.import_hook("jsonschema")
-    mg.import_hook("scrypt")
-    mg.import_hook("_scrypt")
-    mg.import_hook("ConfigParser")
-    mg.import_hook("encodings.idna")
-    mg.import_hook("leap.soledad.client")
-    mg.import_hook("leap.mail")
-    mg.import_hook("leap.keymanager")
-    mg.import_hook("argparse")
-    mg.import_hook("srp")
-    mg.import_hook("pkgutil")
-    mg.import_hook("pkg_resources")
-    mg.import_hook("_sre")
-    mg.import_hook("zope.proxy")
-    mg.import_hook("tuf")
-    mg.import_hook("timeit")
+# bump when the format of the graph cache changes
+GRAPH_CACHE_VERSION = 1
+
+# modules that get imported by name at runtime, pruning never removes
+# them even if the module graph doesn't reach them
+KEEP_MODULES = [
+    "encodings.*",
+    "*.plugins.*",
+    "leap.*",
+    "jsonschema.*",
+    "distutils.command.*",
+    "email.*",
+    "xml.dom.*",
+]
+
+
+# Packages by dotted name. Finding the package a module belongs to only
+# looks at the module's own dotted prefixes, so it doesn't depend on how
+# many packages there are, and "leap.commonx" is never taken for a member
+# of "leap.common".
+class PackageIndex(object):
+    def __init__(self):
+        self._packages = {}
+
+    def add(self, pkg):
+        self._packages[pkg.identifier] = pkg
+
+    def owner(self, identifier):
+        parts = identifier.split(".")
+        for i in range(1, len(parts) + 1):
+            pkg = self._packages.get(".".join(parts[:i]))
+            if pkg is not None:
+                return pkg
+        return None
+
+    def __len__(self):
+        return len(self._packages)
+
+    def __iter__(self):
+        return iter(self._packages.values())
+
+
+def _file_hash(path):
+    m = hashlib.sha1()
+    with open(path, 'rb') as f:
+        m.update(f.read())
+    return m.hexdigest()
+
+
+def _graph_key(root, path):
+    return [GRAPH_CACHE_VERSION, sys.version, root, path, HOOKS]
+
+
+def save_graph(mg, cache_file, key):
+    nodes = []
+    edges = []
+    for node in mg.flatten():
+        if isinstance(node, (modulegraph.Script, modulegraph.AliasNode)):
+            continue
+        stamp = None
+        if node.filename is not None and os.path.isfile(node.filename):
+            st = os.stat(node.filename)
+            stamp = [st.st_size, st.st_mtime, _file_hash(node.filename)]
+        nodes.append({
+            "identifier": node.identifier,
+            "type": type(node).__name__,
+            "filename": node.filename,
+            "packagepath": node.packagepath,
+            "globalnames": sorted(node.globalnames),
+            "starimports": sorted(node.starimports),
+            "stamp": stamp,
+        })
+        for other in mg.get_edges(node)[0]:
+            if other is None or isinstance(other, modulegraph.Script):
+                continue
+            edges.append([node.identifier, other.identifier])
+
+    tmp = cache_file + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({"key": key, "nodes": nodes, "edges": edges}, f)
+    os.rename(tmp, cache_file)
+
+
+def _still_missing(ident, nodes, path):
+    parts = ident.split(".")
+    if len(parts) == 1:
+        try:
+            imp.find_module(ident, path)
+        except ImportError:
+            return True
+        return False
+    parent = nodes.get(".".join(parts[:-1]))
+    if parent is None or not parent["packagepath"]:
+        return True
+    names = [parts[-1] + suffix for suffix, _, _ in imp.get_suffixes()]
+    names.append(os.path.join(parts[-1], "__init__.py"))
+    for pkgdir in parent["packagepath"]:
+        for name in names:
+            if os.path.exists(os.path.join(pkgdir, name)):
+                return False
+    return True
+
+
+def _unchanged(info, nodes, path):
+    stamp = info["stamp"]
+    if info["type"] == "MissingModule":
+        # it might be installed by now
+        return _still_missing(info["identifier"], nodes, path)
+    if stamp is None:
+        return info["filename"] is None or \
+            not os.path.exists(info["filename"])
+    if not os.path.isfile(info["filename"]):
+        return False
+    st = os.stat(info["filename"])
+    if st.st_size != stamp[0]:
+        return False
+    if st.st_mtime == stamp[1]:
+        return True
+    return _file_hash(info["filename"]) == stamp[2]
+
+
+def restore_graph(mg, cache_file, key, path):
+    # Populates mg with the nodes from the cache whose files didn't change,
+    # modulegraph won't scan those again when something imports them.
+    # Returns the cached edges, to be restored with restore_edges once
+    # the changed modules got scanned.
+    if not os.path.isfile(cache_file):
+        return None
+    with open(cache_file) as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            return None
+    if data["key"] != json.loads(json.dumps(key)):
+        return None
+
+    nodes = dict((info["identifier"], info) for info in data["nodes"])
+    restored = set()
+    for info in data["nodes"]:
+        if not _unchanged(info, nodes, path):
+            continue
+        cls = getattr(modulegraph, info["type"], None)
+        if cls is None:
+            continue
+        node = cls(str(info["identifier"]))
+        node.filename = info["filename"]
+        node.packagepath = info["packagepath"]
+        node.globalnames = set(info["globalnames"])
+        node.starimports = set(info["starimports"])
+        mg.addNode(node)
+        restored.add(node.identifier)
+
+    for ident in restored:
+        if "." in ident:
+            parent, name = ident.rsplit(".", 1)
+            if parent in restored:
+                mg.findNode(parent)[name] = mg.findNode(ident)
+
+    print "Graph cache: {0} of {1} modules unchanged".format(
+        len(restored), len(data["nodes"]))
+    return [(src, dst) for src, dst in data["edges"] if src in restored]
+
+
+def restore_edges(mg, edges):
+    for src, dst in edges:
+        to = mg.findNode(dst)
+        if to is None:
+            # changed and not imported by anything scanned so far
+            try:
+                to = mg.import_hook(str(dst))[0]
+            except ImportError:
+                to = mg.createNode(modulegraph.MissingModule, str(dst))
+        mg.createReference(mg.findNode(src), to)
+
+
+def build_graph(root, path, graph_cache=None, save=True):
+    mg = modulegraph.ModuleGraph(path)#, debug=3)
+    key = _graph_key(root, path)
+
+    edges = None
+    if graph_cache is not None:
+        edges = restore_graph(mg, graph_cache, key, path)
+
+    for hook in HOOKS:
+        mg.import_hook(hook)
     mg.run_script(root)
 
-    packages = [mg.findNode(i) for i in ["leap.common", "leap.keymanager", "leap.mail", "leap.soledad.client", "leap.soledad.common", "jsonschema"]]
+    if edges is not None:
+        restore_edges(mg, edges)
+    if graph_cache is not None and save:
+        save_graph(mg, graph_cache, key)
+    return mg
+
+
+def collect_deps(root, dest_lib_dir, path_file, graph_cache=None,
+                 link=False, reachable_file=None, exclude=None,
+                 manifest=None):
+    path = [sys.path[0]] + [x.strip() for x in open(path_file, 'r').readlines()] + sys.path[1:]
+    # a dry run reads the graph cache but doesn't write it
+    mg = build_graph(root, path, graph_cache,
+                     save=manifest is None or not manifest.dry_run)
+
+    packages = PackageIndex()
+    for i in ["leap.common", "leap.keymanager", "leap.mail", "leap.soledad.client", "leap.soledad.common", "jsonschema"]:
+        packages.add(mg.findNode(i))
     other = []
 
     sorted_pkg = [(os.path.basename(mod.identifier), mod) for mod in mg.flatten()]
@@ -51,36 +249,21 @@ def collect_deps(root, dest_lib_dir, path_file):
         if isinstance(pkg, modulegraph.MissingModule):
             # print "ignoring", pkg.identifier
             continue
-        elif isinstance(pkg, modulegraph.Package):
-            foundpackage = False
-            for i in packages:
-                if pkg.identifier.startswith(i.identifier):
-                    # print "skipping", pkg.identifier, "member of", i.identifier
-                    # print "  found in", i.filename
-                    foundpackage = True
-                    break
-            if foundpackage:
-                continue
-            if pkg.filename is None:
-                continue
-            if pkg not in packages:
-                packages.append(pkg)
+        owner = packages.owner(pkg.identifier)
+        if owner is not None:
+            # print "skipping", pkg.identifier, "member of", owner.identifier
+            continue
+        if pkg.filename is None:
+            continue
+        if isinstance(pkg, modulegraph.Package):
+            packages.add(pkg)
         else: #if isinstance(pkg, modulegraph.Extension):
-            foundpackage = False
-            for i in packages:
-                if pkg.identifier.startswith(i.identifier):
-                    # print "skipping", pkg.identifier, "member of", i.identifier
-                    # print "  found in", i.filename
-                    foundpackage = True
-                    break
-            if foundpackage:
-                continue
-            if pkg.filename is None:
-                continue
             other.append(pkg)
             # print pkg.identifier
     #import pdb; pdb.set_trace()
 
+    plan = CopyPlan()
+    inits = []
     print "Packages", len(packages)
     for i in sorted(packages):
         # if i.identifier == "distutils":
@@ -90,21 +273,100 @@ def collect_deps(root, dest_lib_dir, path_file):
             continue
         parts = i.identifier.split(".")
         destdir = os.path.join(*([dest_lib_dir]+parts))
-        mkdir_p(destdir)
-        dir_util.copy_tree(os.path.dirname(i.filename), destdir)
+        plan.add_tree(os.path.dirname(i.filename), destdir)
         before = []
         for part in parts:
             before.append(part)
-            current = before + ["__init__.py"]
-            try:
-                with open(os.path.join(dest_lib_dir, *current), 'a'):
-                    pass
-            except Exception:
-                pass
+            inits.append(os.path.join(dest_lib_dir, *(before + ["__init__.py"])))
 
     print "Other", len(other)
     for i in sorted(other):
         # if i.identifier == "site":
         #     i.filename = site.__file__
         print i.identifier, i.filename
-        file_util.copy_file(i.filename, dest_lib_dir)
+        plan.add_into(i.filename, dest_lib_dir)
+
+    if exclude is not None:
+        plan.discard(exclude, dest_lib_dir)
+    print "Copying", len(plan), "files..."
+    plan.execute(link=link, manifest=manifest)
+    if manifest is not None and manifest.dry_run:
+        return
+
+    if reachable_file is not None:
+        # what prune_unreachable needs to know, the graph is gone by then
+        reachable = [m.identifier for m in mg.flatten()
+                     if not isinstance(m, modulegraph.MissingModule)]
+        copied = [p.identifier for p in packages
+                  if p.identifier != "leap.bitmask"]
+        with open(reachable_file, "w") as f:
+            json.dump({"modules": sorted(reachable),
+                       "packages": sorted(copied)}, f, indent=1)
+    for init in inits:
+        if manifest is not None and manifest.virtual:
+            if not manifest.exists(init):
+                manifest.add_bytes(init, "")
+            continue
+        try:
+            with open(init, 'a'):
+                pass
+        except Exception:
+            pass
+
+
+def _is_kept(name, reachable, keep):
+    return name in reachable or \
+        any(fnmatch.fnmatch(name, pattern) for pattern in keep)
+
+
+def prune_unreachable(lib_dir, reachable_file, keep=KEEP_MODULES, tree=None):
+    # removes the python modules of the copied packages that nothing
+    # imports, packages are copied whole otherwise. Works on the
+    # vtree.VirtualTree tree instead of the disk when given.
+    walk_, remove_, getsize, listdir, rmdir = \
+        walk, remove, os.path.getsize, os.listdir, os.rmdir
+    if tree is not None:
+        walk_, remove_, getsize, listdir, rmdir = \
+            tree.walk, tree.remove, tree.getsize, tree.listdir, tree.rmdir
+    with open(reachable_file) as f:
+        data = json.load(f)
+    reachable = set(data["modules"])
+    removed = 0
+    freed = 0
+    for package in data["packages"]:
+        pkg_dir = os.path.join(lib_dir, *package.split("."))
+        # directories where something was kept, their __init__ stays too
+        used = set()
+        for dirpath, dirnames, filenames in walk_(pkg_dir, topdown=False):
+            rel = os.path.relpath(dirpath, pkg_dir)
+            prefix = package if rel == "." else \
+                package + "." + rel.replace(os.sep, ".")
+            inits = []
+            for name in filenames:
+                base, ext = os.path.splitext(name)
+                if ext not in (".py", ".pyc", ".pyo"):
+                    used.add(dirpath)
+                    continue
+                if base == "__init__":
+                    inits.append(name)
+                    continue
+                if _is_kept(prefix + "." + base, reachable, keep):
+                    used.add(dirpath)
+                    continue
+                path = os.path.join(dirpath, name)
+                freed += getsize(path)
+                remove_(path)
+                removed += 1
+            if dirpath in used or _is_kept(prefix, reachable, keep):
+                used.add(os.path.dirname(dirpath))
+                continue
+            for name in inits:
+                path = os.path.join(dirpath, name)
+                freed += getsize(path)
+                remove_(path)
+                removed += 1
+            if not listdir(dirpath):
+                rmdir(dirpath)
+    print "Pruned {0} unreachable modules, {1} KiB".format(removed,
+                                                          freed // 1024)
+    return removed
@@ -0,0 +1,203 @@
+import fnmatch
+import os
+import struct
+
+from collections import namedtuple
+
+ELF_MAGIC = "\x7fELF"
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# libraries every linux desktop we support has, they never get bundled
+SYSTEM_LIBS = [
+    "ld-linux*.so.*",
+    "libc.so.*",
+    "libm.so.*",
+    "libdl.so.*",
+    "libpthread.so.*",
+    "librt.so.*",
+    "libutil.so.*",
+    "libresolv.so.*",
+    "libnsl.so.*",
+    "libcrypt.so.*",
+    "libgcc_s.so.*",
+    "libz.so.*",
+    "libexpat.so.*",
+    "libfreetype.so.*",
+    "libX*.so.*",
+    "libxcb*.so.*",
+    "libSM.so.*",
+    "libICE.so.*",
+    "libGL.so.*",
+    "libglib-2.0.so.*",
+    "libgobject-2.0.so.*",
+    "libgthread-2.0.so.*",
+]
+
+ElfInfo = namedtuple("ElfInfo", ["elfclass", "machine", "soname", "needed",
+                                 "rpath", "runpath"])
+
+
+class ElfError(Exception):
+    pass
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise ElfError("Truncated ELF file")
+    return data
+
+
+def _string(f, offset):
+    f.seek(offset)
+    chars = []
+    while True:
+        chunk = f.read(64)
+        if not chunk:
+            break
+        end = chunk.find("\0")
+        if end >= 0:
+            chars.append(chunk[:end])
+            break
+        chars.append(chunk)
+    return "".join(chars)
+
+
+def read_elf(path):
+    # Returns the dynamic section information of an ELF object, or None
+    # if path isn't one. Only the program headers are used, so this works
+    # on stripped files too.
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            return None
+        elfclass = ord(ident[4])
+        endian = {1: "<", 2: ">"}.get(ord(ident[5]))
+        if elfclass not in (1, 2) or endian is None:
+            raise ElfError("Unknown ELF class or data encoding")
+
+        if elfclass == 1:
+            header = struct.unpack(endian + "HHIIIIIHHHHHH",
+                                   _read(f, 16, 36))
+            phdr_fmt, dyn_fmt = endian + "IIIIIIII", endian + "iI"
+        else:
+            header = struct.unpack(endian + "HHIQQQIHHHHHH",
+                                   _read(f, 16, 48))
+            phdr_fmt, dyn_fmt = endian + "IIQQQQQQ", endian + "qQ"
+        machine, phoff = header[1], header[4]
+        phentsize, phnum = header[8], header[9]
+
+        loads = []
+        dynamic = None
+        for i in range(phnum):
+            ph = struct.unpack(phdr_fmt, _read(f, phoff + i * phentsize,
+                                               struct.calcsize(phdr_fmt)))
+            if elfclass == 1:
+                p_type, p_offset, p_vaddr, p_filesz = ph[0], ph[1], ph[2], \
+                    ph[4]
+            else:
+                p_type, p_offset, p_vaddr, p_filesz = ph[0], ph[2], ph[3], \
+                    ph[5]
+            if p_type == PT_LOAD:
+                loads.append((p_vaddr, p_offset, p_filesz))
+            elif p_type == PT_DYNAMIC:
+                dynamic = (p_offset, p_filesz)
+
+        if dynamic is None:
+            # statically linked
+            return ElfInfo(elfclass, machine, None, [], [], [])
+
+        entries = []
+        dyn_size = struct.calcsize(dyn_fmt)
+        offset, size = dynamic
+        for pos in range(offset, offset + size, dyn_size):
+            tag, val = struct.unpack(dyn_fmt, _read(f, pos, dyn_size))
+            if tag == DT_NULL:
+                break
+            entries.append((tag, val))
+
+        strtab = None
+        for tag, val in entries:
+            if tag == DT_STRTAB:
+                for vaddr, off, filesz in loads:
+                    if vaddr <= val < vaddr + filesz:
+                        strtab = val - vaddr + off
+                        break
+        if strtab is None:
+            raise ElfError("Can't locate the dynamic string table")
+
+        def strings(wanted):
+            return [_string(f, strtab + val) for tag, val in entries
+                    if tag == wanted]
+
+        soname = strings(DT_SONAME)
+        return ElfInfo(elfclass, machine,
+                       soname[0] if soname else None,
+                       strings(DT_NEEDED),
+                       [p for s in strings(DT_RPATH) for p in s.split(":")],
+                       [p for s in strings(DT_RUNPATH) for p in s.split(":")])
+
+
+def is_system_lib(name, allowlist=SYSTEM_LIBS):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in allowlist)
+
+
+def _expand_origin(path, origin):
+    return path.replace("$ORIGIN", origin).replace("${ORIGIN}", origin)
+
+
+def dependency_closure(roots, search_dirs, allowlist=SYSTEM_LIBS):
+    # Follows DT_NEEDED from roots. Returns the libraries found, by name,
+    # and the unresolved ones along with who needs them. Like ld.so,
+    # DT_RPATH is only honoured when there's no DT_RUNPATH.
+    found = {}
+    unresolved = {}
+    infos = {}
+    pending = list(roots)
+    while pending:
+        path = pending.pop()
+        if path in infos:
+            continue
+        try:
+            info = read_elf(path)
+        except (ElfError, IOError) as e:
+            print "WARNING: can't read", path, e
+            info = None
+        infos[path] = info
+        if info is None:
+            continue
+
+        origin = os.path.dirname(os.path.realpath(path))
+        dirs = info.runpath or info.rpath
+        dirs = [_expand_origin(d, origin) for d in dirs] + list(search_dirs)
+        for name in info.needed:
+            if name in found or is_system_lib(name, allowlist):
+                continue
+            for d in dirs:
+                candidate = os.path.join(d, name)
+                if not os.path.isfile(candidate):
+                    continue
+                try:
+                    other = read_elf(candidate)
+                except ElfError:
+                    continue
+                if other is None or other.elfclass != info.elfclass or \
+                        other.machine != info.machine:
+                    continue
+                found[name] = candidate
+                unresolved.pop(name, None)
+                pending.append(candidate)
+                break
+            else:
+                unresolved.setdefault(name, []).append(path)
+    return found, unresolved
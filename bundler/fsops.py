@@ -0,0 +1,79 @@
+import errno
+import fnmatch
+import os
+import shutil
+import stat
+
+# the scandir backport saves a stat per entry while walking
+try:
+    from scandir import walk
+except ImportError:
+    from os import walk
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def _make_writable(func, path, exc_info):
+    # read-only files (git objects on windows) can't be removed otherwise
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, onerror=_make_writable)
+    elif os.path.lexists(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            _make_writable(os.unlink, path, None)
+
+
+def rename(src, dst):
+    remove(dst)
+    os.rename(src, dst)
+
+
+def symlink(target, path):
+    remove(path)
+    os.symlink(target, path)
+
+
+def find(root, pattern=None, predicate=None, files_only=False):
+    found = []
+    for dirpath, dirnames, filenames in walk(root):
+        names = filenames if files_only else dirnames + filenames
+        for name in names:
+            if pattern is not None and not fnmatch.fnmatch(name, pattern):
+                continue
+            path = os.path.join(dirpath, name)
+            if predicate is not None and not predicate(path):
+                continue
+            found.append(path)
+    return found
+
+
+def remove_matching(root, predicate):
+    # like find | xargs rm -rf, matched directories aren't descended into
+    removed = 0
+    for dirpath, dirnames, filenames in walk(root):
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if predicate(path):
+                dirnames.remove(name)
+                remove(path)
+                removed += 1
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if predicate(path):
+                remove(path)
+                removed += 1
+    return removed
@@ -0,0 +1,171 @@
+import os
+import subprocess
+
+from fsops import makedirs, remove
+from utils import IS_WIN, parallel_map
+
+GIT = "git"
+if IS_WIN:
+    GIT = "C:\\Program Files\\Git\\bin\\git.exe"
+
+# repos that only have a master branch and no release tags
+MASTER_ONLY = ["leap_assets"]
+
+GITHUB = "git://github.com/leapcode"
+LEAP = "git://leap.se"
+
+# directories we delete from the bundle anyway, see RemoveUnused
+SPARSE_EXCLUDE = ["test/", "tests/", "docs/"]
+
+
+def git(cwd, *args):
+    return subprocess.check_output((GIT,) + args, cwd=cwd)
+
+
+def repo_url(repo, base=None):
+    # base replaces where all the repos come from, a directory of bare
+    # repos will do
+    if base is not None:
+        return "{0}/{1}".format(base.rstrip("/"), repo)
+    if repo == "leap_assets":
+        return "{0}/{1}".format(LEAP, repo)
+    return "{0}/{1}".format(GITHUB, repo)
+
+
+# The release built is the newest annotated tag in the history of master,
+# what `git describe --abbrev=0` finds there, for full clones and shallow
+# fetches alike. The tags map the commit they point to to their name.
+
+
+def local_tags(path):
+    tags = {}
+    out = git(path, "for-each-ref",
+              "--format=%(*objectname) %(refname:short)", "refs/tags")
+    for line in out.splitlines():
+        # lightweight tags have no object they point to
+        sha, _, tag = line.partition(" ")
+        if sha:
+            tags[sha] = tag
+    return tags
+
+
+def remote_tags(url):
+    tags = {}
+    for line in git(None, "ls-remote", "--tags", url).splitlines():
+        sha, ref = line.split()
+        if ref.endswith("^{}"):
+            tags[sha] = ref[len("refs/tags/"):-len("^{}")]
+    return tags
+
+
+def release_tag(path, tags):
+    # the first tagged commit going back from HEAD
+    for sha in git(path, "rev-list", "--topo-order", "HEAD").splitlines():
+        if sha in tags:
+            return tags[sha]
+    return None
+
+
+def _setup_sparse(path, exclude):
+    git(path, "config", "core.sparseCheckout", "true")
+    sparse_file = os.path.join(path, ".git", "info", "sparse-checkout")
+    makedirs(os.path.dirname(sparse_file))
+    with open(sparse_file, "w") as f:
+        f.write("/*\n")
+        for pattern in exclude:
+            f.write("!{0}\n".format(pattern))
+
+
+def update_mirror(cache, repo, url):
+    mirror = os.path.join(cache, repo + ".git")
+    if os.path.isdir(mirror):
+        print "Updating mirror of", repo
+        git(mirror, "remote", "set-url", "origin", url)
+        git(mirror, "fetch", "--quiet", "--prune", "origin")
+    else:
+        print "Creating mirror of", repo
+        makedirs(cache)
+        git(cache, "clone", "--quiet", "--mirror", url, repo + ".git")
+    return mirror
+
+
+def _full_clone(basedir, repo, url, nightly, sparse, reference=None):
+    path = os.path.join(basedir, repo)
+    if reference is None:
+        git(basedir, "clone", "--quiet", "--no-checkout", url, repo)
+    else:
+        # objects are borrowed from the mirror, nothing gets copied
+        git(basedir, "clone", "--quiet", "--no-checkout",
+            "--reference", reference, reference, repo)
+    if sparse:
+        _setup_sparse(path, SPARSE_EXCLUDE)
+
+    if repo in MASTER_ONLY:
+        git(path, "checkout", "--quiet", "-f", "master")
+    elif nightly:
+        git(path, "checkout", "--quiet", "-f", "develop")
+    else:
+        git(path, "checkout", "--quiet", "-f", "master")
+        tag = release_tag(path, local_tags(path))
+        if tag is not None:
+            git(path, "checkout", "--quiet", tag)
+
+
+def _shallow_fetch(basedir, repo, url, nightly, sparse, depth):
+    path = os.path.join(basedir, repo)
+    os.makedirs(path)
+    git(path, "init", "--quiet")
+    git(path, "remote", "add", "origin", url)
+    if sparse:
+        _setup_sparse(path, SPARSE_EXCLUDE)
+
+    branch = "master"
+    if nightly and repo not in MASTER_ONLY:
+        branch = "develop"
+    git(path, "fetch", "--quiet", "--depth", str(depth), "origin",
+        "+refs/heads/{0}:refs/remotes/origin/{0}".format(branch))
+    git(path, "checkout", "--quiet", "-B", branch,
+        "origin/{0}".format(branch))
+    if nightly or repo in MASTER_ONLY:
+        return
+
+    tags = remote_tags(url)
+    tag = release_tag(path, tags)
+    shallow = os.path.join(path, ".git", "shallow")
+    step = depth
+    # master gets deeper until the release tag is in the history fetched
+    while tag is None and tags and os.path.exists(shallow):
+        git(path, "fetch", "--quiet", "--deepen", str(step), "origin",
+            "+refs/heads/master:refs/remotes/origin/master")
+        step *= 2
+        tag = release_tag(path, tags)
+    if tag is not None:
+        git(path, "fetch", "--quiet", "origin",
+            "+refs/tags/{0}:refs/tags/{0}".format(tag))
+        git(path, "checkout", "--quiet", tag)
+
+
+def fetch_repo(basedir, repo, url, nightly, depth=None, sparse=False,
+               cache=None):
+    print "Cloning", repo
+    path = os.path.join(basedir, repo)
+    remove(path)
+    if cache is not None:
+        # with a local mirror history is free, so depth doesn't matter
+        mirror = update_mirror(cache, repo, url)
+        _full_clone(basedir, repo, url, nightly, sparse, reference=mirror)
+        git(path, "remote", "set-url", "origin", url)
+    elif depth is None:
+        _full_clone(basedir, repo, url, nightly, sparse)
+    else:
+        _shallow_fetch(basedir, repo, url, nightly, sparse, depth)
+    print "Done cloning", repo
+
+
+def fetch_all(basedir, repos, url_for, nightly, jobs=None, depth=None,
+              sparse=False, cache=None):
+    # repos are independent from each other, so fetch them all at once
+    def fetch(repo):
+        fetch_repo(basedir, repo, url_for(repo), nightly, depth, sparse,
+                   cache)
+    parallel_map(fetch, repos, jobs)
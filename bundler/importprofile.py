@@ -0,0 +1,268 @@
+import ast
+import json
+import os
+import subprocess
+import sys
+
+from distutils.spawn import find_executable
+
+from utils import IS_MAC, IS_WIN
+
+# Runs in a separate interpreter that only sees the staged bundle. Every
+# __import__ call is timed and its time charged to the modules it names
+# (the dotted name, its parents and the fromlist) that it loaded, split
+# evenly when there are several. Modules loaded some other way are listed
+# with no time. The filesystem cost can't be seen from python,
+# the import machinery is in C, so it's estimated as the directories
+# tried before the one holding the module, each of them being a stat plus
+# an open per suffix.
+TRACER = r"""
+# only builtin modules here, anything else would be imported from the
+# build interpreter and then missing from the profile
+import imp, sys, time
+import __builtin__
+try:
+    import posix as _fs
+except ImportError:
+    import nt as _fs
+
+args = eval(sys.argv[1], {"__builtins__": {}})
+sys.path[:] = args["path"]
+sep = "\\" if sys.platform == "win32" else "/"
+suffixes = len(imp.get_suffixes()) + 1
+
+events = []
+stack = []
+known = set(k for k, v in sys.modules.items() if v is not None)
+real_import = __builtin__.__import__
+
+
+def isdir(path):
+    try:
+        return _fs.stat(path).st_mode & 0170000 == 0040000
+    except OSError:
+        return False
+
+
+def probes(name):
+    module = sys.modules.get(name)
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        return 0
+    parent = sys.modules.get(name.rpartition(".")[0])
+    path = getattr(parent, "__path__", None) or sys.path
+    cost = 0
+    for entry in path:
+        if filename.startswith(entry.rstrip(sep) + sep):
+            return cost
+        if isdir(entry):
+            cost += suffixes
+    return cost
+
+
+def add_event(module, self_time, cumulative, depth):
+    known.add(module)
+    events.append({
+        "module": module,
+        "file": getattr(sys.modules[module], "__file__", None),
+        "self": self_time,
+        "cumulative": cumulative,
+        "fs_probes": probes(module),
+        "depth": depth,
+    })
+
+
+def package_of(globals, level):
+    # the package a relative import is relative to
+    if not globals or level == 0:
+        return None
+    package = globals.get("__package__")
+    if package is None:
+        package = globals.get("__name__")
+        if package is not None and "__path__" not in globals:
+            package = package.rpartition(".")[0]
+    if not package:
+        return None
+    if level > 1:
+        package = package.rsplit(".", level - 1)[0]
+    return package
+
+
+def named(full, fromlist):
+    parts = full.split(".")
+    names = [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    for item in fromlist or ():
+        if item != "*":
+            names.append(full + "." + item)
+    return names
+
+
+def candidates(name, package, fromlist, level):
+    # (module that has to be there, what the call names) for the ways it
+    # can resolve, relative first as python 2 tries it
+    head = name.split(".")[0]
+    found = []
+    if package is not None:
+        full = package + "." + name if name else package
+        found.append((package + "." + head if name else package,
+                      named(full, fromlist)))
+    if level <= 0:
+        found.append((head, named(name, fromlist)))
+    return found
+
+
+def traced_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    start = time.time()
+    package = package_of(globals, level)
+    options = candidates(name, package, fromlist, level)
+    # loaded or being loaded already, a nested call can't claim them
+    present = set(n for _, names in options for n in names
+                  if n in sys.modules)
+    stack.append(0.0)
+    try:
+        return real_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        for head, names in options:
+            if sys.modules.get(head) is None:
+                continue
+            loaded = [n for n in names if n not in present and
+                      n not in known and sys.modules.get(n) is not None]
+            for module in loaded:
+                add_event(module, (elapsed - children) / len(loaded),
+                          elapsed / len(loaded), len(stack))
+            break
+
+failures = []
+__builtin__.__import__ = traced_import
+start = time.time()
+for name in args["modules"]:
+    try:
+        __import__(name)
+    except BaseException as e:
+        failures.append({"module": name, "error": repr(e)})
+total = time.time() - start
+__builtin__.__import__ = real_import
+for module in sorted(k for k, v in sys.modules.items()
+                     if v is not None and k not in known):
+    add_event(module, 0.0, 0.0, None)
+
+f = open(args["output"], "w")
+f.write(repr({"total": total, "events": events, "failures": failures}))
+f.close()
+"""
+
+
+def _package_of(module, packages):
+    parts = module.split(".")
+    for i in range(len(parts), 0, -1):
+        if ".".join(parts[:i]) in packages:
+            return ".".join(parts[:i])
+    return parts[0]
+
+
+def _summarize(raw, reachable):
+    packages = {}
+    imported = set()
+    for event in raw["events"]:
+        imported.add(event["module"])
+        pkg = _package_of(event["module"], reachable["packages"])
+        stats = packages.setdefault(pkg, {"modules": 0, "self": 0.0,
+                                          "fs_probes": 0})
+        stats["modules"] += 1
+        stats["self"] += event["self"]
+        stats["fs_probes"] += event["fs_probes"]
+    not_imported = sorted(set(reachable["modules"]) - imported)
+    return {
+        "total": raw["total"],
+        "modules": sorted(raw["events"], key=lambda e: -e["cumulative"]),
+        "packages": packages,
+        "not_imported": not_imported,
+        "failures": raw["failures"],
+    }
+
+
+def _write_report(summary, path, top=50):
+    ms = lambda seconds: "{0:9.1f}".format(seconds * 1000)
+    with open(path, "w") as f:
+        f.write("Total import time: {0} ms, {1} modules\n\n".format(
+            ms(summary["total"]).strip(), len(summary["modules"])))
+
+        f.write("By package (self time)\n")
+        f.write("{0:>9} {1:>7} {2:>9}  {3}\n".format("ms", "modules",
+                                                    "probes", "package"))
+        by_self = sorted(summary["packages"].items(),
+                         key=lambda item: -item[1]["self"])
+        for name, stats in by_self:
+            f.write("{0} {1:7d} {2:9d}  {3}\n".format(
+                ms(stats["self"]), stats["modules"], stats["fs_probes"],
+                name))
+
+        f.write("\nTop {0} modules (cumulative time)\n".format(top))
+        f.write("{0:>9} {1:>9} {2:>6}  {3}\n".format("cumul ms", "self ms",
+                                                    "probes", "module"))
+        for event in summary["modules"][:top]:
+            f.write("{0} {1} {2:6d}  {3}\n".format(
+                ms(event["cumulative"]), ms(event["self"]),
+                event["fs_probes"], event["module"]))
+
+        f.write("\nBundled but not imported at startup: {0}\n".format(
+            len(summary["not_imported"])))
+        unused = {}
+        for module in summary["not_imported"]:
+            unused[module.split(".")[0]] = \
+                unused.get(module.split(".")[0], 0) + 1
+        for name, count in sorted(unused.items(),
+                                  key=lambda item: -item[1])[:top]:
+            f.write("{0:9d}  {1}\n".format(count, name))
+        for failure in summary["failures"]:
+            f.write("FAILED {0}: {1}\n".format(failure["module"],
+                                              failure["error"]))
+
+
+def _headless(command):
+    # the GUI isn't started, but importing Qt may look for a display.
+    # PySide is Qt4, which has no offscreen platform (QT_QPA_PLATFORM is
+    # Qt5's), so it gets a virtual X server when there's no display
+    if IS_MAC or IS_WIN or os.environ.get("DISPLAY"):
+        return command
+    if find_executable("xvfb-run") is not None:
+        return ["xvfb-run", "--auto-servernum"] + command
+    print "WARNING: no display and no xvfb-run, modules that need an X " \
+        "server to be imported will fail"
+    return command
+
+
+def profile_imports(search_path, modules, reachable_file, report,
+                    json_report, python=sys.executable, library_path=None):
+    # imports modules in a clean interpreter whose sys.path is
+    # search_path, -B so nothing gets written into the bundle, and whose
+    # shared libraries come from library_path first, like the launcher
+    # script of the bundle does
+    with open(reachable_file) as f:
+        reachable = json.load(f)
+    raw_path = json_report + ".raw"
+    env = dict(os.environ)
+    if library_path is not None:
+        var = "DYLD_LIBRARY_PATH" if IS_MAC else "LD_LIBRARY_PATH"
+        env[var] = os.pathsep.join([library_path] + filter(
+            None, [env.get(var)]))
+    args = {"path": search_path, "modules": modules, "output": raw_path}
+    subprocess.check_call(_headless([python, "-S", "-E", "-B", "-c", TRACER,
+                                     repr(args)]), env=env)
+    try:
+        with open(raw_path) as f:
+            raw = ast.literal_eval(f.read())
+    finally:
+        os.unlink(raw_path)
+
+    summary = _summarize(raw, reachable)
+    with open(json_report, "w") as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    _write_report(summary, report)
+    print "Imports took {0:.0f} ms, report in {1}".format(
+        summary["total"] * 1000, report)
+    return summary
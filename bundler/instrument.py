@@ -0,0 +1,176 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# What each action cost. Counters (files copied, subprocesses) are
+# charged to the action running in the current thread, parallel_map
+# passes it on to its workers. CPU time, peak RSS and I/O can only be
+# read for the whole process, so for actions that ran alongside others
+# they include the others' share too.
+
+_context = threading.local()
+_lock = threading.Lock()
+_records = []
+_counters = {}
+_installed = False
+
+
+def current():
+    return getattr(_context, "action", None)
+
+
+def set_current(name):
+    _context.action = name
+
+
+def count(counter, n=1):
+    name = current()
+    if name is None:
+        return
+    with _lock:
+        counters = _counters.setdefault(name, {})
+        counters[counter] = counters.get(counter, 0) + n
+
+
+def _io():
+    # bytes read and written by this process and the children it waited
+    # for, linux only
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes everywhere but on mac
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def install():
+    # counts every process spawned, sh and subprocess both fork on posix
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    if hasattr(os, "fork"):
+        real_fork = os.fork
+
+        def fork():
+            count("subprocesses")
+            return real_fork()
+        os.fork = fork
+    else:
+        real_init = subprocess.Popen.__init__
+
+        def init(self, *args, **kwargs):
+            count("subprocesses")
+            return real_init(self, *args, **kwargs)
+        subprocess.Popen.__init__ = init
+
+
+@contextmanager
+def measure(name):
+    previous = current()
+    set_current(name)
+    record = {"name": name, "status": "ok", "start": time.time()}
+    cpu, io = _cpu(), _io()
+    try:
+        yield record
+    except Exception:
+        record["status"] = "failed"
+        raise
+    finally:
+        set_current(previous)
+        record["wall"] = time.time() - record["start"]
+        record["cpu"] = _cpu() - cpu
+        record["peak_rss"] = _peak_rss()
+        end_io = _io()
+        if io is not None and end_io is not None:
+            record["read"] = end_io[0] - io[0]
+            record["written"] = end_io[1] - io[1]
+        with _lock:
+            record.update(_counters.pop(name, {}))
+            _records.append(record)
+
+
+def skipped(name):
+    with _lock:
+        _records.append({"name": name, "status": "skipped",
+                         "start": time.time(), "wall": 0.0})
+
+
+def records():
+    with _lock:
+        return sorted(_records, key=lambda r: r["start"])
+
+
+def write_trace(path):
+    # chrome://tracing and perfetto format, actions that overlap in time
+    # go in different rows
+    events = []
+    lanes = []
+    for record in records():
+        start, end = record["start"], record["start"] + record["wall"]
+        for lane, busy_until in enumerate(lanes):
+            if busy_until <= start:
+                break
+        else:
+            lane = len(lanes)
+            lanes.append(0)
+        lanes[lane] = end
+        args = dict((k, v) for k, v in record.items()
+                    if k not in ("name", "start", "wall"))
+        events.append({"name": record["name"], "ph": "X", "pid": 1,
+                       "tid": lane, "ts": int(start * 1e6),
+                       "dur": int(record["wall"] * 1e6), "args": args})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f,
+                  indent=1)
+
+
+def _mb(value):
+    if value is None:
+        return "-"
+    return "{0:.1f}".format(value / (1024.0 * 1024.0))
+
+
+def print_summary():
+    rows = records()
+    if not rows:
+        return
+    print
+    print "{0:<15} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9} {6:>7} {7:>6}  " \
+        "{8}".format("action", "wall s", "cpu s", "rss MB", "read MB",
+                     "write MB", "copied", "procs", "status")
+    for r in rows:
+        print "{0:<15} {1:8.1f} {2:>8} {3:>9} {4:>9} {5:>9} {6:>7} " \
+            "{7:>6}  {8}".format(
+                r["name"], r["wall"],
+                "-" if "cpu" not in r else "{0:.1f}".format(r["cpu"]),
+                _mb(r.get("peak_rss")), _mb(r.get("read")),
+                _mb(r.get("written")), r.get("files_copied", 0),
+                r.get("subprocesses", 0), r["status"])
+    start = rows[0]["start"]
+    end = max(r["start"] + r["wall"] for r in rows)
+    print "Total {0:.1f}s".format(end - start)
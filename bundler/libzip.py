@@ -0,0 +1,181 @@
+import ast
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import tokenize
+import zipfile
+
+from multiprocessing import cpu_count
+
+from fsops import makedirs, remove, walk
+from utils import parallel_map
+
+LIBRARY_ZIP = "library.zip"
+
+# Have to stay on disk: what the interpreter imports before launcher.py
+# can add the zip to sys.path, namespace packages spread over several
+# directories, and packages that find their own files through __file__.
+ON_DISK = [
+    "__future__", "site", "sitecustomize", "usercustomize", "os",
+    "posixpath", "ntpath", "genericpath", "stat", "warnings", "linecache",
+    "types", "UserDict", "_abcoll", "abc", "_weakrefset", "copy_reg",
+    "traceback", "sysconfig", "_sysconfigdata", "codecs", "encodings",
+    "re", "sre_compile", "sre_parse", "sre_constants",
+    "leap", "zope", "google", "pkg_resources", "setuptools", "distutils",
+]
+
+# Compiled with -O, run in a separate interpreter since python 2 can only
+# produce optimized bytecode when started optimized
+COMPILER = """
+import json, py_compile, sys
+failed = []
+for src, dst, name in json.load(sys.stdin):
+    try:
+        py_compile.compile(src, dst, name, doraise=True)
+    except py_compile.PyCompileError:
+        failed.append(src)
+json.dump(failed, sys.stdout)
+"""
+
+BOOTSTRAP = """\
+# added by the bundler, the pure python modules are in lib/{0}
+import os as _os, sys as _sys
+_sys.path.insert(0, _os.path.join(_os.path.dirname(
+    _os.path.abspath(__file__)), _os.pardir, "lib", "{0}"))
+"""
+
+
+def _pure_python(path):
+    for dirpath, dirnames, filenames in walk(path):
+        for name in filenames:
+            if os.path.splitext(name)[1] not in (".py", ".pyc", ".pyo"):
+                return False
+    return True
+
+
+def zippable(lib_dir):
+    # top level modules and packages of lib_dir that can be imported
+    # from a zip, with their .py files
+    found = []
+    for name in sorted(os.listdir(lib_dir)):
+        path = os.path.join(lib_dir, name)
+        module, ext = os.path.splitext(name)
+        if os.path.isfile(path) and ext == ".py" and module not in ON_DISK:
+            found.append((path, [path]))
+        elif os.path.isdir(path) and name not in ON_DISK and \
+                os.path.isfile(os.path.join(path, "__init__.py")) and \
+                _pure_python(path):
+            sources = []
+            for dirpath, dirnames, filenames in walk(path):
+                dirnames.sort()
+                sources.extend(os.path.join(dirpath, f)
+                               for f in sorted(filenames)
+                               if f.endswith(".py"))
+            found.append((path, sources))
+    return found
+
+
+def _compile(batch):
+    proc = subprocess.Popen([sys.executable, "-O", "-c", COMPILER],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(json.dumps(batch))[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, sys.executable)
+    return json.loads(out)
+
+
+def make_library(lib_dir, jobs=None):
+    # Moves the zippable modules of lib_dir into lib_dir/library.zip as
+    # optimized bytecode. It's stored with the .pyc suffix, which is the
+    # one zipimport looks for unless the interpreter runs with -O.
+    found = zippable(lib_dir)
+    build_dir = tempfile.mkdtemp(prefix="bundler-libzip-")
+    try:
+        items = []
+        for _, sources in found:
+            for src in sources:
+                rel = os.path.relpath(src, lib_dir)
+                items.append([src, os.path.join(build_dir, rel + "c"),
+                              rel.replace(os.sep, "/")])
+        for item in items:
+            makedirs(os.path.dirname(item[1]))
+
+        jobs = jobs or cpu_count()
+        batches = [items[i::jobs] for i in range(jobs)]
+        failed = set()
+        for result in parallel_map(_compile, [b for b in batches if b],
+                                   jobs):
+            failed.update(result)
+
+        zip_path = os.path.join(lib_dir, LIBRARY_ZIP)
+        zf = zipfile.ZipFile(zip_path + ".tmp", "w", zipfile.ZIP_DEFLATED)
+        moved = 0
+        for path, sources in found:
+            if any(src in failed for src in sources):
+                print "WARNING: left on disk, doesn't compile:", path
+                continue
+            for src in sources:
+                rel = os.path.relpath(src, lib_dir)
+                # constant dates, so the zip only changes with its contents
+                info = zipfile.ZipInfo(rel.replace(os.sep, "/") + "c",
+                                       (1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0644 << 16
+                with open(os.path.join(build_dir, rel + "c"), "rb") as f:
+                    zf.writestr(info, f.read())
+            remove(path)
+            moved += 1
+        zf.close()
+        os.rename(zip_path + ".tmp", zip_path)
+    finally:
+        remove(build_dir)
+    print "Moved {0} modules and packages into {1}".format(moved,
+                                                           LIBRARY_ZIP)
+    return zip_path
+
+
+def _header_end(source):
+    # the line after the docstring and the __future__ imports, which have
+    # to stay first, or after the shebang and coding lines without them
+    last = None
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ImportFrom) and node.module == "__future__":
+            last = node
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Str) \
+                and last is None:
+            last = node
+        else:
+            break
+    if last is None:
+        lines = source.splitlines(True)
+        at = 0
+        while at < len(lines) and lines[at].startswith("#"):
+            at += 1
+        return at
+    # the statement may go on for several lines, it ends at its NEWLINE
+    readline = iter(source.splitlines(True)).next
+    for token in tokenize.generate_tokens(readline):
+        if token[0] == tokenize.NEWLINE and token[2][0] >= last.lineno:
+            return token[2][0]
+    return len(source.splitlines())
+
+
+def add_bootstrap(launcher_py):
+    # launcher.py comes from bitmask_launcher, the copy in the bundle gets
+    # the zip added to sys.path right after its __future__ imports
+    with open(launcher_py) as f:
+        lines = f.readlines()
+    bootstrap = BOOTSTRAP.format(LIBRARY_ZIP)
+    if bootstrap in "".join(lines):
+        return
+    lines.insert(_header_end("".join(lines)), bootstrap)
+    # replaced instead of rewritten, with --hardlink the staged file is
+    # the one in the bitmask_launcher checkout
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(launcher_py))
+    with os.fdopen(fd, "w") as f:
+        f.writelines(lines)
+    shutil.copystat(launcher_py, tmp)
+    os.rename(tmp, launcher_py)
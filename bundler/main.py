@@ -14,8 +14,14 @@ from actions import GitCloneAll, PythonSetupAll, CreateDirStructure
 from actions import CollectAllDeps, CopyBinaries, PLister, SeededConfig
 from actions import DarwinLauncher, CopyAssets, CopyMisc, FixDylibs
 from actions import DmgIt, PycRemover, TarballIt, MtEmAll, ZipIt, SignIt
-from actions import RemoveUnused
+from actions import RemoveUnused, CopyLibraries, PruneModules, ZipLibrary
+from actions import ImportProfile, Deduplicate
+from copier import CopyManifest
+from vtree import VirtualTree
+from scheduler import Scheduler
+from stagecache import StageCache
 
+import instrument
 from utils import IS_MAC, IS_WIN
 
 sorted_repos = [
@@ -28,6 +34,10 @@ sorted_repos = [
     "bitmask_launcher",
 ]
 
+# what a dry run goes through, the actions that put files in the bundle
+# before anything else modifies them
+COPY_ACTIONS = ["collectdeps", "copybinaries", "copyassets", "copymisc"]
+
 
 @contextmanager
 def new_build_dir(default=None):
@@ -50,6 +60,93 @@ def main():
     parser.add_argument('--seeded-config', help="")
     parser.add_argument('--nightly', action="store_true", help="")
     parser.add_argument('--codesign', default="", help="")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Number of actions to run concurrently, "
+                        "defaults to the number of CPUs")
+    parser.add_argument('--git-jobs', type=int, default=None,
+                        help="Number of repositories to fetch concurrently")
+    parser.add_argument('--shallow', type=int, default=None, metavar="DEPTH",
+                        help="Only fetch the needed ref, DEPTH commits deep")
+    parser.add_argument('--sparse', action="store_true",
+                        help="Don't check out tests and docs")
+    parser.add_argument('--git-base', metavar="URL",
+                        help="Fetch every repository from URL/<repo> "
+                        "instead of github and leap.se, a directory of bare "
+                        "repositories works too")
+    parser.add_argument('--git-cache',
+                        help="Directory holding persistent mirrors of the "
+                        "repositories, updated incrementally on every run")
+    parser.add_argument('--wheelhouse',
+                        help="Directory where the requirements of the repos "
+                        "are built into wheels once and installed offline "
+                        "from, repos set up before with the same "
+                        "requirements and setup.py are skipped")
+    parser.add_argument('--package-index',
+                        help="Directory of sdists and wheels the wheelhouse "
+                        "is built from instead of PyPI")
+    parser.add_argument('--hardlink', action="store_true",
+                        help="Hardlink files into the bundle instead of "
+                        "copying them when possible, binaries that get "
+                        "stripped are always copied")
+    parser.add_argument('--graph-cache',
+                        help="File where the module graph is kept between "
+                        "runs, only changed modules get scanned again")
+    parser.add_argument('--strip-cache',
+                        help="Directory where stripped binaries are kept, "
+                        "keyed by the hash of the unstripped file")
+    parser.add_argument('--debug-symbols',
+                        help="Split the debug info of the stripped ELF "
+                        "objects into this .tar.bz2")
+    parser.add_argument('--elf-closure', action="store_true",
+                        help="Only bundle the libraries from the binaries "
+                        "path that something in the bundle links to "
+                        "(linux)")
+    parser.add_argument('--compression', default="bz2",
+                        choices=["bz2", "xz", "zstd"],
+                        help="Compression of the linux tarball, xz and zstd "
+                        "need their python modules")
+    parser.add_argument('--formats', nargs="*", default=[],
+                        choices=["bz2", "xz", "zstd", "zip"],
+                        help="Other formats to write the linux or windows "
+                        "bundle in, all of them from a single read of the "
+                        "tree")
+    parser.add_argument('--previous-bundle',
+                        help="Last released tarball (or its extracted "
+                        "directory), a delta from it is written next to "
+                        "the linux tarball for the updater")
+    parser.add_argument('--prune', action="store_true",
+                        help="Remove the modules of the collected packages "
+                        "that app.py doesn't import")
+    parser.add_argument('--zip-lib', action="store_true",
+                        help="Put the pure python modules in lib/ into a "
+                        "zip of optimized bytecode that launcher.py imports "
+                        "from")
+    parser.add_argument('--profile-imports', action="store_true",
+                        help="Time the imports of app.py in the staged "
+                        "bundle, writes import-profile.txt and .json. "
+                        "Without a display it runs under xvfb-run when "
+                        "there is one, Qt4 has no offscreen mode")
+    parser.add_argument('--dedup', action="store_true",
+                        help="Hardlink identical files of the bundle, they "
+                        "are stored once in the tarball (linux)")
+    parser.add_argument('--trace',
+                        help="Write a timeline of the actions to this file, "
+                        "in chrome://tracing format")
+    parser.add_argument('--virtual-staging', action="store_true",
+                        help="Don't copy the bundle into Bitmask/, the "
+                        "tarball is written straight from the files it "
+                        "comes from (linux)")
+    parser.add_argument('--dry-run', action="store_true",
+                        help="Only plan what gets copied into the bundle "
+                        "and report it, nothing is downloaded or written "
+                        "to the bundle and the caches")
+    parser.add_argument('--copy-manifest',
+                        help="Write every file copied into the bundle, "
+                        "with its source, size and hash, to this JSON file")
+    parser.add_argument('--stage-cache',
+                        help="Directory where the results of actions are "
+                        "cached and restored from when their inputs "
+                        "didn't change")
 
     args = parser.parse_args()
 
@@ -61,73 +158,155 @@ def main():
     assert args.binaries is not None, \
         "We don't support building from source, so you'll need to " \
         "specify a binaries path"
+
+    assert not args.virtual_staging or not (IS_MAC or IS_WIN), \
+        "Virtual staging is only for the linux tarball"
+    assert not args.virtual_staging or not (
+        args.elf_closure or args.zip_lib or args.profile_imports or
+        args.dedup or args.previous_bundle or args.debug_symbols or
+        args.dry_run), \
+        "--elf-closure, --zip-lib, --profile-imports, --dedup, " \
+        "--previous-bundle, --debug-symbols and --dry-run need the bundle " \
+        "on disk, they can't go with --virtual-staging"
+
+    do = args.do
+    if args.dry_run:
+        # an empty do list means everything to the actions
+        do = [name for name in (args.do or COPY_ACTIONS)
+              if name in COPY_ACTIONS]
+        assert do, "--dry-run only plans the copies, --do has to include " \
+            "one of " + ", ".join(COPY_ACTIONS)
+
     binaries_path = os.path.realpath(args.binaries)
 
+    graph_cache = None
+    if args.graph_cache is not None:
+        graph_cache = os.path.realpath(args.graph_cache)
+
+    strip_cache = None
+    if args.strip_cache is not None:
+        strip_cache = os.path.realpath(args.strip_cache)
+
+    debug_symbols = None
+    if args.debug_symbols is not None:
+        debug_symbols = os.path.realpath(args.debug_symbols)
+
+    git_cache = None
+    if args.git_cache is not None:
+        git_cache = os.path.realpath(args.git_cache)
+
+    previous_bundle = None
+    if args.previous_bundle is not None:
+        previous_bundle = os.path.realpath(args.previous_bundle)
+
+    wheelhouse = None
+    if args.wheelhouse is not None:
+        wheelhouse = os.path.realpath(args.wheelhouse)
+
+    package_index = None
+    if args.package_index is not None:
+        package_index = os.path.realpath(args.package_index)
+
     seeded_config = None
     if args.seeded_config is not None:
         seeded_config = os.path.realpath(args.seeded_config)
 
+    copy_manifest = None
+    if args.copy_manifest is not None:
+        copy_manifest = os.path.realpath(args.copy_manifest)
+
     with new_build_dir(os.path.realpath(args.workon)) as bd:
         print "Doing it all in", bd
 
-        def init(t, bd=bd):
-            return t(bd, args.skip, args.do)
-
-        gc = init(GitCloneAll)
-        gc.run(sorted_repos, args.nightly)
+        stage_cache = None
+        if args.stage_cache is not None and not args.dry_run and \
+                not args.virtual_staging:
+            stage_cache = StageCache(os.path.realpath(args.stage_cache))
+        if args.virtual_staging:
+            manifest = VirtualTree(bd)
+        else:
+            # hashes are only taken when they get reported
+            manifest = CopyManifest(bd, args.dry_run, digests=(
+                args.dry_run or copy_manifest is not None))
 
-        ps = init(PythonSetupAll)
-        ps.run(sorted_repos, binaries_path)
+        def init(t, bd=bd):
+            action = t(bd, args.skip, do)
+            if stage_cache is not None:
+                action.use_cache(stage_cache)
+            action.use_manifest(manifest)
+            return action
 
-        cd = init(CreateDirStructure, os.path.join(bd, "Bitmask"))
-        cd.run()
+        sched = Scheduler(args.jobs)
 
-        dp = init(CollectAllDeps)
-        dp.run(paths_file)
+        sched.add(init(GitCloneAll), sorted_repos, args.nightly,
+                  jobs=args.git_jobs, depth=args.shallow, sparse=args.sparse,
+                  cache=git_cache, base=args.git_base)
+        sched.add(init(PythonSetupAll), sorted_repos, binaries_path,
+                  wheelhouse, package_index, args.jobs)
+        sched.add(init(CreateDirStructure, os.path.join(bd, "Bitmask")))
+        sched.add(init(CollectAllDeps), paths_file, graph_cache,
+                  args.hardlink)
 
         if binaries_path is not None:
-            cb = init(CopyBinaries)
-            cb.run(binaries_path)
+            closure = args.elf_closure and not (IS_MAC or IS_WIN)
+            sched.add(init(CopyBinaries), binaries_path, args.hardlink,
+                      closure)
+            if closure:
+                sched.add(init(CopyLibraries), binaries_path,
+                          link=args.hardlink)
 
         if IS_MAC:
-            pl = init(PLister)
-            pl.run()
-            dl = init(DarwinLauncher)
-            dl.run()
-            ca = init(CopyAssets)
-            ca.run()
-            fd = init(FixDylibs)
-            fd.run()
+            sched.add(init(PLister))
+            sched.add(init(DarwinLauncher))
+            sched.add(init(CopyAssets))
+            sched.add(init(FixDylibs), args.jobs)
+
+        sched.add(init(CopyMisc), binaries_path, args.hardlink)
+        sched.add(init(PycRemover), strip_cache, debug_symbols, args.jobs)
 
-        cm = init(CopyMisc)
-        cm.run(binaries_path)
+        if args.prune:
+            sched.add(init(PruneModules))
 
-        pyc = init(PycRemover)
-        pyc.run()
+        if args.zip_lib:
+            sched.add(init(ZipLibrary), args.jobs)
+
+        if args.profile_imports:
+            sched.add(init(ImportProfile))
 
         if IS_WIN:
-            mt = init(MtEmAll)
-            mt.run()
+            sched.add(init(MtEmAll))
 
         if IS_MAC:
-            si = init(SignIt)
-            si.run(args.codesign)
+            sched.add(init(SignIt), args.codesign)
 
         if seeded_config is not None:
-            sc = init(SeededConfig)
-            sc.run(seeded_config)
+            sched.add(init(SeededConfig), seeded_config)
 
         if IS_MAC:
-            dm = init(DmgIt)
-            dm.run(sorted_repos, args.nightly)
+            sched.add(init(DmgIt), sorted_repos, args.nightly)
         elif IS_WIN:
-            zi = init(ZipIt)
-            zi.run(sorted_repos, args.nightly)
+            sched.add(init(ZipIt), sorted_repos, args.nightly,
+                      args.jobs, args.formats)
         else:
-            ru = init(RemoveUnused)
-            ru.run()
-            ti = init(TarballIt)
-            ti.run(sorted_repos, args.nightly)
+            sched.add(init(RemoveUnused))
+            if args.dedup:
+                sched.add(init(Deduplicate), args.jobs)
+            sched.add(init(TarballIt), sorted_repos, args.nightly,
+                      args.compression, args.jobs, previous_bundle,
+                      args.formats)
+
+        instrument.install()
+        try:
+            sched.run()
+        finally:
+            instrument.print_summary()
+            if args.trace is not None:
+                instrument.write_trace(args.trace)
+            manifest.print_summary()
+            if copy_manifest is not None:
+                manifest.write(copy_manifest)
+            if args.virtual_staging:
+                manifest.close()
 
         # do manifest on windows
 
@@ -0,0 +1,98 @@
+import sys
+import threading
+import traceback
+
+from multiprocessing import cpu_count
+
+
+class ActionFailed(Exception):
+    pass
+
+
+# Runs actions on a pool of worker threads respecting the dependencies
+# each action declares in its `depends` attribute. Dependencies on actions
+# that were never added (e.g. platform specific ones) are ignored. Actions
+# flagged as `exclusive` change process wide state (the working directory,
+# sys.path, os.environ) so they never run alongside any other action.
+class Scheduler(object):
+    def __init__(self, jobs=None):
+        if jobs is None or jobs < 1:
+            jobs = cpu_count()
+        self._jobs = jobs
+        self._tasks = []
+        self._names = set()
+
+    def add(self, action, *args, **kwargs):
+        assert action.name not in self._names, \
+            "Action {0} added twice".format(action.name)
+        self._names.add(action.name)
+        self._tasks.append((action, args, kwargs))
+
+    def _deps(self, action):
+        return set([d for d in action.depends if d in self._names])
+
+    def run(self):
+        cond = threading.Condition()
+        pending = list(self._tasks)
+        done = set()
+        running = set()
+        errors = []
+
+        def can_start(action):
+            if not self._deps(action).issubset(done):
+                return False
+            if len(running) >= self._jobs:
+                return False
+            if action.exclusive:
+                return len(running) == 0
+            return not any(r.exclusive for r in running)
+
+        def worker(action, args, kwargs):
+            try:
+                action.run(*args, **kwargs)
+            except Exception:
+                errors.append((action.name, sys.exc_info()))
+            with cond:
+                running.discard(action)
+                done.add(action.name)
+                cond.notify_all()
+
+        with cond:
+            while pending or running:
+                if errors:
+                    # don't start anything new, wait for the rest to finish
+                    pending = []
+                    if not running:
+                        break
+                    cond.wait()
+                    continue
+
+                started = False
+                for task in list(pending):
+                    action, args, kwargs = task
+                    if can_start(action):
+                        pending.remove(task)
+                        running.add(action)
+                        t = threading.Thread(target=worker,
+                                             name=action.name,
+                                             args=(action, args, kwargs))
+                        t.daemon = True
+                        t.start()
+                        started = True
+                        if action.exclusive:
+                            break
+
+                if not started:
+                    if not running:
+                        names = [a.name for a, _, _ in pending]
+                        raise ActionFailed(
+                            "Unsatisfiable dependencies for: {0}".format(
+                                ", ".join(names)))
+                    cond.wait()
+
+        if errors:
+            for name, exc_info in errors:
+                print "ERROR in", name
+                traceback.print_exception(*exc_info)
+            name, exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,281 @@
+import ast
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+
+from fsops import makedirs, remove, walk
+from gitfetch import git
+
+# Actions restored from this cache produce exactly the same files they
+# would have produced running again. Whether that holds is decided by a
+# fingerprint each cacheable action computes from its inputs plus the
+# fingerprints of the actions it depends on. What an action did is
+# recorded as the difference between its output directories before and
+# after running, with file contents stored by their sha256.
+
+CHUNK = 1024 * 1024
+
+
+def hash_file(path):
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+def _snapshot(roots, basedir):
+    state = {}
+    for root in roots:
+        if not os.path.lexists(root):
+            continue
+        if not os.path.isdir(root) or os.path.islink(root):
+            st = os.lstat(root)
+            state[os.path.relpath(root, basedir)] = \
+                (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+            continue
+        for dirpath, dirnames, filenames in walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                state[os.path.relpath(path, basedir)] = \
+                    (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+    return state
+
+
+# calls that import what they're given
+DYNAMIC_IMPORTS = ["__import__", "import_module", "load_module",
+                   "load_source"]
+
+
+def _imports(node):
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    if not isinstance(node, ast.Call):
+        return False
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id in DYNAMIC_IMPORTS
+    return getattr(func, "attr", None) in DYNAMIC_IMPORTS
+
+
+class Fingerprint(object):
+    def __init__(self, cache):
+        self._cache = cache
+        self._m = hashlib.sha256()
+
+    def update_value(self, *values):
+        for value in values:
+            # json doesn't tell str from unicode, repr does
+            self._m.update(json.dumps(value, sort_keys=True))
+            self._m.update("\0")
+
+    def update_file(self, path):
+        self.update_value(os.path.basename(path))
+        if os.path.isfile(path):
+            self.update_value(self._cache.file_hash(path))
+        else:
+            self.update_value(None)
+
+    def update_tree(self, root, predicate=None):
+        for dirpath, dirnames, filenames in walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if predicate is not None and not predicate(path):
+                    continue
+                self.update_value(os.path.relpath(path, root))
+                if os.path.islink(path):
+                    self.update_value(os.readlink(path))
+                else:
+                    self.update_value(os.stat(path).st_mode,
+                                      self._cache.file_hash(path))
+
+    def update_repo(self, path):
+        self.update_value(os.path.basename(path))
+        self.update_value(git(path, "rev-parse", "HEAD").strip())
+
+    def update_imports(self, root):
+        # only what a module imports matters for dependency collection,
+        # wherever the import is in it. A module that doesn't parse counts
+        # as a whole.
+        for dirpath, dirnames, filenames in walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if not name.endswith(".py"):
+                    continue
+                path = os.path.join(dirpath, name)
+                self.update_value(os.path.relpath(path, root))
+                with open(path) as f:
+                    source = f.read()
+                try:
+                    tree = ast.parse(source, path)
+                except SyntaxError:
+                    self.update_value(source)
+                    continue
+                for node in ast.walk(tree):
+                    if _imports(node):
+                        self.update_value(ast.dump(node))
+
+    def hexdigest(self):
+        return self._m.hexdigest()
+
+
+class StageCache(object):
+    def __init__(self, cache_dir):
+        self._dir = cache_dir
+        self._objects = os.path.join(cache_dir, "objects")
+        self._stages = os.path.join(cache_dir, "stages")
+        self._memo_path = os.path.join(cache_dir, "hashes.json")
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        self._skipped = set()
+        self._memo = {}
+        if os.path.isfile(self._memo_path):
+            with open(self._memo_path) as f:
+                self._memo = json.load(f)
+
+    def file_hash(self, path):
+        # hashing the same unchanged file on every run is wasteful, so
+        # hashes are remembered by path, size and mtime
+        st = os.stat(path)
+        path = os.path.realpath(path)
+        with self._lock:
+            known = self._memo.get(path)
+        if known is not None and known[0] == st.st_size and \
+                known[1] == st.st_mtime:
+            return known[2]
+        digest = hash_file(path)
+        with self._lock:
+            self._memo[path] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def _save_memo(self):
+        with self._lock:
+            data = json.dumps(self._memo)
+        tmp = self._memo_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.rename(tmp, self._memo_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    def _store_object(self, path):
+        digest = self.file_hash(path)
+        dest = self._object_path(digest)
+        if not os.path.exists(dest):
+            makedirs(os.path.dirname(dest))
+            tmp = dest + ".tmp"
+            shutil.copyfile(path, tmp)
+            os.rename(tmp, dest)
+        return digest
+
+    def _entry_path(self, name, fingerprint):
+        return os.path.join(self._stages, name, fingerprint + ".json")
+
+    def mark_skipped(self, action):
+        # we don't know what a skipped action left behind, so nothing
+        # depending on it can be trusted to the cache
+        if action.cacheable:
+            self._skipped.add(action.name)
+
+    def fingerprint(self, action, args, kwargs):
+        if any(dep in self._skipped for dep in action.depends):
+            return None
+        fp = Fingerprint(self)
+        fp.update_value(action.name, args, sorted(kwargs.items()))
+        for dep in sorted(action.depends):
+            fp.update_value(dep, self._fingerprints.get(dep))
+        if action.cacheable:
+            action.fingerprint(fp, *args, **kwargs)
+        return fp.hexdigest()
+
+    def restore(self, action, fingerprint):
+        entry_path = self._entry_path(action.name, fingerprint)
+        if not os.path.isfile(entry_path):
+            return False
+        with open(entry_path) as f:
+            entry = json.load(f)
+        for digest, _, _ in entry["files"]:
+            if not os.path.isfile(self._object_path(digest)):
+                return False
+
+        basedir = action.basedir
+        for rel in entry["removed"]:
+            remove(os.path.join(basedir, rel))
+        for rel, mode in entry["dirs"]:
+            path = os.path.join(basedir, rel)
+            makedirs(path)
+            os.chmod(path, mode)
+        for rel, target in entry["links"]:
+            path = os.path.join(basedir, rel)
+            remove(path)
+            os.symlink(target, path)
+        for digest, rel, mode in entry["files"]:
+            path = os.path.join(basedir, rel)
+            remove(path)
+            makedirs(os.path.dirname(path))
+            # never hardlink, later actions modify files in place
+            shutil.copyfile(self._object_path(digest), path)
+            os.chmod(path, mode)
+        return True
+
+    def record(self, action, fingerprint, before, after):
+        basedir = action.basedir
+        entry = {"files": [], "links": [], "dirs": [], "removed": []}
+        for rel in sorted(set(before) - set(after)):
+            entry["removed"].append(rel)
+        for rel in sorted(after):
+            if before.get(rel) == after[rel]:
+                continue
+            mode = after[rel][0]
+            path = os.path.join(basedir, rel)
+            if stat.S_ISLNK(mode):
+                entry["links"].append([rel, os.readlink(path)])
+            elif stat.S_ISDIR(mode):
+                entry["dirs"].append([rel, stat.S_IMODE(mode)])
+            elif stat.S_ISREG(mode):
+                entry["files"].append([self._store_object(path), rel,
+                                       stat.S_IMODE(mode)])
+
+        entry_path = self._entry_path(action.name, fingerprint)
+        makedirs(os.path.dirname(entry_path))
+        tmp = entry_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.rename(tmp, entry_path)
+        self._save_memo()
+
+    def run(self, action, func, args, kwargs):
+        fingerprint = self.fingerprint(action, args, kwargs)
+        if fingerprint is None:
+            print "Not caching", action.name, "(depends on skipped action)"
+            self._skipped.add(action.name)
+            return func(action, *args, **kwargs)
+
+        if not action.cacheable:
+            # still runs every time, but what it was given is remembered
+            # for the fingerprints of the actions depending on it
+            result = func(action, *args, **kwargs)
+            self._fingerprints[action.name] = fingerprint
+            return result
+
+        if self.restore(action, fingerprint):
+            print "Restored", action.name, "from cache", fingerprint[:12]
+            self._fingerprints[action.name] = fingerprint
+            return
+
+        roots = action.outputs(*args, **kwargs)
+        before = _snapshot(roots, action.basedir)
+        result = func(action, *args, **kwargs)
+        self.record(action, fingerprint, before,
+                    _snapshot(roots, action.basedir))
+        self._fingerprints[action.name] = fingerprint
+        return result
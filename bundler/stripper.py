@@ -0,0 +1,199 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from fsops import makedirs, remove
+from utils import IS_MAC, parallel_map
+
+STRIP = "strip"
+OBJCOPY = "objcopy"
+
+ELF_MAGIC = "\x7fELF"
+MACHO_MAGICS = [
+    "\xfe\xed\xfa\xce", "\xce\xfa\xed\xfe",
+    "\xfe\xed\xfa\xcf", "\xcf\xfa\xed\xfe",
+    "\xca\xfe\xba\xbe",
+]
+
+# bump when the way files get stripped changes, invalidates the cache
+STRIP_VERSION = 1
+
+
+def tools_version():
+    # what strips the files, for the stage cache
+    versions = [STRIP_VERSION]
+    for tool in (STRIP, OBJCOPY):
+        try:
+            versions.append(subprocess.check_output(
+                [tool, "--version"], stderr=subprocess.STDOUT))
+        except (OSError, subprocess.CalledProcessError):
+            versions.append(None)
+    return versions
+
+
+def is_elf(path):
+    with open(path, "rb") as f:
+        return f.read(4) == ELF_MAGIC
+
+
+def strippable(path):
+    if os.path.islink(path) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if IS_MAC:
+        return magic in MACHO_MAGICS
+    return magic == ELF_MAGIC
+
+
+def _run(*args):
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args[0], out)
+
+
+def _hash(path):
+    m = hashlib.sha256()
+    m.update(str(STRIP_VERSION))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def strip_file(path, debug_path=None):
+    if debug_path is not None and is_elf(path):
+        _run(OBJCOPY, "--only-keep-debug", path, debug_path)
+        _run(STRIP, path)
+        _run(OBJCOPY, "--add-gnu-debuglink=" + debug_path, path)
+    else:
+        _run(STRIP, path)
+
+
+# Stripped outputs keyed by the hash of what went in, so libraries that
+# didn't change between builds (Qt, PySide, boost...) aren't stripped again
+class StripCache(object):
+    def __init__(self, cache_dir):
+        self._dir = cache_dir
+        makedirs(cache_dir)
+
+    def _paths(self, key, split):
+        base = os.path.join(self._dir, key[:2], key[2:])
+        if split:
+            base += ".split"
+        return base, base + ".debug"
+
+    def lookup(self, key, split):
+        stripped, debug = self._paths(key, split)
+        if not os.path.isfile(stripped):
+            return None
+        if split and not os.path.isfile(debug):
+            return None
+        return stripped, debug
+
+    def store(self, key, split, path, debug_path):
+        stripped, debug = self._paths(key, split)
+        makedirs(os.path.dirname(stripped))
+        if split and debug_path is not None and os.path.isfile(debug_path):
+            shutil.copyfile(debug_path, debug + ".tmp")
+            os.rename(debug + ".tmp", debug)
+        shutil.copyfile(path, stripped + ".tmp")
+        os.rename(stripped + ".tmp", stripped)
+
+
+def _restore(src, dst):
+    mode = os.stat(dst).st_mode
+    remove(dst)
+    shutil.copyfile(src, dst)
+    os.chmod(dst, mode)
+
+
+def strip_copies(files, out_dir, cache_dir=None, jobs=None):
+    # strips files into out_dir without touching them, returns where the
+    # stripped version of each one is, cached ones are used where they are
+    cache = None
+    if cache_dir is not None:
+        cache = StripCache(cache_dir)
+
+    def do_strip(item):
+        i, path = item
+        key = None
+        if cache is not None:
+            key = _hash(path)
+            found = cache.lookup(key, False)
+            if found is not None:
+                return found[0], "cached"
+        out = os.path.join(out_dir, "stripped-{0}".format(i))
+        try:
+            _run(STRIP, "-o", out, path)
+        except subprocess.CalledProcessError as e:
+            print "ERROR stripping", path
+            print e.output
+            return path, "failed"
+        if cache is not None:
+            cache.store(key, False, out, None)
+        return out, "stripped"
+
+    results = parallel_map(do_strip, list(enumerate(files)), jobs)
+    statuses = [status for _, status in results]
+    print "Stripped {0}, from cache {1}, failed {2}".format(
+        statuses.count("stripped"), statuses.count("cached"),
+        statuses.count("failed"))
+    return dict(zip(files, [path for path, _ in results]))
+
+
+def strip_all(root, files, cache_dir=None, debug_archive=None, jobs=None):
+    # files get stripped in place, the debug info of each one goes into
+    # debug_archive (a .tar.bz2) under its path relative to root
+    cache = None
+    if cache_dir is not None:
+        cache = StripCache(cache_dir)
+    split = debug_archive is not None
+    debug_dir = None
+    if split:
+        debug_dir = tempfile.mkdtemp(prefix="bundler-debug-")
+
+    def do_strip(path):
+        debug_path = None
+        if split and is_elf(path):
+            debug_path = os.path.join(debug_dir,
+                                      os.path.relpath(path, root) + ".debug")
+            makedirs(os.path.dirname(debug_path))
+
+        key = None
+        if cache is not None:
+            key = _hash(path)
+            found = cache.lookup(key, debug_path is not None)
+            if found is not None:
+                _restore(found[0], path)
+                if debug_path is not None:
+                    shutil.copyfile(found[1], debug_path)
+                return "cached"
+
+        try:
+            strip_file(path, debug_path)
+        except subprocess.CalledProcessError as e:
+            print "ERROR stripping", path
+            print e.output
+            return "failed"
+        if cache is not None:
+            cache.store(key, debug_path is not None, path, debug_path)
+        return "stripped"
+
+    try:
+        results = parallel_map(do_strip, files, jobs)
+        if split:
+            with tarfile.open(debug_archive, "w:bz2") as tf:
+                tf.add(debug_dir, arcname=".")
+    finally:
+        if debug_dir is not None:
+            remove(debug_dir)
+
+    print "Stripped {0}, from cache {1}, failed {2}".format(
+        results.count("stripped"), results.count("cached"),
+        results.count("failed"))
@@ -1,4 +1,31 @@
 import sys
 
+import instrument
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
 IS_MAC = sys.platform == "darwin"
 IS_WIN = sys.platform == "win32"
+
+
+def parallel_map(func, items, jobs=None):
+    items = list(items)
+    if jobs is None or jobs < 1:
+        jobs = cpu_count()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return map(func, items)
+    action = instrument.current()
+
+    def run(item):
+        # so that what the workers do is charged to the caller's action
+        instrument.set_current(action)
+        return func(item)
+
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(run, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
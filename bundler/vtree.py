@@ -0,0 +1,196 @@
+import errno
+import fnmatch
+import json
+import os
+import tempfile
+import threading
+
+from fsops import remove
+
+# The bundle as a mapping from destination to the file on disk holding its
+# contents, instead of a Bitmask/ directory of copies. The copy actions
+# record their plans into it, the actions that modify the bundle (pyc
+# removal, stripping, rmunused, pruning) work on the mapping, and the
+# archive is written straight from the sources. Symlinks and generated
+# files (launcher.conf, missing __init__.py) are the only things written,
+# into a scratch directory, with the stripped binaries.
+
+
+class VirtualTree(object):
+    virtual = True
+    dry_run = False
+
+    def __init__(self, basedir):
+        self._basedir = os.path.normpath(basedir)
+        self.scratch = tempfile.mkdtemp(prefix=".virtual-", dir=basedir)
+        # what the directories of the archive get their mode and date from
+        self._dir_source = os.path.join(self.scratch, "dir")
+        os.mkdir(self._dir_source)
+        os.chmod(self._dir_source, 0755)
+        self._lock = threading.RLock()
+        self._count = 0
+        self._files = {}
+        # every directory, recorded or implied by what's in it, to the
+        # names it holds
+        self._children = {}
+
+    def close(self):
+        remove(self.scratch)
+
+    def _new_scratch(self):
+        with self._lock:
+            self._count += 1
+            return os.path.join(self.scratch, str(self._count))
+
+    def _attach(self, path):
+        while path.startswith(self._basedir + os.sep):
+            parent, name = os.path.split(path)
+            names = self._children.get(parent)
+            if names is not None:
+                names.add(name)
+                return
+            self._children[parent] = set([name])
+            path = parent
+
+    def add_file(self, dst, src):
+        dst = os.path.normpath(dst)
+        with self._lock:
+            self._files[dst] = src
+            self._attach(dst)
+
+    def add_dir(self, dst):
+        dst = os.path.normpath(dst)
+        with self._lock:
+            self._children.setdefault(dst, set())
+            self._attach(dst)
+
+    def add_bytes(self, dst, data, mode=0644):
+        path = self._new_scratch()
+        with open(path, "wb") as f:
+            f.write(data)
+        os.chmod(path, mode)
+        self.add_file(dst, path)
+
+    def add_link(self, dst, target):
+        path = self._new_scratch()
+        os.symlink(target, path)
+        self.add_file(dst, path)
+
+    def record(self, files, links, replaced, jobs=None, dirs=()):
+        # CopyPlan.execute, nothing gets copied
+        for d in dirs:
+            self.add_dir(d)
+        for dst, target in links:
+            self.add_link(dst, target)
+        # the copies are regular files wherever the source is a symlink,
+        # only the links of the plan are archived as symlinks
+        for dst, src in files:
+            self.add_file(dst, os.path.realpath(src))
+        return []
+
+    def source(self, path):
+        return self._files.get(path)
+
+    def set_source(self, path, src):
+        with self._lock:
+            self._files[path] = src
+
+    def isdir(self, path):
+        return path in self._children
+
+    def exists(self, path):
+        return path in self._files or path in self._children
+
+    def getsize(self, path):
+        return os.path.getsize(self._files[path])
+
+    def listdir(self, path):
+        with self._lock:
+            if path not in self._children:
+                raise OSError(errno.ENOENT, "No such directory", path)
+            return sorted(self._children[path])
+
+    def remove(self, path):
+        with self._lock:
+            for name in self._children.pop(path, ()):
+                self.remove(os.path.join(path, name))
+            self._files.pop(path, None)
+            parent, name = os.path.split(path)
+            self._children.get(parent, set()).discard(name)
+
+    def rmdir(self, path):
+        if self.listdir(path):
+            raise OSError(errno.ENOTEMPTY, "Directory not empty", path)
+        self.remove(path)
+
+    def walk(self, top, topdown=True):
+        # os.walk, sorted
+        if not self.isdir(top):
+            return
+        names = self.listdir(top)
+        dirnames = [n for n in names if self.isdir(os.path.join(top, n))]
+        filenames = [n for n in names if n not in dirnames]
+        if topdown:
+            yield top, dirnames, filenames
+        for name in dirnames:
+            for entry in self.walk(os.path.join(top, name), topdown):
+                yield entry
+        if not topdown:
+            yield top, dirnames, filenames
+
+    def find(self, root, pattern=None, predicate=None):
+        # files only, predicate gets the file with the contents
+        found = []
+        for dirpath, dirnames, filenames in self.walk(root):
+            for name in filenames:
+                if pattern is not None and not fnmatch.fnmatch(name, pattern):
+                    continue
+                path = os.path.join(dirpath, name)
+                if predicate is not None and \
+                        not predicate(self._files[path]):
+                    continue
+                found.append(path)
+        return found
+
+    def remove_matching(self, root, predicate):
+        # fsops.remove_matching
+        removed = 0
+        for dirpath, dirnames, filenames in self.walk(root):
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                if predicate(path):
+                    dirnames.remove(name)
+                    self.remove(path)
+                    removed += 1
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if predicate(path):
+                    self.remove(path)
+                    removed += 1
+        return removed
+
+    def listing(self, root):
+        # (file on disk, path relative to root) in archiver.tree_entries
+        # order, for make_archives
+        entries = [(self._dir_source, ".")]
+        for dirpath, dirnames, filenames in self.walk(root):
+            for name in sorted(dirnames + filenames):
+                path = os.path.join(dirpath, name)
+                entries.append((self._files.get(path, self._dir_source),
+                                os.path.relpath(path, root)))
+        return entries
+
+    def print_summary(self):
+        with self._lock:
+            sources = self._files.values()
+        size = sum(os.path.getsize(s) for s in sources
+                   if not os.path.islink(s))
+        print "Virtual bundle: {0} files, {1:.1f} MB read from where " \
+            "they are".format(len(sources), size / (1024.0 * 1024.0))
+
+    def write(self, path):
+        with self._lock:
+            files = dict((os.path.relpath(dst, self._basedir), src)
+                         for dst, src in self._files.items())
+        with open(path, "w") as f:
+            json.dump({"files": files}, f, indent=1, sort_keys=True)
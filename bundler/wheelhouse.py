@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fsops import makedirs, remove
+from stagecache import hash_file
+
+# Wheels for the requirements of the repos, built once and installed
+# offline from then on. wheels/ holds all of them, built/<hash> lists the
+# ones a requirements file with that hash needs. snapshots.json records
+# what every repo was set up from and the `pip freeze` of the environment
+# afterwards, a repo whose requirements and setup.py didn't change since
+# doesn't need setting up again while the environment stays the same.
+
+
+def _hash_files(paths):
+    m = hashlib.sha256()
+    for path in paths:
+        m.update(path)
+        if os.path.exists(path):
+            m.update(hash_file(path))
+    return m.hexdigest()
+
+
+class Wheelhouse(object):
+    def __init__(self, path, index=None, pip="pip"):
+        self._path = path
+        self._wheels = os.path.join(path, "wheels")
+        self._built = os.path.join(path, "built")
+        self._snapshots = os.path.join(path, "snapshots.json")
+        # a directory of sdists and wheels used instead of PyPI
+        self._index = index
+        self._pip = pip
+        makedirs(self._wheels)
+        makedirs(self._built)
+
+    def _built_list(self, requirements):
+        return os.path.join(self._built, hash_file(requirements))
+
+    def _wheels_for(self, requirements):
+        # the wheels built for requirements, None if some are missing
+        try:
+            with open(self._built_list(requirements)) as f:
+                names = json.load(f)
+        except (IOError, ValueError):
+            return None
+        paths = [os.path.join(self._wheels, name) for name in names]
+        if not all(os.path.exists(p) for p in paths):
+            return None
+        return paths
+
+    def build(self, requirements):
+        # wheels for requirements and everything they need, the ones in
+        # the wheelhouse already are reused. Returns whether pip ran.
+        if self._wheels_for(requirements) is not None:
+            return False
+        tmp = tempfile.mkdtemp(prefix="build-", dir=self._path)
+        try:
+            args = [self._pip, "wheel", "--wheel-dir", tmp,
+                    "--find-links", self._wheels, "-r", requirements]
+            if self._index is not None:
+                args += ["--no-index", "--find-links", self._index]
+            # relative paths in requirements files are relative to the repo
+            subprocess.check_call(args, cwd=os.path.dirname(
+                os.path.dirname(requirements)))
+            names = sorted(os.listdir(tmp))
+            for name in names:
+                os.rename(os.path.join(tmp, name),
+                          os.path.join(self._wheels, name))
+        finally:
+            remove(tmp)
+        with open(self._built_list(requirements), "w") as f:
+            json.dump(names, f)
+        return True
+
+    def batches(self, requirements):
+        # requirements files in groups that can be installed at the same
+        # time, those of a group share no wheel
+        groups = []
+        for req in requirements:
+            names = set(os.path.basename(w) for w in self._wheels_for(req))
+            for group, used in groups:
+                if not used & names:
+                    group.append(req)
+                    used.update(names)
+                    break
+            else:
+                groups.append(([req], names))
+        return [group for group, _ in groups]
+
+    def install(self, requirements):
+        wheels = self._wheels_for(requirements)
+        if wheels is None:
+            raise ValueError("No wheels built for " + requirements)
+        if wheels:
+            subprocess.check_call([self._pip, "install", "--no-index",
+                                   "--find-links", self._wheels] + wheels)
+
+    def environment(self):
+        # the editables are the repos themselves, set up by `setup.py
+        # develop`, they change with every commit and are keyed apart
+        out = subprocess.check_output([self._pip, "freeze"])
+        m = hashlib.sha256(sys.version)
+        for line in out.splitlines():
+            if not line.startswith(("-e ", "#")):
+                m.update(line + "\n")
+        return m.hexdigest()
+
+    def _load(self):
+        try:
+            with open(self._snapshots) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"environment": None, "repos": {}}
+
+    def repo_key(self, repo_dir):
+        return _hash_files([
+            os.path.join(repo_dir, "pkg", "requirements.pip"),
+            os.path.join(repo_dir, "setup.py"),
+        ])
+
+    def unchanged(self, repo_dir, environment):
+        snapshots = self._load()
+        return snapshots["environment"] == environment and \
+            snapshots["repos"].get(repo_dir) == self.repo_key(repo_dir)
+
+    def save(self, repo_dirs, environment):
+        snapshots = self._load()
+        snapshots["environment"] = environment
+        for repo_dir in repo_dirs:
+            snapshots["repos"][repo_dir] = self.repo_key(repo_dir)
+        with open(self._snapshots + ".tmp", "w") as f:
+            json.dump(snapshots, f, indent=1, sort_keys=True)
+        shutil.move(self._snapshots + ".tmp", self._snapshots)
@@ -0,0 +1,113 @@
+# Writes the Mach-O fixtures of test_darwin_dyliber.py, the load commands
+# laid out as ld64 does but with no code or symbols:
+#
+#   python make_fixtures.py
+import os
+import struct
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+LC_REQ_DYLD = 0x80000000
+LC_UUID = 0x1b
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+
+MH_DYLIB = 6
+MH_EXECUTE = 2
+CPU_X86_64 = 0x01000007
+CPU_I386 = 7
+CPU_PPC = 18
+
+
+def _padded(data, align):
+    return data + "\0" * (-len(data) % align)
+
+
+def _string_command(endian, cmd, fixed, string, align):
+    # fixed: the fields after cmd, cmdsize and the string offset
+    head = 12 + len(fixed)
+    body = string + "\0"
+    body += "\0" * (-(head + len(body)) % align)
+    return struct.pack(endian + "III", cmd, head + len(body), head) + \
+        fixed + body
+
+
+def dylib_command(endian, cmd, name, align):
+    fixed = struct.pack(endian + "III", 2, 0x10000, 0x10000)
+    return _string_command(endian, cmd, fixed, name, align)
+
+
+def macho(endian, is_64, cputype, filetype, install_name=None, dylibs=(),
+          weak=(), rpaths=()):
+    align = 8 if is_64 else 4
+    commands = [struct.pack(endian + "II", LC_UUID, 24) + "\x11" * 16]
+    if install_name is not None:
+        commands.append(dylib_command(endian, LC_ID_DYLIB, install_name,
+                                      align))
+    for name in dylibs:
+        commands.append(dylib_command(endian, LC_LOAD_DYLIB, name, align))
+    for name in weak:
+        commands.append(dylib_command(endian, LC_LOAD_WEAK_DYLIB, name,
+                                      align))
+    for path in rpaths:
+        commands.append(_string_command(endian, LC_RPATH, "", path, align))
+    sizeofcmds = sum(len(c) for c in commands)
+    magic = 0xfeedfacf if is_64 else 0xfeedface
+    header = struct.pack(endian + "IiiIIII", magic, cputype, 3, filetype,
+                         len(commands), sizeofcmds, 0)
+    if is_64:
+        header += struct.pack(endian + "I", 0)
+    return header + "".join(commands)
+
+
+def fat(slices):
+    # 32 bit fat header, slices aligned to 4096 as lipo does
+    header = struct.pack(">II", 0xcafebabe, len(slices))
+    offset = 4096
+    archs = []
+    body = ""
+    for cputype, data in slices:
+        archs.append(struct.pack(">iiIII", cputype, 3, offset, len(data),
+                                 12))
+        body += _padded(data, 4096)
+        offset += len(_padded(data, 4096))
+    return _padded(header + "".join(archs), 4096) + body
+
+
+def fixtures():
+    lib = macho("<", True, CPU_X86_64, MH_DYLIB,
+                install_name="/usr/local/lib/libfoo.1.dylib",
+                dylibs=["/usr/local/lib/libbar.dylib",
+                        "/usr/lib/libSystem.B.dylib"],
+                weak=["@rpath/libweak.dylib"],
+                rpaths=["@loader_path/../lib"])
+    exe = macho(">", False, CPU_PPC, MH_EXECUTE,
+                dylibs=["/usr/local/lib/libfoo.1.dylib",
+                        "/System/Library/Frameworks/Carbon.framework/Carbon"])
+    universal = fat([
+        (CPU_I386, macho("<", False, CPU_I386, MH_DYLIB,
+                         install_name="libuni.dylib",
+                         dylibs=["/opt/lib/libbar.dylib"])),
+        (CPU_X86_64, macho("<", True, CPU_X86_64, MH_DYLIB,
+                           install_name="libuni.dylib",
+                           dylibs=["/opt/lib/libbar.dylib",
+                                   "/opt/lib/libonly64.dylib"],
+                           weak=["/opt/lib/libweak.dylib"])),
+    ])
+    # java class files start with the fat magic, then their version
+    java = struct.pack(">IHH", 0xcafebabe, 0, 50) + "\0" * 16
+    return {
+        "libfoo.1.dylib": lib,
+        "ppc_executable": exe,
+        "libuni.dylib": universal,
+        "Example.class": java,
+        "libtruncated.dylib": lib[:len(lib) - 20],
+    }
+
+
+if __name__ == "__main__":
+    for name, data in sorted(fixtures().items()):
+        with open(os.path.join(HERE, name), "wb") as f:
+            f.write(data)
@@ -0,0 +1,159 @@
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+import archiver
+
+from archiver import SAMPLE_SIZE, make_archives, worth_deflating
+from vtree import VirtualTree
+
+FILES = {
+    "app.py": "print 'hello'\n",
+    "lib/libfoo.so.1": "\x7fELF" + "\0" * 4096,
+    "lib/PySide/__init__.py": "",
+}
+# relative, up a directory, a chain of them and absolute
+LINKS = {
+    "lib/libfoo.so": "libfoo.so.1",
+    "bin/foo": "../lib/libfoo.so",
+    "lib/python": "/usr/bin/env",
+}
+DIRS = ["bin", "lib", "lib/PySide"]
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, 0644)
+
+
+def tar_members(path):
+    with tarfile.open(path) as tf:
+        return sorted((m.name, m.type, m.linkname, m.mode,
+                       tf.extractfile(m).read() if m.isreg() else None)
+                      for m in tf.getmembers())
+
+
+def zip_members(path):
+    with zipfile.ZipFile(path) as zf:
+        return sorted((i.filename, i.external_attr >> 16, zf.read(i))
+                      for i in zf.infolist())
+
+
+class VirtualArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-archiver-")
+        os.chmod(self.tmp, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def archives(self, name):
+        return [(os.path.join(self.tmp, name + ".tar.bz2"), "bz2"),
+                (os.path.join(self.tmp, name + ".zip"), "zip")]
+
+    def build_on_disk(self):
+        root = os.path.join(self.tmp, "disk", "Bitmask")
+        for d in DIRS:
+            os.makedirs(os.path.join(root, d))
+            os.chmod(os.path.join(root, d), 0755)
+        os.chmod(root, 0755)
+        for rel, data in FILES.items():
+            write(os.path.join(root, rel), data)
+        for rel, target in LINKS.items():
+            os.symlink(target, os.path.join(root, rel))
+        return make_archives(root, self.archives("disk"), "Bitmask")
+
+    def build_virtual(self):
+        basedir = os.path.join(self.tmp, "virtual")
+        os.makedirs(basedir)
+        root = os.path.join(basedir, "Bitmask")
+        # the sources are somewhere else and named otherwise
+        files = []
+        for i, (rel, data) in enumerate(sorted(FILES.items())):
+            src = os.path.join(self.tmp, "sources", str(i))
+            write(src, data)
+            files.append((os.path.join(root, rel), src))
+        tree = VirtualTree(basedir)
+        try:
+            tree.record(files,
+                        [(os.path.join(root, rel), target)
+                         for rel, target in LINKS.items()],
+                        [], dirs=[os.path.join(root, d) for d in DIRS])
+            return make_archives(root, self.archives("virtual"), "Bitmask",
+                                 listing=tree.listing(root))
+        finally:
+            tree.close()
+
+    def test_same_as_on_disk(self):
+        disk_tar, disk_zip = self.build_on_disk()
+        virtual_tar, virtual_zip = self.build_virtual()
+        self.assertEqual(tar_members(virtual_tar), tar_members(disk_tar))
+        self.assertEqual(zip_members(virtual_zip), zip_members(disk_zip))
+
+    def test_zip_follows_links(self):
+        virtual_zip = self.build_virtual()[1]
+        members = dict((name, data)
+                       for name, _, data in zip_members(virtual_zip))
+        for rel in ["lib/libfoo.so", "bin/foo"]:
+            self.assertEqual(members["Bitmask/" + rel],
+                             FILES["lib/libfoo.so.1"])
+        self.assertTrue("Bitmask/lib/python" in members)
+
+
+def noise(size, seed=0):
+    rng = random.Random(seed)
+    return "".join(chr(rng.randint(0, 255)) for _ in xrange(size))
+
+
+class DeflateTest(unittest.TestCase):
+    def test_sampled_all_over(self):
+        text = "def function(value):\n    return value\n" * 20000
+        # incompressible head, text after it
+        self.assertTrue(worth_deflating("lib.so", noise(SAMPLE_SIZE) + text))
+        self.assertTrue(worth_deflating("lib.so", text + noise(SAMPLE_SIZE)))
+        self.assertFalse(worth_deflating("lib.so", noise(4 * SAMPLE_SIZE)))
+
+    def test_small_and_compressed(self):
+        self.assertTrue(worth_deflating("a.py", noise(1024)))
+        self.assertFalse(worth_deflating("a.png", "x" * 1024))
+        self.assertFalse(worth_deflating("a", "PK\x03\x04" + "x" * 1024))
+
+    def test_zip_through_writestr(self):
+        tmp = tempfile.mkdtemp(prefix="test-archiver-")
+        try:
+            root = os.path.join(tmp, "Bitmask")
+            write(os.path.join(root, "text.py"), "x = 1\n" * 10000)
+            write(os.path.join(root, "noise.so"), noise(2 * SAMPLE_SIZE))
+            zips = []
+            for precompressed in [True, False]:
+                archiver.PRECOMPRESSED = precompressed
+                dest = os.path.join(tmp, "{0}.zip".format(precompressed))
+                zips.append(zip_members(make_archives(
+                    root, [(dest, "zip")])[0]))
+                with zipfile.ZipFile(dest) as zf:
+                    self.assertEqual(zf.testzip(), None)
+                    types = dict((i.filename, i.compress_type)
+                                 for i in zf.infolist())
+                self.assertEqual(types["Bitmask/text.py"],
+                                 zipfile.ZIP_DEFLATED)
+                self.assertEqual(types["Bitmask/noise.so"],
+                                 zipfile.ZIP_STORED)
+            self.assertEqual(zips[0], zips[1])
+        finally:
+            archiver.PRECOMPRESSED = sys.version_info[:2] == (2, 7)
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    unittest.main()
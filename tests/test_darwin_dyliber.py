@@ -0,0 +1,99 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+from darwin_dyliber import MachOError, plan_all, read_macho
+
+# made by fixtures/macho/make_fixtures.py
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures", "macho")
+
+
+def fixture(name):
+    return os.path.join(FIXTURES, name)
+
+
+class ReadMachOTest(unittest.TestCase):
+    def test_thin_64_bit_dylib(self):
+        info = read_macho(fixture("libfoo.1.dylib"))
+        self.assertEqual(info.install_name, "/usr/local/lib/libfoo.1.dylib")
+        # LC_LOAD_WEAK_DYLIB comes with the other dylibs
+        self.assertEqual(info.dylibs, ["/usr/local/lib/libbar.dylib",
+                                       "/usr/lib/libSystem.B.dylib",
+                                       "@rpath/libweak.dylib"])
+        self.assertEqual(info.rpaths, ["@loader_path/../lib"])
+
+    def test_thin_32_bit_big_endian_executable(self):
+        info = read_macho(fixture("ppc_executable"))
+        self.assertEqual(info.install_name, None)
+        self.assertEqual(info.dylibs, [
+            "/usr/local/lib/libfoo.1.dylib",
+            "/System/Library/Frameworks/Carbon.framework/Carbon"])
+        self.assertEqual(info.rpaths, [])
+
+    def test_fat_slices_are_merged(self):
+        info = read_macho(fixture("libuni.dylib"))
+        self.assertEqual(info.install_name, "libuni.dylib")
+        self.assertEqual(info.dylibs, ["/opt/lib/libbar.dylib",
+                                       "/opt/lib/libonly64.dylib",
+                                       "/opt/lib/libweak.dylib"])
+
+    def test_not_macho(self):
+        self.assertEqual(read_macho(fixture("Example.class")), None)
+        self.assertEqual(read_macho(fixture("make_fixtures.py")), None)
+
+    def test_truncated(self):
+        self.assertRaises(MachOError, read_macho,
+                          fixture("libtruncated.dylib"))
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-dyliber-")
+        self.exe = os.path.join(self.tmp, "MacOS")
+        os.makedirs(os.path.join(self.exe, "lib"))
+        for name in ["libfoo.1.dylib", "ppc_executable", "Example.class"]:
+            shutil.copy(fixture(name), self.exe)
+        for name in ["libbar.dylib", "libweak.dylib"]:
+            with open(os.path.join(self.exe, "lib", name), "w") as f:
+                f.write("not a Mach-O file\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_plan(self):
+        plan = dict((os.path.relpath(path, self.exe), args)
+                    for path, args in plan_all(self.exe))
+        self.assertEqual(plan, {
+            "libfoo.1.dylib": [
+                "-id", "@executable_path/libfoo.1.dylib",
+                "-change", "/usr/local/lib/libbar.dylib",
+                "@executable_path/lib/libbar.dylib",
+                "-change", "@rpath/libweak.dylib",
+                "@executable_path/lib/libweak.dylib"],
+            # Carbon is left alone
+            "ppc_executable": [
+                "-change", "/usr/local/lib/libfoo.1.dylib",
+                "@executable_path/libfoo.1.dylib"],
+        })
+
+    def test_fat_binary(self):
+        shutil.copy(fixture("libuni.dylib"), self.exe)
+        plan = dict((os.path.basename(path), args)
+                    for path, args in plan_all(self.exe))
+        # libonly64 isn't in the bundle, it's left as it is
+        self.assertEqual(plan["libuni.dylib"], [
+            "-id", "@executable_path/libuni.dylib",
+            "-change", "/opt/lib/libbar.dylib",
+            "@executable_path/lib/libbar.dylib",
+            "-change", "/opt/lib/libweak.dylib",
+            "@executable_path/lib/libweak.dylib"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+from delta import apply_delta, make_delta
+
+
+def make_bundle(root, files):
+    for rel, data in files.items():
+        path = os.path.join(root, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+    os.chmod(root, 0755)
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-delta-")
+        self.old = os.path.join(self.tmp, "Bitmask-old")
+        self.new = os.path.join(self.tmp, "Bitmask-new")
+        make_bundle(self.old, {"app.py": "old\n", "lib/same.py": "same\n"})
+        make_bundle(self.new, {"app.py": "new\n", "lib/same.py": "same\n",
+                               "lib/added.py": "added\n"})
+        self.delta = make_delta(self.old, self.new,
+                                os.path.join(self.tmp, "delta.tar.bz2"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_top_directory_mode(self):
+        with tarfile.open(self.delta) as tf:
+            top = tf.getmember("delta")
+        self.assertEqual(stat.S_IMODE(top.mode), 0755)
+
+    def test_applies(self):
+        dest = os.path.join(self.tmp, "applied")
+        apply_delta(self.old, self.delta, dest)
+        for rel in ["app.py", "lib/same.py", "lib/added.py"]:
+            with open(os.path.join(dest, rel)) as a:
+                with open(os.path.join(self.new, rel)) as b:
+                    self.assertEqual(a.read(), b.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+from gitfetch import fetch_all, repo_url
+
+ENV = {
+    "GIT_AUTHOR_NAME": "test", "GIT_AUTHOR_EMAIL": "test@example.org",
+    "GIT_COMMITTER_NAME": "test", "GIT_COMMITTER_EMAIL": "test@example.org",
+}
+
+
+def git(cwd, *args):
+    env = dict(os.environ)
+    env.update(ENV)
+    return subprocess.check_output(("git",) + args, cwd=cwd, env=env,
+                                   stderr=subprocess.STDOUT).strip()
+
+
+def commit(path, n):
+    for d in ["src", "tests", "docs"]:
+        if not os.path.isdir(os.path.join(path, d)):
+            os.makedirs(os.path.join(path, d))
+        with open(os.path.join(path, d, "file"), "w") as f:
+            f.write("{0}\n".format(n))
+    git(path, "add", "-A")
+    git(path, "commit", "--quiet", "-m", "commit {0}".format(n))
+    return git(path, "rev-parse", "HEAD")
+
+
+def make_remote(remotes, work, name):
+    # master with release tags, a lightweight tag after the last one and
+    # a higher one on a side branch, develop ahead of master
+    path = os.path.join(work, name)
+    git(work, "init", "--quiet", name)
+    shas = {}
+    for n in range(1, 13):
+        shas[n] = commit(path, n)
+        if n == 3:
+            git(path, "tag", "-a", "0.1", "-m", "0.1")
+        if n == 8:
+            git(path, "tag", "-a", "0.2", "-m", "0.2")
+        if n == 10:
+            git(path, "tag", "not-a-release")
+    master = shas[12]
+    git(path, "checkout", "--quiet", "-b", "side", shas[5])
+    commit(path, "side")
+    git(path, "tag", "-a", "0.10", "-m", "0.10")
+    git(path, "checkout", "--quiet", "-b", "develop", "master")
+    develop = commit(path, "develop")
+    git(remotes, "clone", "--quiet", "--bare", path, name)
+    return {"release": shas[8], "master": master, "develop": develop}
+
+
+class FetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix="test-gitfetch-")
+        cls.remotes = os.path.join(cls.tmp, "remotes")
+        work = os.path.join(cls.tmp, "work")
+        os.makedirs(cls.remotes)
+        os.makedirs(work)
+        cls.heads = {}
+        for name in ["bitmask_client", "leap_assets"]:
+            cls.heads[name] = make_remote(cls.remotes, work, name)
+        cls.base = "file://" + cls.remotes
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def fetch(self, nightly, **kwargs):
+        basedir = tempfile.mkdtemp(dir=self.tmp)
+        fetch_all(basedir, ["bitmask_client", "leap_assets"],
+                  lambda repo: repo_url(repo, self.base), nightly,
+                  jobs=2, **kwargs)
+        return basedir
+
+    def check(self, basedir, nightly, sparse=False):
+        client = os.path.join(basedir, "bitmask_client")
+        expected = self.heads["bitmask_client"]
+        self.assertEqual(git(client, "rev-parse", "HEAD"),
+                         expected["develop" if nightly else "release"])
+        if not nightly:
+            self.assertEqual(git(client, "describe", "--exact-match"), "0.2")
+        # master only, whatever its tags
+        assets = os.path.join(basedir, "leap_assets")
+        self.assertEqual(git(assets, "rev-parse", "HEAD"),
+                         self.heads["leap_assets"]["master"])
+        for repo in [client, assets]:
+            self.assertTrue(os.path.isfile(os.path.join(repo, "src",
+                                                        "file")))
+            self.assertEqual(os.path.exists(os.path.join(repo, "tests")),
+                             not sparse)
+            self.assertEqual(git(repo, "config", "remote.origin.url"),
+                             repo_url(os.path.basename(repo), self.base))
+
+    def test_modes(self):
+        cache = os.path.join(self.tmp, "cache")
+        modes = [
+            ("full", {}, False),
+            ("shallow", {"depth": 1}, False),
+            ("shallow and sparse", {"depth": 1, "sparse": True}, True),
+            ("cache", {"cache": cache}, False),
+            ("cache again", {"cache": cache, "sparse": True}, True),
+        ]
+        for nightly in [False, True]:
+            for name, kwargs, sparse in modes:
+                basedir = self.fetch(nightly, **kwargs)
+                try:
+                    self.check(basedir, nightly, sparse)
+                except AssertionError as e:
+                    raise AssertionError("{0}, nightly={1}: {2}".format(
+                        name, nightly, e))
+
+    def test_default_urls(self):
+        self.assertEqual(repo_url("soledad"),
+                         "git://github.com/leapcode/soledad")
+        self.assertEqual(repo_url("leap_assets"),
+                         "git://leap.se/leap_assets")
+        self.assertEqual(repo_url("soledad", "/srv/git/"),
+                         "/srv/git/soledad")
+
+
+if __name__ == "__main__":
+    unittest.main()
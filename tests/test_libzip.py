@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+from libzip import BOOTSTRAP, LIBRARY_ZIP, add_bootstrap
+
+LAUNCHERS = {
+    "parenthesized": (
+        "#!/usr/bin/env python\n"
+        "from __future__ import (absolute_import,\n"
+        "                        print_function)\n"
+        "import os\n",
+        "import os\n"),
+    "docstring and continuation": (
+        "# -*- coding: utf-8 -*-\n"
+        '"""\n'
+        "The launcher.\n"
+        '"""\n'
+        "from __future__ import absolute_import, \\\n"
+        "    print_function\n"
+        "\n"
+        "from __future__ import division  # comment\n"
+        "import os\n",
+        "import os\n"),
+    "docstring only": (
+        '"""The launcher."""\n'
+        "import os\n",
+        "import os\n"),
+    "shebang only": (
+        "#!/usr/bin/env python\n"
+        "import os\n",
+        "import os\n"),
+}
+
+
+class AddBootstrapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-libzip-")
+        self.path = os.path.join(self.tmp, "launcher.py")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_after_the_header(self):
+        bootstrap = BOOTSTRAP.format(LIBRARY_ZIP)
+        for name, (source, rest) in sorted(LAUNCHERS.items()):
+            with open(self.path, "w") as f:
+                f.write(source)
+            add_bootstrap(self.path)
+            with open(self.path) as f:
+                patched = f.read()
+            head = source[:len(source) - len(rest)]
+            self.assertEqual(patched, head + bootstrap + rest, name)
+            compile(patched, self.path, "exec")
+
+    def test_once(self):
+        with open(self.path, "w") as f:
+            f.write(LAUNCHERS["parenthesized"][0])
+        add_bootstrap(self.path)
+        with open(self.path) as f:
+            once = f.read()
+        add_bootstrap(self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), once)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "bundler"))
+
+from wheelhouse import Wheelhouse
+
+PIP = os.path.join(os.path.dirname(sys.executable), "pip")
+
+
+def make_wheel(index, name, version="1.0"):
+    # the smallest wheel pip installs, one module printing nothing
+    dist_info = "{0}-{1}.dist-info".format(name, version)
+    path = os.path.join(index, "{0}-{1}-py2-none-any.whl".format(name,
+                                                                 version))
+    files = {
+        name + ".py": "VALUE = {0!r}\n".format(name),
+        dist_info + "/METADATA": "Metadata-Version: 2.1\nName: {0}\n"
+                                 "Version: {1}\n".format(name, version),
+        dist_info + "/WHEEL": "Wheel-Version: 1.0\nGenerator: test\n"
+                              "Root-Is-Purelib: true\nTag: py2-none-any\n",
+    }
+    record = "".join("{0},,\n".format(f) for f in sorted(files))
+    files[dist_info + "/RECORD"] = record + dist_info + "/RECORD,,\n"
+    with zipfile.ZipFile(path, "w") as zf:
+        for arcname, data in sorted(files.items()):
+            zf.writestr(arcname, data)
+    return path
+
+
+def make_repo(root, name, requirements):
+    repo = os.path.join(root, name)
+    os.makedirs(os.path.join(repo, "pkg"))
+    with open(os.path.join(repo, "pkg", "requirements.pip"), "w") as f:
+        f.write("".join(r + "\n" for r in requirements))
+    with open(os.path.join(repo, "setup.py"), "w") as f:
+        f.write("# {0}\n".format(name))
+    return repo
+
+
+@unittest.skipUnless(os.path.exists(PIP), "needs pip next to python")
+class WheelhouseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="test-wheelhouse-")
+        self.index = os.path.join(self.tmp, "index")
+        os.makedirs(self.index)
+        for name in ["demo", "other"]:
+            make_wheel(self.index, name)
+        # installs go to a user site of their own, not the interpreter's
+        self.env = dict(os.environ)
+        os.environ["PIP_USER"] = "1"
+        os.environ["PYTHONUSERBASE"] = os.path.join(self.tmp, "userbase")
+        os.environ["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+        self.house = Wheelhouse(os.path.join(self.tmp, "house"), self.index,
+                                PIP)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmp)
+
+    def requirements(self, repo):
+        return os.path.join(repo, "pkg", "requirements.pip")
+
+    def test_builds_once_and_installs_offline(self):
+        repo = make_repo(self.tmp, "a", ["demo"])
+        self.assertTrue(self.house.build(self.requirements(repo)))
+        self.assertFalse(self.house.build(self.requirements(repo)))
+        self.house.install(self.requirements(repo))
+        out = subprocess.check_output([sys.executable, "-c",
+                                       "import demo; print demo.__file__"])
+        self.assertTrue(out.startswith(os.environ["PYTHONUSERBASE"]))
+
+    def test_batches_share_no_wheel(self):
+        reqs = [self.requirements(make_repo(self.tmp, name, deps))
+                for name, deps in [("a", ["demo"]), ("b", ["other"]),
+                                   ("c", ["demo"])]]
+        for req in reqs:
+            self.house.build(req)
+        self.assertEqual(self.house.batches(reqs),
+                         [[reqs[0], reqs[1]], [reqs[2]]])
+
+    def test_unchanged_until_requirements_change(self):
+        repo = make_repo(self.tmp, "a", ["demo"])
+        self.assertFalse(self.house.unchanged(repo, "env"))
+        self.house.save([repo], "env")
+        self.assertTrue(self.house.unchanged(repo, "env"))
+        self.assertFalse(self.house.unchanged(repo, "other env"))
+        with open(self.requirements(repo), "a") as f:
+            f.write("other\n")
+        self.assertFalse(self.house.unchanged(repo, "env"))
+
+    def test_environment_leaves_editables_out(self):
+        fake_pip = os.path.join(self.tmp, "pip")
+        with open(fake_pip, "w") as f:
+            f.write("#!/bin/sh\necho demo==1.0\n"
+                    "echo \"-e git+https://example.org/a@$REV#egg=a\"\n")
+        os.chmod(fake_pip, 0755)
+        house = Wheelhouse(os.path.join(self.tmp, "house"), pip=fake_pip)
+        os.environ["REV"] = "1"
+        before = house.environment()
+        os.environ["REV"] = "2"
+        self.assertEqual(house.environment(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()